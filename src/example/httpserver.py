@@ -1,16 +1,60 @@
 import webapp2
+from pyparsing import ParseException
 from rdflib import Graph
 from rdflib_appengine.ndbstore import NDBStore
+from rdflib_appengine.querycache import QueryCache
+from rdflib_appengine.sparqljson import iter_json
 
 _GRAPH_ID = 'default-graph'
 _GRAPH_INSTANCE_ID = 'Graph-instance'
 
+'''Serialized query results, shared by all requests served by this instance'''
+_QUERY_CACHE = QueryCache()
+
+'''The maximal number of solutions returned for a query'''
+_MAX_ROWS = 10000
+
+'''The maximal size of a streamed result to cache'''
+_MAX_CACHED_BYTES = 1000000
+
+'''Triple patterns whose GraphShards are loaded by every new instance, in addition to those recently used by other instances'''
+_WARM_UP_PATTERNS = []
+
+'''Common queries prepared by every new instance'''
+_WARM_UP_QUERIES = []
+
+'''The number of queries between each recording of the GraphShards used by this instance, see NDBStore.remember_hot_shards()'''
+_QUERIES_PER_HOT_SHARDS = 100
+
+_queries_served = 0
+
 class MainPage(webapp2.RequestHandler):
     def get(self):
         #Access-Control-Allow-Origin: *
         self.response.headers['Access-Control-Allow-Origin'] = '*'
         self.response.headers['Content-Type'] = 'application/sparql-results+json; charset=utf-8'
-        self.response.write(query(self.request.get('query')))
+        q = self.request.get('query')
+        g = graph()
+        remember_hot_shards(g.store)
+        key = _QUERY_CACHE.key(g.store, q, 'json')
+        result = _QUERY_CACHE.get(key)
+        if result is not None:
+            self.response.headers['X-Cache'] = 'HIT'
+            self.response.write(result)
+        else:
+            self.response.headers['X-Cache'] = 'MISS'
+            try:
+                self.response.app_iter = streamed_query(g, q, key)
+            except (ParseException, ValueError) as e:
+                self.response.set_status(400)
+                self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+                self.response.write('Invalid query: {}'.format(e))
+
+class WarmUp(webapp2.RequestHandler):
+    def get(self):
+        stats = graph().store.warm_up(patterns = _WARM_UP_PATTERNS, queries = _WARM_UP_QUERIES)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('Warmed up with {shards} GraphShards and {queries} queries in {seconds:.3f}s'.format(**stats))
 
 class FourOhFour(webapp2.RequestHandler):
     def get(self):
@@ -20,6 +64,7 @@ class FourOhFour(webapp2.RequestHandler):
 
 application = webapp2.WSGIApplication([
     ('/ds/.*', MainPage),
+    ('/_ah/warmup', WarmUp),
     ('/.*', FourOhFour),
 ], debug=True)
 
@@ -28,7 +73,34 @@ def update(q):
     
 def query(q):
     return graph().query(q).serialize(format='json')
+
+def streamed_query(g, q, key):
+    '''Parses the query and starts evaluating it, see iter_json().
+       @return A generator yielding the result of the query as application/sparql-results+json in chunks.
+               If the complete result is small, it is cached with the given key.
+       @raise ParseException, ValueError: If the query is invalid, or not a SELECT or ASK query
+    '''
+    return _cached(iter_json(g, q, max_rows = _MAX_ROWS), key)
+
+def _cached(result, key):
+    chunks = []
+    size = 0
+    for chunk in result:
+        if size <= _MAX_CACHED_BYTES:
+            chunks.append(chunk)
+            size += len(chunk)
+        yield chunk
+    if size <= _MAX_CACHED_BYTES:
+        _QUERY_CACHE.put(key, ''.join(chunks))
     
+def remember_hot_shards(store):
+    '''Records the GraphShards used by this instance for warming up new instances, once every _QUERIES_PER_HOT_SHARDS queries.
+    '''
+    global _queries_served
+    _queries_served += 1
+    if _queries_served % _QUERIES_PER_HOT_SHARDS == 0:
+        store.remember_hot_shards()
+
 def graph():
     return Graph(store = NDBStore(identifier = _GRAPH_ID))
 
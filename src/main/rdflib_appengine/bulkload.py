@@ -0,0 +1,184 @@
+'''
+Streaming bulk loading of large RDF files into an NDBStore.
+
+NDBStore.addN() collects all the given triples in memory before writing them, so loading a large
+dump with a single call needs the whole dump in memory, and a failure halfway through loses the work done.
+load() instead reads the file in chunks of a bounded number of triples. Each chunk is grouped by GraphShard
+and written asynchronously while the next chunk is parsed. After each chunk is written, the number of triples
+loaded so far is recorded in a BulkLoad entity, so a load that was interrupted (e.g. by a DeadlineExceededError)
+can be resumed by calling load() again with the same load_id.
+
+Example, e.g. in a task queue handler that is retried until it succeeds:
+  load(NDBStore(identifier = 'current'), 'dump.nt', load_id = 'dump-2015-01-09')
+
+A context aware NDBStore is loaded into one of its contexts, by default the default graph.
+'''
+
+from google.appengine.ext import ndb
+from rdflib_appengine.ndbstore import _identifier_of
+from rdflib import Graph
+from rdflib.term import BNode
+from rdflib.plugins.parsers.ntriples import NTriplesParser, ParseError, r_nodeid, ascii
+from itertools import islice
+from time import time
+from uuid import uuid4
+import logging
+
+class BulkLoad(ndb.Model):
+    '''Records the progress of a bulk load into an NDBStore, see load().
+       The key's id is the load_id followed by the graph_ID.
+    '''
+    graph_ID = ndb.StringProperty()
+    triples = ndb.IntegerProperty(default = 0, indexed = False) #The number of triples from the file that have been written
+    seconds = ndb.FloatProperty(default = 0.0, indexed = False) #The time spent writing them, across resumed loads
+    bnode_prefix = ndb.StringProperty(indexed = False) #Makes the blank nodes of a resumed load equal to those already written
+    is_done = ndb.BooleanProperty(default = False, indexed = False)
+
+    def triples_per_second(self):
+        '''@return The average throughput of this bulk load
+        '''
+        return self.triples / self.seconds if self.seconds > 0 else 0.0
+
+def load(store, source, format = 'nt', chunk_size = 10000, load_id = None, context = None):
+    '''Adds the triples in an RDF file to an NDBStore, reading and writing a chunk of triples at a time.
+       N-Triples files are streamed. Other formats are parsed into memory by rdflib first, and then written in chunks.
+       @param store: An NDBStore
+       @param source: A file-like object or the name of a file
+       @param format: The rdflib name of the file's format, e.g. 'nt' or 'turtle'
+       @param chunk_size: The maximal number of triples to hold in memory and write in one batch
+       @param load_id: None, or a string naming this load. If given, the progress is recorded in a BulkLoad entity,
+                       and calling load() again with the same load_id continues after the last triples written.
+                       Only N-Triples files can be resumed, as other parsers may name blank nodes differently on every run.
+       @param context: If the NDBStore is context aware, a Graph or the identifier of the context to load the triples into,
+                       or None for the default graph. Must be None otherwise.
+       @return The BulkLoad describing the load. It is only stored if load_id is given.
+    '''
+    assert isinstance(chunk_size, int) and chunk_size > 0, 'chunk_size must be a positive integer, not {}'.format(chunk_size)
+    assert load_id is None or format == 'nt', 'Only N-Triples loads can be resumed, not {}'.format(format)
+    target = _target(store, context)
+    progress = _progress(target, load_id)
+    if progress.is_done:
+        logging.info('Bulk load {} into {} has already completed'.format(load_id, target._ID))
+        return progress
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            return _load(target, store, f, format, chunk_size, progress)
+    return _load(target, store, source, format, chunk_size, progress)
+
+def _target(store, context):
+    '''@return The NDBStore to write the triples to: The given store, or if it is context aware, 
+               the NDBStore for the triples of the given context, which is registered as a context of the given store
+    '''
+    if not store.context_aware:
+        assert context is None, 'Only a context aware NDBStore can be loaded into a context'
+        return store
+    for future in store._register_contexts_async([_identifier_of(context)]):
+        future.check_success()
+    return store._context_store(context)
+
+def _progress(store, load_id):
+    '''@return The BulkLoad for the given load_id, a new one if it does not exist or load_id is None
+    '''
+    if load_id is None:
+        return BulkLoad(graph_ID = store._ID, bnode_prefix = uuid4().hex)
+    key = ndb.Key(BulkLoad, '{}-{}'.format(load_id, store._ID))
+    progress = key.get()
+    if progress is None:
+        return BulkLoad(key = key, graph_ID = store._ID, bnode_prefix = uuid4().hex)
+    logging.info('Resuming bulk load {} into {} after {} triples'.format(load_id, store._ID, progress.triples))
+    return progress
+
+def _load(store, owner, f, format, chunk_size, progress):
+    '''Writes the triples from the given file to the store, recording progress after each chunk.
+       While the writes of one chunk are in flight, the next chunk is parsed.
+       @param owner: The NDBStore passed to load(), whose generation changes with that of store
+    '''
+    triples = _triples(f, format, progress.bnode_prefix)
+    for _ in islice(triples, progress.triples): #Skip the triples written before the load was interrupted
+        pass
+    written = progress.triples
+    futures = []
+    while True:
+        #Step 1: Parse the next chunk while the writes of the previous chunk are in flight
+        begin = time()
+        chunk = list(islice(triples, chunk_size))
+        #Step 2: Complete the writes of the previous chunk and record them
+        for future in futures:
+            future.get_result()
+        progress.triples = written
+        progress.seconds += time() - begin
+        if len(futures) > 0:
+            store._bump_generation()
+            if owner is not store:
+                owner._bump_generation()
+            logging.info('Loaded {} triples into {} ({:.0f} triples/s)'.format(progress.triples, store._ID, progress.triples_per_second()))
+        if len(chunk) == 0:
+            break
+        #Step 3: Start writing this chunk, grouped by GraphShard
+        begin = time()
+        futures = store._update_shards_async(store._changes_for_adds(chunk))
+        if progress.key is not None:
+            futures.append(progress.put_async())
+        if len(futures) > 0:
+            #NDB only sends the queued batches when some result is waited for. Waiting for the first to complete sends them all.
+            ndb.Future.wait_any(futures)
+        progress.seconds += time() - begin
+        written += len(chunk)
+    progress.is_done = True
+    if progress.key is not None:
+        progress.put()
+    logging.info('Completed bulk load of {} triples into {} in {:.1f}s ({:.0f} triples/s)'.format(progress.triples, store._ID, progress.seconds, progress.triples_per_second()))
+    return progress
+
+def _triples(f, format, bnode_prefix):
+    '''Generator yielding the triples in the given file.
+       @param bnode_prefix: A string prefixed to the labels of blank nodes in N-Triples files,
+                            so the same label always yields the same BNode within a bulk load
+    '''
+    if format != 'nt':
+        g = Graph()
+        g.parse(f, format = format)
+        for t in g:
+            yield t
+        return
+    parser = _StreamingNTriplesParser(bnode_prefix)
+    for t in parser.triples(f):
+        yield t
+
+class _StreamingNTriplesParser(NTriplesParser):
+    '''An N-Triples parser yielding each triple as it is parsed, instead of passing it to a sink.
+    '''
+    def __init__(self, bnode_prefix):
+        super(_StreamingNTriplesParser, self).__init__(sink = self)
+        self._bnode_prefix = bnode_prefix
+        self._triple = None
+
+    def triples(self, f):
+        '''Generator yielding the triples in the given N-Triples file.
+           @raise ParseError: If a line is not valid N-Triples
+        '''
+        self.file = ascii(f)
+        self.buffer = ''
+        while True:
+            self.line = self.readline()
+            if self.line is None:
+                return
+            try:
+                self.parseline()
+            except ParseError:
+                raise ParseError('Invalid line: {!r}'.format(self.line))
+            if self._triple is not None:
+                yield self._triple
+                self._triple = None
+
+    def triple(self, s, p, o):
+        '''Called by parseline() as the sink for each triple.
+        '''
+        self._triple = (s, p, o)
+
+    def nodeid(self):
+        '''Overrides NTriplesParser.nodeid(), which maps labels to fresh BNodes shared by all parsers of the process.
+        '''
+        if self.peek('_'):
+            return BNode(self._bnode_prefix + self.eat(r_nodeid).group(1))
+        return False
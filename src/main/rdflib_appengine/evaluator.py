@@ -0,0 +1,283 @@
+'''
+The SPARQL query evaluator for Graphs backed by an NDBStore, see NDBStore.
+
+Importing this module registers the evaluator in rdflib. It is imported by NDBStore.query() and NDBStore.update()
+before rdflib evaluates the first query or update, rather than by rdflib_appengine.ndbstore itself, so an instance that imports
+rdflib_appengine.ndbstore does not pay for importing rdflib's SPARQL machinery until it is needed.
+'''
+
+from rdflib_appengine.ndbstore import NDBStore, _plan, _is_variable
+from rdflib_appengine.querycache import normalize
+from rdflib.plugins.sparql.evaluate import evalPart, evalSelectQuery, evalAskQuery, evalConstructQuery
+from rdflib.plugins.sparql.sparql import AlreadyBound, QueryContext
+from rdflib.plugins.sparql.evalutils import _fillTemplate
+from rdflib.plugins.sparql.parser import parseUpdate
+from rdflib.plugins.sparql.algebra import translateUpdate
+from rdflib.plugins.sparql import CUSTOM_EVALS, prepareQuery
+from rdflib.term import Node, Variable
+from rdflib.graph import ConjunctiveGraph
+from collections import OrderedDict
+from StringIO import StringIO
+from itertools import islice
+import logging
+
+'''The maximal number of queries remembered by prepare()'''
+_MAX_PREPARED_QUERIES = 100
+
+_prepared_queries = OrderedDict() #Maps the normalized text of a query to the prepared query, least recently used first
+
+def prepare(query):
+    '''Parses and translates a SPARQL query like rdflib.plugins.sparql.prepareQuery(), but remembers the most recently
+       prepared queries, so a common query is only parsed once by an instance. The first query parsed by a process
+       takes much longer than the rest, as rdflib initializes its parser, so NDBStore.warm_up() prepares the common queries.
+       @param query: The text of a SPARQL query
+       @return The prepared query, which can be passed to Graph.query() instead of the text
+    '''
+    key = normalize(query)
+    prepared = _prepared_queries.pop(key, None)
+    if prepared is None:
+        prepared = prepareQuery(query)
+    _prepared_queries[key] = prepared
+    while len(_prepared_queries) > _MAX_PREPARED_QUERIES:
+        _prepared_queries.popitem(last = False)
+    return prepared
+
+'''The sizes of the batches of bindings evaluated together. 
+   The first batches are small so the first solutions are found quickly, e.g. for queries with a LIMIT.'''
+_BATCH_SIZES = [8, 32, 128, 256]
+
+'''The functions evaluating the queries that can be traced'''
+_QUERY_EVALS = {'SelectQuery' : evalSelectQuery, 'AskQuery' : evalAskQuery, 'ConstructQuery' : evalConstructQuery}
+
+def _evalPartWithLoggingAndLazyJoins(ctx, part):
+    '''Supplement to rdflib.plugins.sparql.evaluate.evalPart().
+       Only active when ctx.graph is backed by an NDBStore
+       Dumps any query to the NDBStores internal log, and traces it if tracing is enabled.
+       Executes every join as a lazy join.
+       Evaluates basic graph patterns with prefetching.
+       Stops evaluating when the LIMIT of a query is reached.
+    '''
+    if not isinstance(ctx.graph.store, NDBStore):
+        raise NotImplementedError
+    if part.name in _QUERY_EVALS:
+        s = StringIO()
+        _dump(part, '', s)
+        ctx.graph.store.log(s.getvalue())
+        if not ctx.graph.store.is_tracing():
+            raise NotImplementedError
+        return _evalQueryWithTracing(ctx, part)
+    elif part.name == 'Join':
+        return _evalLazyJoinWithPrefetch(ctx, part)
+    elif part.name == 'BGP':
+        return _evalBGPWithPrefetch([ctx], _ordered(ctx, part.triples))
+    elif part.name == 'Slice':
+        return _evalSlice(ctx, part)
+    else:
+        raise NotImplementedError
+
+def _batches(iterable):
+    '''Generator splitting the given iterable into lists with the lengths in _BATCH_SIZES (repeating the last length).
+    '''
+    iterator = iter(iterable)
+    for size in _sizes():
+        batch = list(islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+def _sizes():
+    for size in _BATCH_SIZES:
+        yield size
+    while True:
+        yield _BATCH_SIZES[-1]
+
+def _evalQueryWithTracing(ctx, query):
+    '''Evaluates a query like rdflib does, within a root Span for the query.
+       The solutions of a SELECT query are evaluated lazily, so its Span ends when all solutions have been consumed or the evaluation is closed.
+    '''
+    store = ctx.graph.store
+    span = store._begin_query(query.name)
+    if query.name != 'SelectQuery':
+        try:
+            return _QUERY_EVALS[query.name](ctx, query)
+        finally:
+            store._end_query(span)
+    res = evalSelectQuery(ctx, query)
+    res['bindings'] = _tracedSolutions(store, span, res['bindings'])
+    return res
+
+def _tracedSolutions(store, span, solutions):
+    '''Generator yielding the given solutions, then ending the given Span of the query.
+    '''
+    count = 0
+    try:
+        for solution in solutions:
+            count += 1
+            yield solution
+    finally:
+        span.set(solutions = count)
+        store._end_query(span)
+
+def _evalSlice(ctx, part):
+    '''Like rdflib.plugins.sparql.evaluate.evalSlice(), but does not consume the rest of the solutions 
+       after OFFSET + LIMIT solutions have been found.
+    '''
+    end = None if part.length is None else part.start + part.length
+    return islice(evalPart(ctx, part.p), part.start, end)
+
+def _evalLazyJoinWithPrefetch(ctx, join):
+    '''Like rdflib.plugins.sparql.evaluate.evalLazyJoin(), pushes the bindings from the first part to the second part.
+       But if the second part is a basic graph pattern, it is evaluated for a batch of bindings at a time.
+    '''
+    for batch in _batches(evalPart(ctx, join.p1)):
+        ctxs = [ctx.thaw(a) for a in batch]
+        if join.p2.name == 'BGP':
+            for b in _evalBGPWithPrefetch(ctxs, _ordered(ctxs[0], join.p2.triples)):
+                yield b
+        else:
+            for c in ctxs:
+                for b in evalPart(c, join.p2):
+                    yield b
+
+def _evalBGPWithPrefetch(ctxs, bgp):
+    '''Like rdflib.plugins.sparql.evaluate.evalBGP(), but for several contexts at once.
+       The triple patterns are matched breadth first: Before matching a triple pattern, 
+       the GraphShards it needs for every context in the batch are prefetched.
+       @param ctxs: A nonempty list of QueryContexts, all for the same Graph
+       @param bgp: A list of triple patterns
+    '''
+    if not bgp:
+        for c in ctxs:
+            yield c.solution()
+        return
+    (s, p, o) = bgp[0]
+    graph = ctxs[0].graph
+    context = None if isinstance(graph, ConjunctiveGraph) else graph #The contexts triples() will read
+    graph.store.prefetch([(c[s], c[p], c[o]) for c in ctxs if isinstance(p, Node)], context) #p may be a property path
+    for batch in _batches(c for ctx in ctxs for c in _match(ctx, (s, p, o))):
+        for x in _evalBGPWithPrefetch(batch, bgp[1:]):
+            yield x
+
+def _ordered(ctx, bgp):
+    '''@param ctx: A QueryContext for a Graph backed by an NDBStore
+       @param bgp: A list of triple patterns
+       @return The triple patterns in the order chosen by _plan() for the variables bound in the given context
+    '''
+    store = ctx.graph.store
+    if not store._keeps_statistics or len(bgp) < 2:
+        return bgp
+    bound = set(term for pattern in bgp for term in pattern if _is_variable(term) and ctx[term] is not None)
+    plan = _plan(store, bgp, bound)
+    store._finish(store._span('plan', patterns = plan))
+    return [pattern for (pattern, _) in plan]
+
+def evalUpdateWithBatchedWrites(graph, update, initNs, initBindings):
+    '''Like rdflib.plugins.sparql.update.evalUpdate(), but writes the changes of each operation in one batch grouped by GraphShard, 
+       which writes each affected GraphShard once, see NDBStore._apply(). So the cost of an operation depends on the number of
+       GraphShards written, not the number of triples. rdflib instead writes every triple separately.
+       As in SPARQL, the triples of an operation are deleted before those it inserts, so a triple both deleted and inserted is kept.
+       Only INSERT DATA, DELETE DATA, DELETE WHERE and DELETE/INSERT ... WHERE on the default graph are supported.
+       The solutions of a WHERE clause are all found before anything is written.
+       @param graph: A Graph backed by an NDBStore
+       @param update: The text of a SPARQL update, or a translated update
+       @param initNs: A dict mapping prefixes to namespaces, used if update is text
+       @param initBindings: A dict mapping variables to initial values
+       @raise NotImplementedError: If any operation of the update is not supported. Nothing has been written then.
+    '''
+    if isinstance(update, basestring):
+        update = translateUpdate(parseUpdate(update), initNs = initNs)
+    if not all([_is_batched(u) for u in update]):
+        raise NotImplementedError
+    for u in update:
+        ctx = QueryContext(graph)
+        ctx.prologue = u.prologue
+        for (k, v) in (initBindings or {}).iteritems():
+            ctx[k if isinstance(k, Variable) else Variable(k)] = v
+        try:
+            (removed, added) = _changes(ctx, u)
+            if len(removed) > 0 or len(added) > 0:
+                graph.store._apply(removed, added)
+        except:
+            if not u.silent:
+                raise
+
+def _is_batched(u):
+    '''@param u: An operation of a translated SPARQL update
+       @return True if evalUpdateWithBatchedWrites() supports the operation, i.e. it only changes triples in the default graph
+    '''
+    if u.name in ['InsertData', 'DeleteData', 'DeleteWhere']:
+        return len(u.quads) == 0
+    if u.name == 'Modify':
+        return (u.using is None and u.withClause is None 
+                and all([clause is None or len(clause.quads) == 0 for clause in [u.delete, u.insert]]))
+    return False
+
+def _changes(ctx, u):
+    '''@param ctx: A QueryContext for the Graph to update
+       @param u: An operation of a translated SPARQL update, see _is_batched()
+       @return A pair of lists (triples to remove, triples to add)
+    '''
+    if u.name == 'InsertData':
+        return ([], u.triples)
+    if u.name == 'DeleteData':
+        return (u.triples, [])
+    if u.name == 'DeleteWhere':
+        solutions = list(_evalBGPWithPrefetch([ctx], _ordered(ctx, u.triples)))
+        return ([t for c in solutions for t in _fillTemplate(u.triples, c)], [])
+    solutions = list(evalPart(ctx, u.where))
+    removed = [t for c in solutions for t in _fillTemplate(u.delete.triples, c)] if u.delete is not None else []
+    added = [t for c in solutions for t in _fillTemplate(u.insert.triples, c)] if u.insert is not None else []
+    return (removed, added)
+
+def _match(ctx, (s, p, o)):
+    '''Generator yielding a context for each triple matching the given triple pattern in the given context.
+       Corresponds to the body of rdflib.plugins.sparql.evaluate.evalBGP()
+    '''
+    _s = ctx[s]
+    _p = ctx[p]
+    _o = ctx[o]
+    for ss, sp, so in ctx.graph.triples((_s, _p, _o)):
+        if None in (_s, _p, _o):
+            c = ctx.push()
+        else:
+            c = ctx
+        if _s is None:
+            c[s] = ss
+        try:
+            if _p is None:
+                c[p] = sp
+        except AlreadyBound:
+            continue
+        try:
+            if _o is None:
+                c[o] = so
+        except AlreadyBound:
+            continue
+        yield c
+
+def _dump(part, indent, dest):
+    '''Pretty printer for a SPARQL query parsed by rdflib.
+       The query will be written on multiple lines.
+       @param part: Part of a parsed SPARQL query
+       @param indent: A string that is prepended to every lines printed for this part of the query
+       @param dest: A file-like object to which the output is written
+    '''
+    if part is None:
+        return None
+    if part.name == 'BGP':
+        dest.write('{}{} {:04d} triples={}\n'.format(indent, part.name, id(part) % 10000, part.triples))
+        return
+    if part.name == 'Extend':
+        dest.write('{}{} {:04d} {}={}\n'.format(indent, part.name, id(part) % 10000, part.var, part.expr))
+    else:
+        dest.write('{}{} {:04d}\n'.format(indent, part.name, id(part) % 10000))
+    for attr in ['p', 'p1', 'p2']:
+        if hasattr(part, attr):
+            child  = getattr(part, attr)
+            if child is not None:
+                _dump(child, '{}  '.format(indent), dest)
+    return
+
+'''Register the above SPARQL query evaluator in rdflib'''
+CUSTOM_EVALS['ndbstore'] = _evalPartWithLoggingAndLazyJoins
+logging.info('Activated specialized query evaluation in rdflib')
@@ -13,16 +13,18 @@ import hashlib
 import logging
 from time import time
 from rdflib import Graph
-from collections import defaultdict
+from rdflib.graph import DATASET_DEFAULT_GRAPH_ID
+from rdflib.util import from_n3
+from collections import defaultdict, OrderedDict, deque
 from google.appengine.api import memcache
 from rdflib.plugins.memory import IOMemory
-from weakref import WeakValueDictionary
+from rdflib_appengine import shardformat
+from rdflib_appengine.tracing import Span, NULL_SPAN
 from StringIO import StringIO
-from random import randrange
-from rdflib.plugins.sparql.evaluate import evalLazyJoin
-from rdflib.plugins.sparql import CUSTOM_EVALS
-from itertools import product
-from random import choice
+from rdflib.term import Node, Variable, BNode, URIRef, Literal
+from itertools import product, islice
+from random import choice, randrange
+import zlib
 
 ANY = None #Convention used by rdflib
 
@@ -34,57 +36,327 @@ def sha1(node):
     m.update(node.encode('utf-8'))
     return m.hexdigest()
 
+class ShardCache(object):
+    '''A least-recently-used cache of rdflib.Graph() objects for GraphShards.
+       The cache is bounded by the total number of triples in the cached Graphs and, optionally,
+       by the total number of bytes that the cached GraphShards occupy in the datastore.
+       Each Graph is cached with a stamp identifying the version of the GraphShard it was loaded from,
+       so a Graph outdated by a write on another instance is not returned.
+       The cache also counts how often GraphShards were found in each layer of cache, see GraphShard.rdflib_graph().
+    '''
+    def __init__(self, max_triples = 100000, max_bytes = None):
+        '''@param max_triples: The maximal total number of triples in the cached Graphs
+           @param max_bytes: The maximal total number of bytes of the cached GraphShards, or None for no limit
+        '''
+        self._entries = OrderedDict() #Maps a key to a tuple (graph, no_of_triples, no_of_bytes, stamp), least recently used first
+        self._triples = 0
+        self._bytes = 0
+        self.configure(max_triples, max_bytes)
+        self.reset_stats()
+        
+    def configure(self, max_triples = 100000, max_bytes = None):
+        '''Changes the limits of this cache, evicting Graphs if needed.
+           @param max_triples: The maximal total number of triples in the cached Graphs
+           @param max_bytes: The maximal total number of bytes of the cached GraphShards, or None for no limit
+        '''
+        assert isinstance(max_triples, int) and max_triples >= 0, 'max_triples must be a non-negative integer, not {}'.format(max_triples)
+        assert max_bytes is None or (isinstance(max_bytes, int) and max_bytes >= 0), 'max_bytes must be None or a non-negative integer, not {}'.format(max_bytes)
+        self._max_triples = max_triples
+        self._max_bytes = max_bytes
+        self._evict()
+        
+    def get(self, key, stamp = None):
+        '''@param key: The key of a cached Graph
+           @param stamp: The stamp of the current version of the GraphShard
+           @return The cached Graph, or None if it is not in the cache or was cached with another stamp
+        '''
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[3] != stamp:
+            self._triples -= entry[1]
+            self._bytes -= entry[2]
+            self._counters['outdated'] += 1
+            return None
+        self._entries[key] = entry
+        return entry[0]
+    
+    def put(self, key, graph, no_of_bytes, stamp = None):
+        '''Adds a Graph to this cache, evicting least recently used Graphs if needed.
+           Graphs that exceed the limits of this cache on their own are not cached.
+           @param key: The key of the Graph
+           @param graph: An rdflib.Graph
+           @param no_of_bytes: The size of the GraphShard that graph was loaded from
+           @param stamp: The stamp of the version of the GraphShard that graph was loaded from
+        '''
+        self.discard(key)
+        entry = (graph, len(graph), no_of_bytes, stamp)
+        if entry[1] > self._max_triples or (self._max_bytes is not None and no_of_bytes > self._max_bytes):
+            return
+        self._entries[key] = entry
+        self._triples += entry[1]
+        self._bytes += entry[2]
+        self._evict()
+        
+    def keys(self):
+        '''@return The keys of the cached Graphs, most recently used first
+        '''
+        return list(reversed(self._entries.keys()))
+
+    def discard(self, key):
+        '''Removes a Graph from this cache, if present.
+           @param key: The key of the Graph
+        '''
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._triples -= entry[1]
+            self._bytes -= entry[2]
+            
+    def clear(self):
+        '''Removes all Graphs from this cache.
+        '''
+        self._entries.clear()
+        self._triples = 0
+        self._bytes = 0
+        
+    def record(self, counter):
+        '''Increments one of the counters in stats().
+           @param counter: The name of the counter, e.g. 'local_hits'
+        '''
+        self._counters[counter] += 1
+        
+    def reset_stats(self):
+        '''Sets all counters in stats() to 0.
+        '''
+        self._counters = dict((counter, 0) for counter in ['local_hits', 'memcache_hits', 'datastore_loads', 'evictions', 'outdated'])
+
+    def stats(self):
+        '''@return A dict with the counters
+                     * local_hits: Number of Graphs found in this cache
+                     * memcache_hits: Number of Graphs found in Memcache
+                     * datastore_loads: Number of Graphs loaded from the datastore
+                     * evictions: Number of Graphs evicted from this cache to respect its limits
+                     * outdated: Number of Graphs found in this cache, but dropped as the GraphShard had been written since
+                   and the current size of this cache: entries, triples and bytes.
+        '''
+        stats = dict(self._counters)
+        stats.update(entries = len(self._entries), triples = self._triples, bytes = self._bytes)
+        return stats
+        
+    def _evict(self):
+        while len(self._entries) > 0 and (self._triples > self._max_triples or (self._max_bytes is not None and self._bytes > self._max_bytes)):
+            (_, (_, no_of_triples, no_of_bytes, _)) = self._entries.popitem(last = False)
+            self._triples -= no_of_triples
+            self._bytes -= no_of_bytes
+            self._counters['evictions'] += 1
+
 class GraphShard(ndb.Model):
     '''Stores a subset of all triples in a Graph
        A single GraphShard will typically contain triples for one specific predicate
        or a selection of subjects.
        A GraphShard can be retrieved quickly and cheaply by its key.
-       The triples are stored in the N3 format, gzip compressed by NDB.
+       The triples are stored in the binary format from rdflib_appengine.shardformat, gzip compressed by NDB.
+       GraphShards written by earlier versions store their triples in the N3 format instead.
+       These are read transparently and converted to the binary format when next compacted,
+       or by NDBStore.upgrade_shards().
+       A GraphShard that grows too large is split: Its triples are moved to up to 16 child GraphShards,
+       and the GraphShard itself is kept, empty, with is_split set to mark that its children must be read instead.
+       Small changes are not written to the GraphShard itself, but appended as GraphShardDeltas.
+       The triples in a GraphShard are those in graph_bin (or graph_n3) with the delta_count GraphShardDeltas applied in order.
+       triple_count is the number of triples in graph_bin, so it is exact whenever delta_count is 0.
+       Likewise, subject_count and object_count are the numbers of distinct subjects and objects in graph_bin.
+       updated changes on every write, so it identifies the version of the GraphShard in caches, see stamp().
     '''
-    graph_n3 = ndb.TextProperty(compressed = True)
+    graph_bin = ndb.BlobProperty(compressed = True)
+    graph_n3 = ndb.TextProperty(compressed = True) #Legacy format, only read
     graph_ID = ndb.StringProperty()
+    is_split = ndb.BooleanProperty(default = False, indexed = False)
+    delta_count = ndb.IntegerProperty(default = 0)
+    triple_count = ndb.IntegerProperty()
+    subject_count = ndb.IntegerProperty(indexed = False)
+    object_count = ndb.IntegerProperty(indexed = False)
+    updated = ndb.DateTimeProperty(auto_now = True, indexed = False)
 
-    '''A cache for previously retrieved GraphShard that haven't yet been garbage collected.
+    '''A cache for previously retrieved GraphShards, shared by all requests served by this instance.
        This is important because all joins will be performed lazily, which means the query evaluator
-       will ask for the same triples over and over again within milliseconds.'''
-    _graph_cache = WeakValueDictionary()
-    _not_found = set() #Placeholder used in _graph_cache because None or object() cannot be weakref'ed
+       will ask for the same triples over and over again within milliseconds.
+       Other instances do not invalidate it when they write a GraphShard, so a cached Graph is only used 
+       if the GraphShard just fetched from the datastore has the stamp() it was cached with.
+       Use configure_cache() to change its limits and cache_stats() to inspect it.'''
+    _graph_cache = ShardCache()
 
     '''Retrieve an rdflib.Graph() containing the triples in this GraphShard.
        This method searches three layers of store in order:
-         * a local WeakValueDictionary containing rdflib.Graph() objects (very, very fast)
-         * The Memcache provided by NDB containing pickled rdflib.Graph() objects (needs unpickling, takes 0-300ms in my experience)
-         * NDB itself containing compressed N3 data (needs decompression and parsing, takes 0-1500ms in my experience)
+         * a local ShardCache containing rdflib.Graph() objects (very, very fast)
+         * Memcache containing the triples in the binary format, compressed and split into chunks if large (needs decompression and decoding)
+           under a key including stamp(), so it is never read for a later version of the GraphShard
+         * NDB itself containing compressed binary data and GraphShardDeltas (needs decompression, decoding, and applying the GraphShardDeltas)
        The method stores the returned object in the two first layers before returning.
+       Use rdflib_graphs() to retrieve many at once.
+       @param span: A Span from rdflib_appengine.tracing, to which a child Span is added describing how the GraphShard was retrieved
        @return The rdflib.Graph() containing the triples in this GraphShard.
     '''    
-    def rdflib_graph(self):
-        g = GraphShard._graph_cache.get(self._parsed_memcache_key(), GraphShard._not_found)
-        if g is not GraphShard._not_found:
-            return g
-        g = memcache.get(self._parsed_memcache_key())
-        if g is not None:
-            GraphShard._graph_cache[self._parsed_memcache_key()] = g
-            return g
-        g = Graph(store = IOMemory())
-        g.parse(data = self.graph_n3, format='n3')
-        GraphShard._graph_cache[self._parsed_memcache_key()] = g
-        memcache.add(self._parsed_memcache_key(), g, 86400)
-        return g
+    def rdflib_graph(self, span = NULL_SPAN):
+        return GraphShard.rdflib_graphs([self], span)[0]
+    
+    @staticmethod
+    def rdflib_graphs(instances, span = NULL_SPAN):
+        '''Like rdflib_graph(), but for many GraphShards at once.
+           Searching each layer of store takes one batched round trip for all the GraphShards not found in the previous layer.
+           @param instances: A list of GraphShards
+           @param span: A Span from rdflib_appengine.tracing, to which a child Span is added for each GraphShard
+           @return A list containing the rdflib.Graph() for each of the given GraphShards, in the same order
+        '''
+        graphs = dict()
+        for instance in instances:
+            g = GraphShard._graph_cache.get(instance._cache_key(), instance.stamp())
+            if g is not None:
+                GraphShard._graph_cache.record('local_hits')
+                span.child('shard', key = instance.key.id(), layer = 'local', triples = len(g)).finish()
+                graphs[instance.key] = g
+        missing = [instance for instance in instances if instance.key not in graphs]
+        if len(missing) > 0:
+            found = _get_multi_chunked([instance._parsed_memcache_key() for instance in missing])
+            for instance in missing:
+                data = found.get(instance._parsed_memcache_key())
+                if data is not None:
+                    GraphShard._graph_cache.record('memcache_hits')
+                    shard_span = span.child('shard', key = instance.key.id(), layer = 'memcache', bytes = len(data))
+                    g = shardformat.decode(data, Graph(store = IOMemory()))
+                    shard_span.set(triples = len(g))
+                    shard_span.finish()
+                    GraphShard._graph_cache.put(instance._cache_key(), g, instance._stored_size(), instance.stamp())
+                    graphs[instance.key] = g
+            missing = [instance for instance in missing if instance.key not in graphs]
+        if len(missing) > 0:
+            ndb.get_multi([key for instance in missing for key in instance.delta_keys()]) #Fills NDB's context cache for load_into()
+            loaded = dict()
+            for instance in missing:
+                GraphShard._graph_cache.record('datastore_loads')
+                shard_span = span.child('shard', key = instance.key.id(), layer = 'datastore', bytes = instance._stored_size(), deltas = instance.delta_count)
+                g = instance.load_into(Graph(store = IOMemory()))
+                shard_span.set(triples = len(g))
+                shard_span.finish()
+                GraphShard._graph_cache.put(instance._cache_key(), g, instance._stored_size(), instance.stamp())
+                loaded[instance._parsed_memcache_key()] = instance.graph_bin if instance.delta_count == 0 and instance.graph_bin is not None else shardformat.encode(g)
+                graphs[instance.key] = g
+            _set_multi_chunked(loaded, 86400)
+        return [graphs[instance.key] for instance in instances]
+    
+    @staticmethod
+    def configure_cache(max_triples = 100000, max_bytes = None):
+        '''Changes the limits of the local cache used by rdflib_graph(). See ShardCache.configure().
+        '''
+        GraphShard._graph_cache.configure(max_triples, max_bytes)
+        
+    @staticmethod
+    def cache_stats():
+        '''@return The counters and size of the local cache used by rdflib_graph(). See ShardCache.stats().
+        '''
+        return GraphShard._graph_cache.stats()
     
+    def _stored_size(self):
+        '''@return The number of bytes used by the triples in this GraphShard (excluding GraphShardDeltas), before compression
+        '''
+        return len(self.graph_bin or self.graph_n3 or '')
+    
+    def load_into(self, graph):
+        '''Adds the triples stored in this GraphShard, including its GraphShardDeltas, to the given graph, bypassing all caches.
+           @param graph: An rdflib.Graph
+           @return The given graph
+        '''
+        if self.graph_bin is not None:
+            shardformat.decode(self.graph_bin, graph)
+        elif self.graph_n3 is not None:
+            graph.parse(data = self.graph_n3, format='n3')
+        if self.delta_count > 0:
+            for delta in ndb.get_multi(self.delta_keys()):
+                if delta is not None:
+                    delta.apply_to(graph)
+        return graph
+    
+    def delta_keys(self):
+        '''@return The keys of this GraphShard's GraphShardDeltas, in the order they must be applied
+        '''
+        return [ndb.Key(GraphShardDelta, index, parent = self.key) for index in range(1, self.delta_count + 1)]
+    
+    def append_delta(self, added, removed, max_triples, max_bytes):
+        '''Records changes to this GraphShard in a new GraphShardDelta instead of rewriting the triples stored in this GraphShard,
+           unless the changes exceed the given limits. Such changes must be folded into the GraphShard instead, so it can be split.
+           Note that neither this GraphShard nor the new GraphShardDelta is stored by this method.
+           @param added: A collection of triples to add
+           @param removed: A collection of triples to remove. Triples in both added and removed will be added.
+           @param max_triples: The maximal number of triples in the GraphShardDelta
+           @param max_bytes: The maximal number of bytes of the GraphShardDelta, before compression
+           @return The new GraphShardDelta, or None if the changes exceed the limits
+        '''
+        if len(added) + len(removed) > max_triples:
+            return None
+        added_bin = shardformat.encode(added)
+        removed_bin = shardformat.encode(removed)
+        if len(added_bin) + len(removed_bin) > max_bytes:
+            return None
+        self.delta_count += 1
+        return GraphShardDelta(key = ndb.Key(GraphShardDelta, self.delta_count, parent = self.key),
+                               graph_ID = self.graph_ID,
+                               added_bin = added_bin,
+                               removed_bin = removed_bin)
+    
+    def clear_deltas(self):
+        '''Forgets all GraphShardDeltas of this GraphShard. Call this when the triples stored in this GraphShard
+           have been replaced with the result of load_into().
+           Note that neither this GraphShard is stored nor the GraphShardDeltas deleted by this method.
+           @return The keys of the forgotten GraphShardDeltas, which should be deleted
+        '''
+        keys = self.delta_keys()
+        self.delta_count = 0
+        return keys
+    
+    def set_triples(self, triples):
+        '''Replaces the triples stored in this GraphShard. The triples are stored in the binary format.
+           @param triples: A collection of distinct (s, p, o) triples, e.g. an rdflib.Graph or a set
+        '''
+        self.graph_bin = shardformat.encode(triples)
+        self.graph_n3 = None
+        self.triple_count = len(triples)
+        self.subject_count = len(set(t[0] for t in triples))
+        self.object_count = len(set(t[2] for t in triples))
+
+    def is_legacy(self):
+        '''@return True if this GraphShard stores its triples in the N3 format
+        '''
+        return self.graph_bin is None and self.graph_n3 is not None
+
+    def stamp(self):
+        '''@return A str identifying the version of this GraphShard, which changes whenever it is written.
+                   It is empty for GraphShards not written since updated was introduced.
+        '''
+        return '' if self.updated is None else self.updated.strftime('%Y%m%d%H%M%S%f')
+
+    def _cache_key(self):
+        '''@return The key used for caching self.rdflib_graph() in the internal _graph_cache
+        '''
+        return 'GraphShard({})'.format(self.key.id())
+
     def _parsed_memcache_key(self):
-        '''@return The key used for caching self.rdflib_graph() in Memcache and
-           the internal _graph_cache
+        '''@return The key used for caching self.rdflib_graph() in Memcache, which includes the stamp() of this GraphShard
         '''
-        return 'IOMemory({})'.format(self.key.id())
+        return 'GraphShard({})@{}'.format(self.key.id(), self.stamp())
+    
+    @staticmethod
+    def cached_keys():
+        '''@return The keys of the GraphShards in the local cache used by rdflib_graph(), most recently used first
+        '''
+        return [ndb.Key(GraphShard, key[len('GraphShard('):-1]) for key in GraphShard._graph_cache.keys()]
     
     @staticmethod
     def invalidate(instances):
-        '''Removes all cached copies of the given GraphShard instances.
+        '''Removes the cached copies of the given GraphShard instances from this instance and from Memcache.
+           Other instances notice the change by the stamp() of the GraphShards instead.
            @param instances: A collection of GraphShard instances
         '''
         for instance in instances:
-            GraphShard._graph_cache[instance._parsed_memcache_key()] = GraphShard._not_found
+            GraphShard._graph_cache.discard(instance._cache_key())
         memcache.delete_multi([instance._parsed_memcache_key() for instance in instances])
         
     def spo(self):
@@ -93,6 +365,182 @@ class GraphShard(ndb.Model):
         '''
         return self.key.id().split('-')[0]
     
+    def routing_index(self):
+        '''@return The position in a triple of the term which decides the child GraphShard of this GraphShard 
+                   that the triple belongs to: 0 (subject) for subject and predicate GraphShards, 2 (object) for object GraphShards.
+        '''
+        return 2 if self.spo() == 'o' else 0
+
+    def split_depth(self):
+        '''@return The number of splits between this GraphShard and the GraphShard with a key from NDBStore.keys_for()
+        '''
+        sub_shard = self._key_prefix().rsplit('-', 1)[1]
+        return len(sub_shard.split('.')[1]) if '.' in sub_shard else 0
+
+    def child_key(self, routing_term):
+        '''@param routing_term: The subject or object (see routing_index()) of a triple
+           @return The key of the child GraphShard storing triples with the given routing_term after this GraphShard has been split.
+                   Example: 'p-prov#endedAtTime_6f11f819383b6a6bb619fbea25b5696372ba0b62-.0-newdata' 
+        '''
+        return self._child_key(sha1(routing_term)[self.split_depth()])
+
+    def child_keys(self):
+        '''@return The keys of all 16 possible child GraphShards of this GraphShard
+        '''
+        return [self._child_key(digit) for digit in _HEX_DIGITS]
+
+    def _child_key(self, digit):
+        separator = '.' if self.split_depth() == 0 else ''
+        return ndb.Key(GraphShard, '{}{}{}-{}'.format(self._key_prefix(), separator, digit, self.graph_ID))
+
+    def _key_prefix(self):
+        '''@return The id of this GraphShard's key without the graph_ID suffix
+        '''
+        return self.key.id()[:-len(self.graph_ID) - 1]
+
+
+class GraphShardDelta(ndb.Model):
+    '''Stores a batch of changes to a GraphShard, which have not yet been folded into the GraphShard itself.
+       This makes the cost of a write proportional to the number of triples written, not to the size of the GraphShard.
+       The parent of a GraphShardDelta's key is the key of the GraphShard it belongs to,
+       and the key's id is its number in the sequence of GraphShardDeltas for that GraphShard, starting from 1.
+    '''
+    added_bin = ndb.BlobProperty(compressed = True)
+    removed_bin = ndb.BlobProperty(compressed = True)
+    graph_ID = ndb.StringProperty()
+    
+    def apply_to(self, graph):
+        '''Removes the removed triples from the given graph, then adds the added triples.
+           @param graph: An rdflib.Graph
+        '''
+        for t in shardformat.decode(self.removed_bin, Graph()):
+            graph.remove(t)
+        shardformat.decode(self.added_bin, graph)
+
+class PredicateStats(ndb.Model):
+    '''Cardinality statistics for the triples with one predicate in a graph, used to order triple patterns in SPARQL queries.
+       The key's id is the predicate part of the keys of the predicate's GraphShards followed by the graph_ID,
+       see NDBStore.keys_for(). 
+       For each (unsplit) GraphShard of the predicate, shards maps its key's id to a list [triples, distinct subjects, distinct objects, bytes]
+       describing the triples stored in the GraphShard itself. NDBStore updates an entry whenever it writes the triples of the GraphShard,
+       i.e. when the GraphShard is created, split or compacted, but not when it appends a GraphShardDelta, as counting the triples 
+       that a GraphShardDelta actually adds or removes would require reading the GraphShard. So the statistics lag behind by at most
+       max_deltas_per_shard writes per GraphShard. Entries written by earlier versions have a fifth element, which is ignored.
+    '''
+    graph_ID = ndb.StringProperty()
+    predicate = ndb.TextProperty()
+    shards = ndb.JsonProperty(compressed = True)
+    
+    def triple_count(self):
+        '''@return The number of triples with the predicate stored in its GraphShards, not counting GraphShardDeltas
+        '''
+        return sum([entry[0] for entry in self.shards.itervalues()])
+    
+    def subject_count(self):
+        '''@return An upper bound of the number of distinct subjects of the predicate, exact if it has a single GraphShard.
+                   A subject found in several GraphShards is counted once for each.
+        '''
+        return sum([entry[1] for entry in self.shards.itervalues()])
+    
+    def object_count(self):
+        '''@return An upper bound of the number of distinct objects of the predicate, exact if it has a single GraphShard.
+                   A object found in several GraphShards is counted once for each.
+        '''
+        return sum([entry[2] for entry in self.shards.itervalues()])
+    
+    def estimate(self, subject_bound, object_bound):
+        '''Estimates the number of triples with the predicate matching a triple pattern.
+           @param subject_bound: True if the pattern's subject is bound
+           @param object_bound: True if the pattern's object is bound
+           @return The estimated number of matching triples, a float
+        '''
+        triples = float(self.triple_count())
+        if subject_bound and object_bound:
+            return min(1.0, triples)
+        if subject_bound:
+            return triples / max(1, self.subject_count())
+        if object_bound:
+            return triples / max(1, self.object_count())
+        return triples
+    
+    def as_dict(self):
+        '''@return A dict summarizing these statistics, e.g. for logging or display
+        '''
+        return {'predicate' : None if self.predicate is None else URIRef(self.predicate),
+                'triples' : self.triple_count(),
+                'subjects' : self.subject_count(),
+                'objects' : self.object_count(),
+                'shards' : len(self.shards),
+                'bytes' : sum([entry[3] for entry in self.shards.itervalues()]),
+                }
+
+class GraphPointer(ndb.Model):
+    '''Names the graph_ID holding the triples of a versioned NDBStore, see NDBStore.replace().
+       The key's id is the identifier of the NDBStore. Version 0 is stored under the identifier itself as graph_ID,
+       so a graph written before it was versioned needs no GraphPointer.
+    '''
+    graph_ID = ndb.StringProperty(indexed = False)
+    version = ndb.IntegerProperty(default = 0, indexed = False) #The version readers use
+    latest = ndb.IntegerProperty(default = 0, indexed = False) #The latest version reserved by replace(), which may still be loading
+
+class GraphContext(ndb.Model):
+    '''Records a context (named graph) of a context aware NDBStore, see NDBStore.contexts().
+       The key's id is the graph_ID of the context's triples, see NDBStore._context_store().
+    '''
+    graph_ID = ndb.StringProperty() #The graph_ID of the NDBStore
+    identifier = ndb.TextProperty() #The identifier of the context in the N3 format
+
+class LargeTerm(ndb.Model):
+    '''Stores the lexical form of a large URIRef or Literal once, see large_term_size in NDBStore.
+       GraphShards contain a placeholder instead, see _placeholder(), so they stay small and quick to decode.
+       The key's id is the sha1() of the lexical form, so equal terms share one LargeTerm, also across graphs.
+       LargeTerms are therefore never deleted.
+    '''
+    value = ndb.TextProperty(compressed = True)
+
+    '''Lexical forms of LargeTerms recently read or written by this instance, least recently used first.
+       Bounded by _MAX_CACHED_LARGE_TERM_CHARS.'''
+    _cache = OrderedDict()
+    _cached_chars = 0
+
+    @staticmethod
+    def get_values(digests):
+        '''@param digests: An iterable of ids of LargeTerms
+           @return A dict mapping each digest to the lexical form of its LargeTerm. 
+                   The LargeTerms not in the local cache are fetched in one batch. Missing LargeTerms are left out.
+        '''
+        values = dict()
+        for digest in set(digests):
+            value = LargeTerm._cache.pop(digest, None)
+            if value is not None:
+                LargeTerm._cache[digest] = value
+                values[digest] = value
+        missing = [digest for digest in set(digests) if digest not in values]
+        for (digest, model) in zip(missing, ndb.get_multi([ndb.Key(LargeTerm, digest) for digest in missing])):
+            if model is None:
+                logging.error('LargeTerm {} is missing'.format(digest))
+                continue
+            values[digest] = model.value
+            LargeTerm._remember(digest, model.value)
+        return values
+
+    @staticmethod
+    def put_values(values):
+        '''Stores LargeTerms, unless the local cache shows they are stored already.
+           @param values: A dict mapping digests to lexical forms
+        '''
+        new = [(digest, value) for (digest, value) in values.iteritems() if digest not in LargeTerm._cache]
+        ndb.put_multi([LargeTerm(id = digest, value = value) for (digest, value) in new])
+        for (digest, value) in new:
+            LargeTerm._remember(digest, value)
+
+    @staticmethod
+    def _remember(digest, value):
+        LargeTerm._cache[digest] = value
+        LargeTerm._cached_chars += len(value)
+        while LargeTerm._cached_chars > _MAX_CACHED_LARGE_TERM_CHARS:
+            (_, evicted) = LargeTerm._cache.popitem(last = False)
+            LargeTerm._cached_chars -= len(evicted)
 
 '''Map from the number of shards for something to the number of hex digits needed to get this.
 E.g. to get 16 shards for subjects, we need to use one hex digit.'''
@@ -106,6 +554,27 @@ _HEX_DIGITS = [str(i) for i in range(10)] + [chr(i) for i in range(ord('a'), ord
 
 _VALID_NO_SHARDS = _NO_OF_SHARDS_TO_NO_OF_HEX_DIGITS.keys()
 
+'''Allowed values for no_of_object_shards. 0 means that no object shards are maintained.'''
+_VALID_NO_OBJECT_SHARDS = [0] + _VALID_NO_SHARDS
+
+'''The maximal number of times a GraphShard is split. Each split creates up to 16 child GraphShards.'''
+_MAX_SPLIT_DEPTH = 3
+
+'''The query prepared by NDBStore.warm_up() when no queries are given'''
+_WARM_UP_QUERY = 'ASK { ?s ?p ?o }'
+
+'''The total length of the lexical forms of the LargeTerms cached by an instance'''
+_MAX_CACHED_LARGE_TERM_CHARS = 10000000
+
+'''Starts the lexical form of a placeholder for a LargeTerm. The character is from the Unicode private use area.'''
+_PLACEHOLDER_PREFIX = u'\uf8ff'
+
+'''The number of triples triples() resolves placeholders for in one batch'''
+_RESOLVE_BATCH_SIZE = 100
+
+'''The number of seconds NDBStore.__len__() caches a total in Memcache'''
+_LEN_CACHE_SECONDS = 60
+
 _CONF_ERR_MSG = "NDBStore configuration must set {} to be in {}, not {}"
 
 class NDBStore(Store):
@@ -117,22 +586,88 @@ class NDBStore(Store):
       * The GraphShard containing every triple with a subject that hashes to the same as http://s
     The hash used for a subject is the last digit of the subject's hex SHA1. 
     
-    An NDBStore contains an internal log to which it writes information about SPARQL query execution
-    and calls to triples(). This information can be logged by calling flush_log().
-    If you do not wish to use memory for this log, set configuration to {'log': False} in the constructor.
+    Predicates configured to have more than one GraphShard (see no_of_shards_per_predicate_default and 
+    no_of_shards_per_predicate_dict) have their triples spread across that many sub-shards. 
+    By default the sub-shard for a triple is chosen at random, so reading any triples for the predicate 
+    means reading all its sub-shards. If predicate_sub_shards_by_subject is set, the sub-shard is chosen
+    by the last hex digits of the subject's SHA1 instead, so triple patterns with both subject and predicate bound
+    read a single sub-shard. Graphs written with random sub-shards must be migrated with rehash_predicate_shards().
+    
+    If no_of_object_shards is configured (it is 0 by default), every triple is also stored in
+      * The GraphShard containing every triple with an object that hashes to the same as Literal(42)
+    This makes triples() patterns with only the object bound, or only predicate and object bound, 
+    read a single GraphShard instead of traversing the whole graph. These patterns are answered from the object GraphShards alone,
+    so a graph that had triples before no_of_object_shards was enabled or changed must be migrated with rebuild_object_shards().
+
+    An NDBStore can trace SPARQL query execution and calls to triples(), see rdflib_appengine.tracing.
+    Set configuration to {'tracer': f} in the constructor to have the function f called with the tree of Spans for each query.
+    Set configuration to {'log': True} to write the trees, and the parsed form of each query, to an internal log instead.
+    This log can be logged by calling flush_log(). Tracing is disabled by default.
+    
+    A GraphShard is split automatically into child GraphShards when it contains more than
+    max_triples_per_shard triples or more than max_bytes_per_shard bytes (before compression).
+    This makes the settings no_of_shards_per_predicate_default and no_of_shards_per_predicate_dict
+    unnecessary in most cases.
+    
+    Writes append the added and removed triples to each GraphShard as a GraphShardDelta instead of
+    rewriting the GraphShard, unless they exceed max_triples_per_shard or max_bytes_per_shard. When a GraphShard has max_deltas_per_shard GraphShardDeltas, the next 
+    write compacts it, i.e. folds the GraphShardDeltas into the GraphShard. Set max_deltas_per_shard to 0
+    to always rewrite GraphShards. Use compact() to fold all GraphShardDeltas in the graph, 
+    e.g. from a cron job or a task queue. Like all writes to an NDBStore, this is not transactional.
+    
+    Unless statistics is set to False, writes also update a PredicateStats entity for each affected predicate,
+    counting its triples, distinct subjects and objects, and bytes per GraphShard, as stored when the GraphShard was last compacted. The SPARQL query evaluator uses these
+    to evaluate the most selective triple patterns first. Use statistics() to inspect them and explain() to see
+    the order chosen for a basic graph pattern. Graphs written before statistics were kept need rebuild_statistics().
+    
+    rdflib's SPARQL UPDATE and many parsers call add() or addN() for a few triples at a time. Set write_buffer_size to a positive number
+    to buffer the triples passed to add(), addN(), remove() and removeN() in memory instead of writing them at once. The buffered triples are 
+    written in one batch, like by addN() and removeN(), by commit(), when the NDBStore is used as a context manager and the 
+    with block ends, or when write_buffer_size triples are buffered. rollback() discards the buffered triples. triples() includes 
+    the buffered changes, but __len__() does not. A buffer is per NDBStore instance and is lost if it is not committed.
+    
+    To reload a graph without readers seeing it empty or partially loaded, set versioned to True and call replace().
+    The new triples are loaded under a new graph_ID, and a GraphPointer is switched to it when they have all been written.
+    An NDBStore reads the GraphPointer when it is created, so create one per request. 
+    
+    Set context_aware to True to store named graphs, e.g. for a ConjunctiveGraph or a Dataset. The triples of each context 
+    are then stored in GraphShards of their own, whose graph_ID is that of the NDBStore followed by '@' and the SHA1 of 
+    the context's identifier. So triples() for one context reads only that context's GraphShards, and contexts() reads 
+    a small GraphContext entity per context rather than the triples. triples() for all contexts yields each triple once, 
+    but __len__() for all contexts counts a triple once per context containing it.
+    
+    Set large_term_size to a positive number to store the subjects and objects longer than that many characters out of line. 
+    Each such term is stored once as a LargeTerm keyed by its sha1(), and the GraphShards hold a short placeholder instead,
+    so large literals do not bloat the GraphShards or slow down decoding them. triples() replaces the placeholders 
+    by the terms as it yields the triples, fetching the LargeTerms needed by a batch of triples at once. 
+    Set large_term_size before the first write, as triples written with another setting are not found by remove().
     
     This implementation heavily favours
-      * batch updates, i.e. using addN() with many triples
-      * triple() queries where either subject or predicate is bound
-      * not asking for the length of the NDBStore
+      * batch updates, i.e. using addN() or removeN() with many triples
+      * triple() queries where either subject or predicate is bound (or object, if object shards are configured)
+      * not asking for the length of the NDBStore right after writes (it is cheap, but cached only until the next write,
+        and the eventually consistent queries it uses may not include the latest writes)
+    
+    triples() fetches the GraphShards it needs lazily, with at most shard_fetch_window (16 by default) gets in flight,
+    so a consumer that stops early (e.g. a query with a LIMIT) does not fetch every sub-shard of a predicate.
       
-    This module registers a custom SPARQL query evaluator that
+    NDBStore comes with a custom SPARQL query evaluator, see rdflib_appengine.evaluator. It is imported by query() and update()
+    when rdflib is about to evaluate the first query, so instances that do not evaluate SPARQL never import rdflib's SPARQL machinery. 
+    The evaluator
       * Writes the parsed form of every SELECT query to the internal log
       * Performs all joins as lazy joins, which is much faster for NDBStore in my experience.
+      * Evaluates basic graph patterns for batches of bindings at a time, using prefetch() to fetch
+        the GraphShards needed by a whole batch in a few round trips rather than one per binding.
+      * Orders the triple patterns of basic graph patterns by their estimated number of matches, see explain().
+      * Stops evaluating a query when its LIMIT is reached.
+      * Writes the changes of each SPARQL update operation in one batch, see update().
+      
+    A new instance starts with empty caches and an uninitialized SPARQL parser. Call warm_up() from a warm-up request
+    to load the GraphShards that recent instances used most (see remember_hot_shards()) and prepare the common queries.
     """
     
     def __init__(self, configuration={}, identifier=None):
-        '''@param configuration: A dict mapping 'log' to True or False
+        '''@param configuration: A dict mapping configuration settings to values, e.g. 'log' to True or False
            @param identifier: A nonempty string or unicode. It's length must be <64
            to keep internal keys reasonably small.
         '''
@@ -141,26 +676,77 @@ class NDBStore(Store):
         assert isinstance(identifier, basestring), "NDBStore requires a basestring identifier"
         assert len(identifier) > 0, "NDBStore requires a non-empty identifier"
         assert len(identifier) < 64, "NDBStore requires a brief identifier"
-        self._ID = identifier
+        self._identifier = identifier
+        self._ID = identifier #The graph_ID in the keys of this graph's entities, see versioned
+        self._configuration = configuration
         self._log = StringIO()
         self._log_begin = time()
+        self._statistics = dict() #Maps a predicate to its PredicateStats (or None), and ANY to a list of all PredicateStats, as read since the last write
+        self._query_span = NULL_SPAN #The root Span of the query being evaluated, if traced
+        self._buffered_adds = set() #Triples added by add() and not yet committed, if writes are buffered
+        self._buffered_removes = set() #Triples removed by remove() and not yet committed, if writes are buffered
+        self._context_stores = dict() #Maps the identifier of a context to the NDBStore for its triples, if context aware
+        self._context_identifiers = None #The identifiers of the contexts, once read, if context aware
         self._setup(**configuration)
+        if self._versioned:
+            pointer = GraphPointer.get_by_id(identifier)
+            if pointer is not None:
+                self._ID = pointer.graph_ID
         
     def _setup(self, 
                log = False, 
                no_of_subject_shards = 16, 
+               no_of_object_shards = 0,
                no_of_shards_per_predicate_default = 1,
-               no_of_shards_per_predicate_dict = {}):
+               no_of_shards_per_predicate_dict = {},
+               predicate_sub_shards_by_subject = False,
+               max_triples_per_shard = 20000,
+               max_bytes_per_shard = 500000,
+               max_deltas_per_shard = 10,
+               statistics = True,
+               tracer = None,
+               shard_fetch_window = 16,
+               write_buffer_size = 0,
+               versioned = False,
+               context_aware = False,
+               large_term_size = 0):
         assert isinstance(log, bool), _CONF_ERR_MSG.format('log', [True, False], log)
         self._is_logging = log
         assert no_of_subject_shards in _VALID_NO_SHARDS, _CONF_ERR_MSG.format('no_of_subject_shards', _VALID_NO_SHARDS, no_of_subject_shards)
         self._no_of_subject_shard_digits = _NO_OF_SHARDS_TO_NO_OF_HEX_DIGITS[no_of_subject_shards]
+        assert no_of_object_shards in _VALID_NO_OBJECT_SHARDS, _CONF_ERR_MSG.format('no_of_object_shards', _VALID_NO_OBJECT_SHARDS, no_of_object_shards)
+        self._has_object_shards = no_of_object_shards > 0
+        self._no_of_object_shard_digits = _NO_OF_SHARDS_TO_NO_OF_HEX_DIGITS.get(no_of_object_shards, 0)
         assert no_of_shards_per_predicate_default in _VALID_NO_SHARDS, _CONF_ERR_MSG.format('no_of_shards_per_predicate_default', _VALID_NO_SHARDS, no_of_shards_per_predicate_default)
         self._no_of_shards_per_predicate_default = no_of_shards_per_predicate_default
         assert isinstance(no_of_shards_per_predicate_dict, dict), _CONF_ERR_MSG.format('no_of_shards_per_predicate_dict', 'a dict', no_of_shards_per_predicate_dict)
         for (_, no_of_shards) in no_of_shards_per_predicate_dict.iteritems():
             assert no_of_shards in _VALID_NO_SHARDS, _CONF_ERR_MSG.format('no_of_shards_per_predicate_dict values', _VALID_NO_SHARDS, no_of_shards)
         self._no_of_shards_per_predicate_dict = no_of_shards_per_predicate_dict
+        assert isinstance(predicate_sub_shards_by_subject, bool), _CONF_ERR_MSG.format('predicate_sub_shards_by_subject', [True, False], predicate_sub_shards_by_subject)
+        self._predicate_sub_shards_by_subject = predicate_sub_shards_by_subject
+        assert isinstance(max_triples_per_shard, int) and max_triples_per_shard > 0, _CONF_ERR_MSG.format('max_triples_per_shard', 'the positive integers', max_triples_per_shard)
+        self._max_triples_per_shard = max_triples_per_shard
+        assert isinstance(max_bytes_per_shard, int) and max_bytes_per_shard > 0, _CONF_ERR_MSG.format('max_bytes_per_shard', 'the positive integers', max_bytes_per_shard)
+        self._max_bytes_per_shard = max_bytes_per_shard
+        assert isinstance(max_deltas_per_shard, int) and max_deltas_per_shard >= 0, _CONF_ERR_MSG.format('max_deltas_per_shard', 'the non-negative integers', max_deltas_per_shard)
+        self._max_deltas_per_shard = max_deltas_per_shard
+        assert isinstance(statistics, bool), _CONF_ERR_MSG.format('statistics', [True, False], statistics)
+        self._keeps_statistics = statistics
+        assert tracer is None or callable(tracer), _CONF_ERR_MSG.format('tracer', 'None or a function', tracer)
+        self._tracer = tracer
+        assert isinstance(shard_fetch_window, int) and shard_fetch_window > 0, _CONF_ERR_MSG.format('shard_fetch_window', 'the positive integers', shard_fetch_window)
+        self._shard_fetch_window = shard_fetch_window
+        assert isinstance(write_buffer_size, int) and write_buffer_size >= 0, _CONF_ERR_MSG.format('write_buffer_size', 'the non-negative integers', write_buffer_size)
+        self._write_buffer_size = write_buffer_size
+        assert isinstance(versioned, bool), _CONF_ERR_MSG.format('versioned', [True, False], versioned)
+        self._versioned = versioned
+        assert isinstance(context_aware, bool), _CONF_ERR_MSG.format('context_aware', [True, False], context_aware)
+        assert not (context_aware and (versioned or write_buffer_size > 0)), 'NDBStore cannot be context_aware and versioned or buffer writes'
+        self.context_aware = context_aware #Read by rdflib
+        self.graph_aware = context_aware #Read by rdflib.Dataset
+        assert isinstance(large_term_size, int) and large_term_size >= 0, _CONF_ERR_MSG.format('large_term_size', 'the non-negative integers', large_term_size)
+        self._large_term_size = large_term_size
 
     def _hex_digits(self, predicate):
         no_of_shards = self._no_of_shards_per_predicate_dict.get(predicate, self._no_of_shards_per_predicate_default)
@@ -170,12 +756,13 @@ class NDBStore(Store):
         '''Assemble all NDB keys for the GraphShards containing triples relevant to the given parameters.
            @param graph_ID: The name of the graph to get triples from, e.g. 'current'
            @param uri_ref: The rdflib.URIRef to get triples for
-           @param index: 0, or 1 to indicate at which position the triples should have the given uri_ref.
-                         0=subject, 1=predicate
+           @param index: 0, 1 or 2 to indicate at which position the triples should have the given uri_ref.
+                         0=subject, 1=predicate, 2=object. Object keys require object shards to be configured.
            @return A list of ndb.Keys for the relevant GraphShards.
                    Example Key: 'p-prov#endedAtTime_6f11f819383b6a6bb619fbea25b5696372ba0b62--newdata'
         '''
-        assert index in range(2), 'index was {}, must be one of 0 for subject, 1 for predicate'.format(index)
+        assert index in range(3), 'index was {}, must be one of 0 for subject, 1 for predicate, 2 for object'.format(index)
+        assert index != 2 or self._has_object_shards, 'NDBStore is not configured with object shards'
         if index == 1: #A predicate
             no_of_hex_digits = self._hex_digits(uri_ref)
             random_sub_shards = [''.join(t) for t in product(_HEX_DIGITS, repeat = no_of_hex_digits)]
@@ -184,11 +771,25 @@ class NDBStore(Store):
             if len(whiff) > 20:
                 whiff = whiff[-20:]
             uri_ref_digest = '{}_{}'.format(whiff, sha1(uri_ref))#Example: prov#endedAtTime_6f11f819383b6a6bb619fbea25b5696372ba0b62
-        else: #A subject
+        elif index == 0: #A subject
             uri_ref_digest = sha1(uri_ref)[-self._no_of_subject_shard_digits:]
             random_sub_shards = ['']
+        else: #An object
+            digest = sha1(uri_ref)
+            uri_ref_digest = digest[len(digest) - self._no_of_object_shard_digits:] #Note: [-0:] would be the whole digest
+            random_sub_shards = ['']
         return [ndb.Key(GraphShard, '{}-{}-{}-{}'.format('spo'[index], uri_ref_digest, r, graph_ID)) for r in random_sub_shards]
 
+    def _predicate_keys(self, s, p):
+        '''@param s: A subject, or ANY
+           @param p: A predicate
+           @return The keys of the predicate GraphShards that may contain triples matching (s, p, ANY)
+        '''
+        keys = self.keys_for(self._ID, p, 1)
+        if self._predicate_sub_shards_by_subject and s != ANY:
+            return [keys[_sub_shard_index(s, len(keys))]]
+        return keys
+
     def log(self, msg):
         '''Add a message to this objects internal log.
            @param msg: The message, a string. It may contain newlines.
@@ -204,149 +805,1157 @@ class NDBStore(Store):
         if self._is_logging:
             logging.log(level, self._log.getvalue())
             self._log = StringIO()
+
+    def is_tracing(self):
+        '''@return True if this NDBStore builds Spans, i.e. if a tracer or the internal log is configured
+        '''
+        return self._tracer is not None or self._is_logging
+
+    def _span(self, name, **attributes):
+        '''Starts a Span as part of the query being evaluated, or as the root of a new tree of Spans if there is none.
+           @return The new Span, or NULL_SPAN if this NDBStore is not tracing
+        '''
+        if self._query_span:
+            return self._query_span.child(name, **attributes)
+        if not self.is_tracing():
+            return NULL_SPAN
+        return Span(name, **attributes)
+
+    def _finish(self, span):
+        '''Ends a Span. If it is the root of a tree of Spans, the tree is passed to the tracer and written to the internal log.
+        '''
+        span.finish()
+        if span and span.parent is None:
+            if self._tracer is not None:
+                self._tracer(span)
+            self.log(span.format())
+
+    def _begin_query(self, name):
+        '''Starts the root Span of a query, to which subsequent Spans are added until _end_query() is called.
+        '''
+        self._query_span = NULL_SPAN
+        self._query_span = self._span(name)
+        return self._query_span
+
+    def _end_query(self, span):
+        '''Ends the root Span of a query, see _finish().
+        '''
+        if self._query_span is span:
+            self._query_span = NULL_SPAN
+        self._finish(span)
         
     def destroy(self, _configuration):
+        self.rollback()
+        if self.context_aware:
+            for identifier in self._contexts():
+                self._context_store(identifier).destroy(_configuration)
+            ndb.delete_multi(GraphContext.query(GraphContext.graph_ID == self._ID).iter(keys_only = True))
+            self._context_identifiers = set()
+        self._statistics.clear()
+        _delete_graph(self._ID)
+        self._bump_generation()
+
+    def replace(self, source, format = 'nt', chunk_size = 10000, delete_after = 60):
+        '''Replaces all triples in this graph with the triples in an RDF file. Readers see the old triples until the new ones 
+           have all been written, and then the new ones: The triples are loaded by rdflib_appengine.bulkload.load() under the 
+           graph_ID of a new version, and then the GraphPointer of this graph is switched to the new version in a transaction.
+           The triples of the old version are deleted by a deferred task, which requires the deferred builtin to be enabled.
+           Requires versioned to be set.
+           @param source: A file-like object or the name of a file, see rdflib_appengine.bulkload.load()
+           @param format: The rdflib name of the file's format, e.g. 'nt' or 'turtle'
+           @param chunk_size: The maximal number of triples to hold in memory and write in one batch
+           @param delete_after: The number of seconds to wait before deleting the old version, so readers that read the
+                                GraphPointer before it was switched can complete
+           @return The BulkLoad describing the load
+        '''
+        assert self._versioned, 'NDBStore must be configured with versioned set to True to replace() its triples'
+        from rdflib_appengine.bulkload import load
+        from google.appengine.ext import deferred
+        self.commit()
+        #Step 1: Reserve a new version, so concurrent calls do not load into the same graph_ID
+        version = _reserve_version(self._identifier)
+        staged = NDBStore(configuration = dict(self._configuration, versioned = False), identifier = self._identifier)
+        staged._ID = _versioned_graph_ID(self._identifier, version)
+        _delete_graph(staged._ID) #Left behind if an earlier call with this version failed
+        #Step 2: Load the triples into the new version
+        progress = load(staged, source, format = format, chunk_size = chunk_size)
+        #Step 3: Switch readers to the new version, then delete the old version when readers are done with it
+        obsolete = _switch_version(self._identifier, version, staged._ID)
+        if obsolete != staged._ID:
+            self._ID = staged._ID
+            self._statistics.clear()
+        deferred.defer(_delete_graph, obsolete, _countdown = delete_after if obsolete != staged._ID else 0)
+        logging.info('Replaced {} with version {} ({} triples), deleting {}'.format(self._identifier, version, progress.triples, obsolete))
+        return progress
+
+    def upgrade_shards(self, batch_size = 20):
+        '''Converts every GraphShard in this graph still stored in the N3 format to the binary format.
+           Reading legacy GraphShards works without this, but calling it once removes the parsing cost.
+           @param batch_size: The number of GraphShards to convert per datastore round trip
+           @return The number of converted GraphShards
+        '''
+        if self.context_aware:
+            return sum([self._context_store(identifier).upgrade_shards(batch_size) for identifier in self._contexts()])
+        upgraded = 0
         more = True
         cursor = None
         while more:
-            (results, cursor, more) = GraphShard.query().filter(GraphShard.graph_ID == self._ID).fetch_page(20, keys_only = True, start_cursor=cursor)
-            logging.debug('Deleting {}'.format(results))
-            ndb.delete_multi(results)
+            (results, cursor, more) = GraphShard.query().filter(GraphShard.graph_ID == self._ID).fetch_page(batch_size, start_cursor=cursor)
+            legacy = [m for m in results if m.is_legacy()]
+            self._compact(legacy)
+            upgraded += len(legacy)
+        logging.info('Upgraded {} GraphShards in {} to the binary format'.format(upgraded, self._ID))
+        return upgraded
+    
+    def rehash_predicate_shards(self):
+        '''Moves every triple stored in a randomly chosen predicate sub-shard to the sub-shard chosen by its subject,
+           as if predicate_sub_shards_by_subject had been set when it was added. Triples already in the right sub-shard are untouched.
+           Use this to migrate graphs written without predicate_sub_shards_by_subject: Enable the setting, then run this method.
+           Reads of triples with bound subject and predicate may miss triples until the method completes.
+           Note that this method reads every triple in the graph.
+           @return The number of triples moved
+        '''
+        if self.context_aware:
+            return sum([self._context_store(identifier).rehash_predicate_shards() for identifier in self._contexts()])
+        predicates = set()
+        for m in self._all_predicate_shard_models():
+            predicates.update(m.rdflib_graph().predicates())
+        moved = 0
+        for p in predicates:
+            keys = self.keys_for(self._ID, p, 1)
+            if len(keys) == 1:
+                continue
+            changes = defaultdict(_new_changes)
+            for key in keys:
+                for m in self._leaf_shard_models([key], ANY):
+                    for t in m.rdflib_graph().triples((ANY, p, ANY)):
+                        target = keys[_sub_shard_index(t[0], len(keys))]
+                        if target != key:
+                            changes[key][1].add(t)
+                            changes[target][0].add(t)
+                            moved += 1
+            self._update_shards(changes)
+        logging.info('Moved {} triples in {} to the predicate sub-shards chosen by their subjects'.format(moved, self._ID))
+        return moved
+
+    def rebuild_object_shards(self):
+        '''Stores every triple in this graph in the object GraphShards, replacing the object GraphShards written before.
+           Use this after enabling no_of_object_shards for a graph that already has triples, or after changing it:
+           Patterns answered from object GraphShards (see _route()) miss the triples not yet in them until the method completes.
+           Note that this method reads every triple in the graph.
+           @return The number of triples stored in object GraphShards
+        '''
+        assert self._has_object_shards, 'NDBStore is not configured with object shards'
+        if self.context_aware:
+            return sum([self._context_store(identifier).rebuild_object_shards() for identifier in self._contexts()])
+        self.commit()
+        #Step 1: Delete the object GraphShards, which may have been written with another no_of_object_shards
+        obsolete = [key for key in GraphShard.query(GraphShard.graph_ID == self._ID).iter(keys_only = True) if key.id().startswith('o-')]
+        GraphShard.invalidate([GraphShard(key = key, graph_ID = self._ID) for key in obsolete])
+        obsolete += [key for key in GraphShardDelta.query(GraphShardDelta.graph_ID == self._ID).iter(keys_only = True) if key.parent().id().startswith('o-')]
+        ndb.delete_multi(obsolete)
+        #Step 2: Add the triples of each predicate GraphShard to the object GraphShards
+        stored = 0
+        for m in self._all_predicate_shard_models():
+            changes = defaultdict(_new_changes)
+            for t in m.rdflib_graph():
+                changes[choice(self.keys_for(self._ID, t[2], 2))][0].add(t)
+                stored += 1
+            self._update_shards(changes)
+        logging.info('Stored {} triples in {} in object GraphShards'.format(stored, self._ID))
+        return stored
+
+    def compact(self, batch_size = 20):
+        '''Folds the GraphShardDeltas of every GraphShard in this graph into the GraphShard itself.
+           Compaction also happens automatically, see max_deltas_per_shard.
+           @param batch_size: The number of GraphShards to compact per datastore round trip
+           @return The number of compacted GraphShards
+        '''
+        if self.context_aware:
+            return sum([self._context_store(identifier).compact(batch_size) for identifier in self._contexts()])
+        compacted = 0
+        more = True
+        cursor = None
+        while more:
+            (results, cursor, more) = GraphShard.query().filter(GraphShard.graph_ID == self._ID, GraphShard.delta_count > 0).fetch_page(batch_size, start_cursor=cursor)
+            self._compact(results)
+            compacted += len(results)
+        logging.info('Compacted {} GraphShards in {}'.format(compacted, self._ID))
+        return compacted
+    
+    def statistics(self):
+        '''@return A list with PredicateStats.as_dict() for every predicate in this graph, most frequent predicate first.
+                   If this NDBStore is context aware, there is one for every predicate in every context, with the context's identifier as 'context'.
+        '''
+        if self.context_aware:
+            stats = [dict(d, context = identifier) for identifier in self._contexts() for d in self._context_store(identifier).statistics()]
+        else:
+            stats = [st.as_dict() for st in PredicateStats.query().filter(PredicateStats.graph_ID == self._ID)]
+        return sorted(stats, key = lambda d: d['triples'], reverse = True)
+    
+    def predicate_statistics(self, predicates):
+        '''Reads the PredicateStats of the given predicates. They are kept in this NDBStore until the next write.
+           @param predicates: An iterable of predicates
+           @return A dict mapping each given predicate to its PredicateStats, or to None if no triples with it have been written
+        '''
+        predicates = set(predicates)
+        missing = [p for p in predicates if p not in self._statistics]
+        if len(missing) > 0:
+            keys = [ndb.Key(PredicateStats, '{}-{}'.format(self.keys_for(self._ID, p, 1)[0].id().split('-')[1], self._ID)) for p in missing]
+            self._statistics.update(zip(missing, ndb.get_multi(keys)))
+        return dict((p, self._statistics[p]) for p in predicates)
+    
+    def estimate(self, (s, p, o)):
+        '''Estimates the number of triples matching a triple pattern, using the PredicateStats.
+           Like predicate_statistics(), the PredicateStats are read once and kept in this NDBStore until the next write.
+           @param (s, p, o): A triple pattern, where ANY marks a free position. The subject and object need not be 
+                             actual terms, anything but ANY counts as bound. The predicate must be ANY or a predicate.
+           @return The estimated number of matching triples, a float
+        '''
+        if self.context_aware:
+            return sum([self._context_store(identifier).estimate((s, p, o)) for identifier in self._contexts()])
+        if p == ANY:
+            if ANY not in self._statistics:
+                self._statistics[ANY] = PredicateStats.query().filter(PredicateStats.graph_ID == self._ID).fetch()
+            stats = self._statistics[ANY]
+        else:
+            stats = [self.predicate_statistics([p])[p]]
+        return sum([st.estimate(s != ANY, o != ANY) for st in stats if st is not None])
+    
+    def explain(self, bgp, bound = ()):
+        '''Shows how the SPARQL query evaluator orders the triple patterns of a basic graph pattern.
+           @param bgp: A list of triple patterns, whose variables are rdflib.Variables or rdflib.BNodes
+           @param bound: The variables that are bound before the basic graph pattern is evaluated
+           @return A list of pairs (triple pattern, estimated number of matches for each binding) in evaluation order
+        '''
+        return _plan(self, bgp, set(bound))
+    
+    def rebuild_statistics(self):
+        '''Recomputes the PredicateStats for every predicate in this graph by reading every predicate GraphShard.
+           Use this for graphs written before statistics were kept, or by an NDBStore with statistics set to False.
+           @return The number of predicates with statistics
+        '''
+        if self.context_aware:
+            return sum([self._context_store(identifier).rebuild_statistics() for identifier in self._contexts()])
+        self._statistics.clear()
+        ndb.delete_multi(PredicateStats.query().filter(PredicateStats.graph_ID == self._ID).iter(keys_only = True))
+        stats = dict()
+        for m in self._all_predicate_shard_models():
+            g = m.rdflib_graph()
+            if len(g) == 0:
+                continue
+            key = ndb.Key(PredicateStats, '{}-{}'.format(m.key.id().split('-')[1], self._ID))
+            if key not in stats:
+                stats[key] = PredicateStats(key = key, graph_ID = self._ID, predicate = next(iter(g))[1], shards = {})
+            stats[key].shards[m.key.id()] = [len(g), len(set(g.subjects())), len(set(g.objects())), m._stored_size()]
+        ndb.put_multi(stats.values())
+        logging.info('Rebuilt statistics for {} predicates in {}'.format(len(stats), self._ID))
+        return len(stats)
+    
+    def _compact(self, models):
+        '''Rewrites the given GraphShards in the binary format with their GraphShardDeltas folded in, 
+           splitting them if needed. 
+           @param models: A list of GraphShards
+        '''
+        updated = list()
+        deleted = list()
+        predicates = dict()
+        for model in models:
+            g = model.load_into(Graph())
+            for t in g:
+                predicates[model.key] = t[1]
+                break
+            deleted.extend(model.clear_deltas())
+            updated.extend(self._set_triples_or_split(model, g))
+        if len(updated) > 0:
+            GraphShard.invalidate(updated)
+            ndb.put_multi(updated + self._updated_statistics(updated, predicates))
+            ndb.delete_multi(deleted)
         
     def addN(self, quads):
-        #TODO: Handle splitting large graphs into two entities
         #Note: quads is a generator, not a list. It cannot be traversed twice.
-        #Step 1: Collect the triples into the Graphs reflecting the GraphShards they will be added to.
-        new_shard_dict = defaultdict(Graph)
-        for (s, p, o, _) in quads: #Last component ignored as this Store is not context_aware
+        if self.context_aware:
+            self._add_to_contexts(quads)
+            return
+        #Last component ignored as this Store is not context_aware
+        if self._write_buffer_size > 0:
+            for (s, p, o, _) in quads:
+                self._buffered_removes.discard((s, p, o))
+                self._buffered_adds.add((s, p, o))
+            self._commit_if_full()
+            return
+        self._update_shards(self._changes_for_adds((s, p, o) for (s, p, o, _) in quads))
+
+    def _changes_for_adds(self, triples):
+        '''Collects the triples into sets reflecting the GraphShards they will be added to.
+           @param triples: An iterable of (s, p, o) triples
+           @return A dict like the parameter of _update_shards()
+        '''
+        changes = defaultdict(_new_changes)
+        for (s, p, o) in self._stored_forms(triples):
             subject_shard = choice(self.keys_for(self._ID, s, 0))
-            new_shard_dict[subject_shard].add((s, p, o))
-            predicate_shard = choice(self.keys_for(self._ID, p, 1))
-            new_shard_dict[predicate_shard].add((s, p, o))
-        keys = list(new_shard_dict.keys())
-        #Step 2: Load all existing, corresponding GraphShards
-        keys_models = zip(keys, ndb.get_multi(keys)) #TODO: Use async get
-        #Step 3: Update or create GraphShards with the added triples
-        updated = list()
-        for index in range(len(keys_models)):
-            (key, model) = keys_models[index]
-            if model is None:
-                model = GraphShard(key = key, graph_ID = self._ID, graph_n3 = new_shard_dict[key].serialize(format='n3'))
-            else:
-                new_shard_dict[key].parse(data = model.graph_n3, format='n3')
-                model.graph_n3 = new_shard_dict[key].serialize(format='n3')
-            updated.append(model)
-        #Step 4: Invalidate and store all created/updated GraphShards
-        if len(updated) > 0:
-            GraphShard.invalidate(updated)
-            ndb.put_multi(updated)
+            changes[subject_shard][0].add((s, p, o))
+            predicate_shard = choice(self._predicate_keys(s, p))
+            changes[predicate_shard][0].add((s, p, o))
+            if self._has_object_shards:
+                object_shard = choice(self.keys_for(self._ID, o, 2))
+                changes[object_shard][0].add((s, p, o))
+        return changes
 
     def add(self, (subject, predicate, o), context, quoted=False):
         """\
         Redirects to addN() because NDB heavily favours batch updates.
         """
-        logging.warn('Inefficient use: 1 triple being added')
+        if self._write_buffer_size == 0:
+            logging.warn('Inefficient use: 1 triple being added')
         self.addN([(subject, predicate, o, context)])
 
     def remove(self, (s, p, o), context=None):
-        #Step 1: Get all relevant GraphShards
-        graph_shards = ndb.get_multi(self.keys_for(self._ID, s, 0)) + ndb.get_multi(self.keys_for(self._ID, p, 1))
-        #Step 2: Remove the given triple from the found GraphShards
-        updated = []
-        for m in graph_shards:
-            if m is not None:
-                g = m.rdflib_graph()
-                g.remove((s, p, o))
-                m.graph_n3 = g.serialize(format='n3')
-                updated.append(m)
-        #Step 3: Invalidate and store the updated GraphShards
+        """\
+        Redirects to removeN(), so (s, p, o) may contain ANY.
+        If this NDBStore is context aware, the triples are only removed from the given context, or from every context if it is None.
+        """
+        if self.context_aware:
+            self._remove_from_contexts([(s, p, o)], context)
+            return
+        self.removeN([(s, p, o)])
+
+    def removeN(self, patterns):
+        '''Removes every triple matching any of the given patterns.
+           The triples are grouped by GraphShard, so each affected GraphShard is written once.
+           If writes are buffered (see write_buffer_size), the triples are buffered instead.
+           @param patterns: An iterable of (s, p, o) triples. Any of s, p and o may be ANY,
+                            in which case the matching triples are found using triples().
+        '''
+        if self.context_aware:
+            self._remove_from_contexts(patterns, None)
+            return
+        matches = list()
+        for pattern in patterns:
+            if ANY in pattern:
+                matches.extend([t for (t, _) in self.triples(pattern)])
+            else:
+                matches.append(pattern)
+        if self._write_buffer_size > 0:
+            for t in matches:
+                self._buffered_adds.discard(t)
+                self._buffered_removes.add(t)
+            self._commit_if_full()
+            return
+        #Collect all GraphShards that may contain the triples
+        changes = defaultdict(_new_changes)
+        self._add_removals(changes, matches)
+        self._update_shards(changes)
+
+    def commit(self):
+        '''Writes the triples buffered by addN() and removeN() in one batch, see write_buffer_size.
+        '''
+        if len(self._buffered_adds) == 0 and len(self._buffered_removes) == 0:
+            return
+        changes = self._changes_for_adds(self._buffered_adds)
+        self._add_removals(changes, self._buffered_removes)
+        self._buffered_adds = set()
+        self._buffered_removes = set()
+        self._update_shards(changes)
+
+    def _apply(self, removed, added):
+        '''Removes and then adds triples in one batch of writes, so each affected GraphShard is written once.
+           If writes are buffered (see write_buffer_size), the triples are buffered instead.
+           @param removed: A list of (s, p, o) triples without ANY. Those also in added are kept.
+           @param added: A list of (s, p, o) triples
+        '''
+        if self._write_buffer_size > 0:
+            for t in removed:
+                self._buffered_adds.discard(t)
+                self._buffered_removes.add(t)
+            for t in added:
+                self._buffered_removes.discard(t)
+                self._buffered_adds.add(t)
+            self._commit_if_full()
+            return
+        kept = set(added)
+        changes = self._changes_for_adds(added)
+        self._add_removals(changes, [t for t in removed if t not in kept])
+        self._update_shards(changes)
+
+    def rollback(self):
+        '''Discards the triples buffered by addN() and removeN(), see write_buffer_size.
+        '''
+        self._buffered_adds = set()
+        self._buffered_removes = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''Commits the buffered writes when a with block ends normally, and discards them if it ends with an exception.
+        '''
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def _commit_if_full(self):
+        if len(self._buffered_adds) + len(self._buffered_removes) >= self._write_buffer_size:
+            self.commit()
+
+    def _add_to_contexts(self, quads):
+        '''Adds the triples of the given quads to the GraphShards of their contexts, in one batch of writes for all contexts.
+           @param quads: An iterable of (s, p, o, context), where context is a Graph, or None for the default graph of a Dataset
+        '''
+        by_context = defaultdict(list)
+        for (s, p, o, c) in quads:
+            by_context[_identifier_of(c)].append((s, p, o))
+        futures = self._register_contexts_async(by_context.keys())
+        for (identifier, triples) in by_context.iteritems():
+            store = self._context_store(identifier)
+            futures.extend(store._update_shards_async(store._changes_for_adds(triples)))
+        for future in futures:
+            future.check_success()
+        for identifier in by_context.keys():
+            self._context_store(identifier)._bump_generation()
+        self._bump_generation()
+
+    def _remove_from_contexts(self, patterns, context):
+        '''Removes the triples matching the given patterns from the given context, or from every context if it is None.
+        '''
+        patterns = list(patterns)
+        identifiers = list(self._contexts()) if context is None else [_identifier_of(context)]
+        for identifier in identifiers:
+            self._context_store(identifier).removeN(patterns)
+        self._bump_generation()
+
+    def contexts(self, triple = None):
+        '''Generator yielding the contexts of this context aware NDBStore as Graphs.
+           The contexts are read from GraphContexts rather than from the triples.
+           @param triple: None, or a triple. If given, only the contexts containing the triple are yielded.
+        '''
+        assert self.context_aware, 'NDBStore must be configured with context_aware set to True to have contexts'
+        for identifier in sorted(self._contexts()):
+            if triple is None or next(self._context_store(identifier).triples(triple), None) is not None:
+                yield Graph(store = self, identifier = identifier)
+
+    def add_graph(self, graph):
+        '''Adds an empty context to this context aware NDBStore, see rdflib.Dataset.
+           @param graph: A Graph, whose identifier identifies the context
+        '''
+        for future in self._register_contexts_async([_identifier_of(graph)]):
+            future.check_success()
+
+    def remove_graph(self, graph):
+        '''Removes a context and all its triples from this context aware NDBStore, see rdflib.Dataset.
+           @param graph: A Graph, whose identifier identifies the context
+        '''
+        identifier = _identifier_of(graph)
+        store = self._context_store(identifier)
+        store.destroy(None)
+        ndb.Key(GraphContext, store._ID).delete()
+        self._contexts().discard(identifier)
+        self._bump_generation()
+
+    def _contexts(self):
+        '''@return The set of the identifiers of the contexts of this graph, read from the GraphContexts once by this NDBStore
+        '''
+        if self._context_identifiers is None:
+            self._context_identifiers = set([from_n3(c.identifier) for c in GraphContext.query(GraphContext.graph_ID == self._ID)])
+        return self._context_identifiers
+
+    def _register_contexts_async(self, identifiers):
+        '''Records the contexts with the given identifiers in GraphContexts, unless they are known already.
+           @return A list of ndb.Futures for the writes
+        '''
+        new = [identifier for identifier in identifiers if identifier not in self._contexts()]
+        self._contexts().update(new)
+        return ndb.put_multi_async([GraphContext(id = self._context_store(identifier)._ID, graph_ID = self._ID, identifier = identifier.n3()) for identifier in new])
+
+    def _context_store(self, context):
+        '''@param context: A Graph, or the identifier of a context
+           @return An NDBStore, not context aware, for the triples in the given context of this graph. 
+                   Its graph_ID is this graph's graph_ID followed by '@' and the SHA1 of the context's identifier.
+        '''
+        identifier = _identifier_of(context)
+        store = self._context_stores.get(identifier)
+        if store is None:
+            store = NDBStore(configuration = dict(self._configuration, context_aware = False), identifier = self._identifier)
+            store._ID = '{}@{}'.format(self._ID, sha1(identifier.n3()))
+            self._context_stores[identifier] = store
+        store._query_span = self._query_span
+        return store
+
+    def _add_removals(self, changes, triples):
+        '''Adds the given triples to the triples to remove from every GraphShard that may contain them.
+           @param changes: A dict like the parameter of _update_shards()
+           @param triples: An iterable of (s, p, o) triples without ANY
+        '''
+        for (s, p, o) in map(self._stored_form, triples):
+            keys = self.keys_for(self._ID, s, 0) + self._predicate_keys(s, p)
+            if self._has_object_shards:
+                keys += self.keys_for(self._ID, o, 2)
+            for key in keys:
+                changes[key][1].add((s, p, o))
+
+    def _stored_forms(self, triples):
+        '''Stores the large terms of the given triples as LargeTerms, see large_term_size.
+           @param triples: An iterable of (s, p, o) triples
+           @return An iterable of the triples as stored in GraphShards, see _stored_form()
+        '''
+        if self._large_term_size == 0:
+            return triples
+        values = dict()
+        stored = list()
+        for (s, p, o) in triples:
+            for term in [s, o]:
+                if self._is_large(term):
+                    values[sha1(term)] = unicode(term)
+            stored.append(self._stored_form((s, p, o)))
+        LargeTerm.put_values(values) #Before the GraphShards referring to them are written
+        return stored
+
+    def _stored_form(self, (s, p, o)):
+        '''@param (s, p, o): A triple or a pattern
+           @return The triple or pattern as stored in GraphShards, i.e. with large subjects and objects replaced by placeholders
+        '''
+        if self._large_term_size == 0:
+            return (s, p, o)
+        return (_placeholder(s) if self._is_large(s) else s, p, _placeholder(o) if self._is_large(o) else o)
+
+    def _is_large(self, term):
+        return isinstance(term, (URIRef, Literal)) and len(term) > self._large_term_size
+
+    def _resolved(self, triples):
+        '''Generator replacing the placeholders in the given triples by the terms they stand for.
+           The LargeTerms for a batch of triples are fetched at once, so a consumer that stops early does not fetch the rest.
+           @param triples: An iterable of (s, p, o) triples read from GraphShards
+        '''
+        triples = iter(triples)
+        while True:
+            batch = list(islice(triples, _RESOLVE_BATCH_SIZE))
+            if len(batch) == 0:
+                return
+            values = LargeTerm.get_values([term[len(_PLACEHOLDER_PREFIX):] for (s, _, o) in batch for term in [s, o] if _is_placeholder(term)])
+            for (s, p, o) in batch:
+                yield (_resolve(s, values), p, _resolve(o, values))
+
+    def _update_shards(self, changes):
+        '''Adds and removes triples in GraphShards.
+           GraphShards that have been split pass the changes on to their child GraphShards.
+           GraphShards that grow too large are split.
+           @param changes: A dict mapping keys from keys_for() to pairs of sets (triples to add, triples to remove) 
+        '''
+        for future in self._update_shards_async(changes):
+            future.check_success()
+        self._bump_generation()
+
+    def _update_shards_async(self, changes):
+        '''Like _update_shards(), but the GraphShards are written and deleted asynchronously.
+           The GraphShards are read synchronously, so the writes of any previous call must have completed.
+           @param changes: A dict mapping keys from keys_for() to pairs of sets (triples to add, triples to remove)
+           @return A list of ndb.Futures for the writes and deletes
+        '''
+        updated = list()
+        deltas = list()
+        deleted = list()
+        predicates = dict() #Maps the key of a predicate GraphShard to its predicate
+        for (key, (added, removed)) in changes.iteritems():
+            for t in added or removed:
+                predicates[key] = t[1]
+                break
+        while len(changes) > 0:
+            #Step 1: Load all existing, corresponding GraphShards
+            keys = list(changes.keys())
+            keys_models = zip(keys, ndb.get_multi(keys)) #TODO: Use async get
+            #Step 2: Update or create GraphShards with the changes, or pass changes to children of split GraphShards
+            child_changes = defaultdict(_new_changes)
+            for (key, model) in keys_models:
+                (added, removed) = changes[key]
+                if model is None:
+                    if len(added) > 0:
+                        updated.extend(self._set_triples_or_split(GraphShard(key = key, graph_ID = self._ID), added))
+                    continue
+                if model.is_split:
+                    for (index, triples) in enumerate(changes[key]):
+                        for t in triples:
+                            child_changes[model.child_key(t[model.routing_index()])][index].add(t)
+                    continue
+                if model.delta_count < self._max_deltas_per_shard:
+                    #Append a GraphShardDelta with the changes, leaving the existing triples untouched
+                    delta = model.append_delta(added, removed, self._max_triples_per_shard, self._max_bytes_per_shard)
+                    if delta is not None:
+                        deltas.append(delta)
+                        updated.append(model)
+                        continue
+                #Fold GraphShardDeltas and changes into the GraphShard, which is split if it grows too large
+                g = model.load_into(Graph())
+                deleted.extend(model.clear_deltas())
+                for t in removed:
+                    g.remove(t)
+                for t in added:
+                    g.add(t)
+                updated.extend(self._set_triples_or_split(model, g))
+            changes = child_changes
+        #Step 3: Invalidate and store all created/updated GraphShards
         if len(updated) > 0:
             GraphShard.invalidate(updated)
-            ndb.put_multi(updated)
+            return (ndb.put_multi_async(updated + deltas + self._updated_statistics(updated, predicates))
+                    + ndb.delete_multi_async(deleted))
+        return []
+
+    def _updated_statistics(self, updated, predicates):
+        '''Updates the PredicateStats of the predicates of the given predicate GraphShards, unless statistics are disabled.
+           @param updated: A list of created or updated GraphShards. GraphShards with GraphShardDeltas are skipped, as their 
+                           stored triples have not changed, see PredicateStats.
+           @param predicates: A dict mapping the key of a predicate GraphShard, or of its split ancestor, to its predicate 
+           @return A list of the PredicateStats to store
+        '''
+        self._statistics.clear()
+        if not self._keeps_statistics:
+            return []
+        entries = defaultdict(dict) #Maps a PredicateStats key to a dict mapping a GraphShard's key's id to its new entry, or None to remove
+        for m in updated:
+            if m.spo() != 'p' or m.delta_count > 0:
+                continue
+            shard_id = m.key.id()
+            stats_key = ndb.Key(PredicateStats, '{}-{}'.format(shard_id.split('-')[1], self._ID))
+            if m.is_split:
+                entries[stats_key][shard_id] = None
+            else:
+                entries[stats_key][shard_id] = [m.triple_count, m.subject_count, m.object_count, m._stored_size()]
+        #Any key of a predicate's GraphShards identifies the predicate for all of them
+        predicates = dict((ndb.Key(PredicateStats, '{}-{}'.format(key.id().split('-')[1], self._ID)), p) for (key, p) in predicates.iteritems() if key.id().startswith('p-'))
+        keys = list(entries.keys())
+        stats = list()
+        for (key, st) in zip(keys, ndb.get_multi(keys)):
+            if st is None:
+                st = PredicateStats(key = key, graph_ID = self._ID, shards = {})
+            if st.predicate is None:
+                st.predicate = predicates.get(key)
+            for (shard_id, entry) in entries[key].iteritems():
+                if entry is None:
+                    st.shards.pop(shard_id, None)
+                else:
+                    st.shards[shard_id] = entry
+            stats.append(st)
+        return stats
+
+    def _set_triples_or_split(self, model, g):
+        '''Stores the given triples in the given GraphShard. 
+           If the triples exceed the configured limits, the GraphShard is split instead,
+           and the triples are stored in its new child GraphShards (which may in turn be split).
+           @param model: A GraphShard that is not split and has no GraphShardDeltas
+           @param g: Every triple the GraphShard should contain, e.g. an rdflib.Graph or a set
+           @return A list of GraphShards that have been created or updated
+        '''
+        model.set_triples(g)
+        if len(g) <= self._max_triples_per_shard and len(model.graph_bin) <= self._max_bytes_per_shard:
+            return [model]
+        if model.split_depth() >= _MAX_SPLIT_DEPTH:
+            logging.warn('GraphShard {} exceeds the configured limits but cannot be split further'.format(model.key.id()))
+            return [model]
+        children = defaultdict(Graph)
+        for t in g:
+            children[model.child_key(t[model.routing_index()])].add(t)
+        if len(children) < 2:
+            logging.warn('GraphShard {} exceeds the configured limits but splitting would not distribute its triples'.format(model.key.id()))
+            return [model]
+        logging.info('Splitting GraphShard {} with {} triples into {} child GraphShards'.format(model.key.id(), len(g), len(children)))
+        model.is_split = True
+        model.set_triples([])
+        updated = [model]
+        for (key, child) in children.iteritems():
+            updated.extend(self._set_triples_or_split(GraphShard(key = key, graph_ID = self._ID), child))
+        return updated
 
     def triples(self, (s, p, o), context=None):
-        #Log execution data using a random ID
-        log_id = '{:04d}'.format(randrange(1000))
-        self.log('{} triples({}, {}, {})'.format(log_id, s, p, o))
-        #Analyse bindings to see if the query can be answered using a single GraphShard
-        if p == ANY:
-            if s == ANY:
-                #(s,p,o) == (ANY,ANY,o), so all GraphShards must be consulted
-                models = self._all_predicate_shard_models()
-                pattern = (s, p, o)
-            else:#s is bound so only the GraphShard for s (and subjects with same hash) needs to be consulted
-                models = ndb.get_multi(self.keys_for(self._ID, s, 0))
-                pattern = (s, p, o)
-        else:#p is bound so only the GraphShard for p needs to be consulted
-            models = ndb.get_multi(self.keys_for(self._ID, p, 1))
-            pattern = (s, ANY, o) #Remove p because IOMemory is slower if you provide a redundant binding
-        for m in models:
-            if m is not None:
-                g = m.rdflib_graph()
-                for t in g.triples(pattern):
+        if self.context_aware:
+            for x in self._triples_in_contexts((s, p, o), context):
+                yield x
+            return
+        span = self._span('triples', pattern = (s, p, o))
+        route = self._route(self._stored_form((s, p, o)))
+        if route is None:
+            #(s,p,o) == (ANY,ANY,o) or (ANY,ANY,ANY), so all GraphShards must be consulted
+            models = self._all_predicate_shard_models()
+            pattern = self._stored_form((s, p, o))
+            span.set(route = 'all')
+        else:
+            (keys, routing_term, pattern) = route
+            models = self._leaf_shard_models(keys, routing_term, span)
+            if span:
+                span.set(route = keys[0].id()[0], keys = [key.id() for key in keys])
+        buffered = len(self._buffered_adds) > 0 or len(self._buffered_removes) > 0
+        if buffered: #Read your own buffered writes: Skip the stored triples that are buffered, then yield the buffered additions
+            changed = self._buffered_adds | self._buffered_removes
+            added = [t for t in self._buffered_adds if _matches(t, (s, p, o))]
+        stored = (t for m in models for t in m.rdflib_graph(span).triples(pattern))
+        if self._large_term_size > 0:
+            stored = self._resolved(stored)
+        yielded = 0
+        try:
+            for t in stored:
+                if buffered and t in changed:
+                    continue
+                yielded += 1
+                yield t, self.__contexts()
+            if buffered:
+                for t in added:
+                    yielded += 1
                     yield t, self.__contexts()
-        self.log('{} done'.format(log_id))
+        finally:
+            span.set(triples = yielded)
+            self._finish(span)
+
+    def _triples_in_contexts(self, pattern, context):
+        '''Like triples(), for a context aware NDBStore. If context is None, the triples of every context are yielded,
+           each triple only once with all contexts containing it. With more than one context, the matching triples of all
+           contexts are therefore read and grouped, each context's GraphShards once, before the first triple is yielded.
+        '''
+        if context is not None:
+            for (t, _) in self._context_store(context).triples(pattern):
+                yield t, iter([context])
+            return
+        graphs = [Graph(store = self, identifier = identifier) for identifier in sorted(self._contexts())]
+        if len(graphs) == 1:
+            for (t, _) in self._context_store(graphs[0].identifier).triples(pattern):
+                yield t, iter(graphs)
+            return
+        contexts_of = OrderedDict() #Maps a triple to the Graphs of the contexts containing it
+        for graph in graphs:
+            for (t, _) in self._context_store(graph.identifier).triples(pattern):
+                contexts_of.setdefault(t, []).append(graph)
+        for (t, containing) in contexts_of.iteritems():
+            yield t, iter(containing)
+
+    def _route(self, (s, p, o)):
+        '''Analyse bindings to see if triples() can be answered using a single GraphShard (and its children)
+           @return None if all GraphShards must be consulted, otherwise a triple (keys, routing_term, pattern) where
+                   keys are the keys of the GraphShards to consult (see keys_for()), 
+                   routing_term decides which children of split GraphShards to consult (see _leaf_shard_models()), and
+                   pattern is the pattern to match against the triples in those GraphShards
+        '''
+        if p == ANY:
+            if s != ANY:#s is bound so only the GraphShard for s (and subjects with same hash) needs to be consulted
+                return (self.keys_for(self._ID, s, 0), s, (s, p, o))
+            if o != ANY and self._has_object_shards:#Only o is bound so only the GraphShard for o (and objects with same hash) needs to be consulted
+                return (self.keys_for(self._ID, o, 2), o, (s, p, o))
+            return None
+        if s == ANY and o != ANY and self._has_object_shards:#(ANY,p,o): The GraphShard for o is much smaller than that for p
+            return (self.keys_for(self._ID, o, 2), o, (s, p, o))
+        #p is bound so only the GraphShard for p needs to be consulted
+        return (self._predicate_keys(s, p), s, (s, ANY, o)) #Remove p because IOMemory is slower if you provide a redundant binding
+
+    def prefetch(self, patterns, context = None):
+        '''Loads the GraphShards that triples() needs for any of the given patterns into the local cache.
+           The GraphShards are fetched using one batched, asynchronous datastore round trip per level of splitting,
+           and the cache layers are searched in batches too (see GraphShard.rdflib_graphs()).
+           Patterns that would require traversing all GraphShards are ignored.
+           @param patterns: An iterable of (s, p, o) triples, where any of s, p and o may be ANY
+           @param context: If this NDBStore is context aware, the Graph for the context to prefetch for, or None for every context
+        '''
+        if self.context_aware:
+            patterns = list(patterns)
+            for identifier in (list(self._contexts()) if context is None else [_identifier_of(context)]):
+                self._context_store(identifier).prefetch(patterns)
+            return
+        span = self._span('prefetch')
+        routing_terms = defaultdict(set)
+        no_of_patterns = 0
+        for pattern in patterns:
+            no_of_patterns += 1
+            route = self._route(self._stored_form(pattern))
+            if route is not None:
+                (keys, routing_term, _) = route
+                for key in keys:
+                    routing_terms[key].add(routing_term)
+        span.set(patterns = no_of_patterns, keys = len(routing_terms))
+        leaves = list()
+        while len(routing_terms) > 0:
+            keys = list(routing_terms.keys())
+            futures = ndb.get_multi_async(keys)
+            child_routing_terms = defaultdict(set)
+            for (key, future) in zip(keys, futures):
+                m = future.get_result()
+                if m is None:
+                    continue
+                if not m.is_split:
+                    leaves.append(m)
+                elif ANY in routing_terms[key]:
+                    for child_key in m.child_keys():
+                        child_routing_terms[child_key].add(ANY)
+                else:
+                    for routing_term in routing_terms[key]:
+                        child_routing_terms[m.child_key(routing_term)].add(routing_term)
+            routing_terms = child_routing_terms
+        GraphShard.rdflib_graphs(leaves, span)
+        self._finish(span)
+
+    def _leaf_shard_models(self, keys, routing_term, span = NULL_SPAN):
+        '''Generator yielding the existing GraphShards with the given keys that have not been split.
+           For those that have been split, their children are yielded instead (recursively).
+           The GraphShards are fetched asynchronously, keeping up to shard_fetch_window gets in flight, so the first
+           GraphShards can be used while later ones are being fetched. GraphShards beyond the window are not fetched
+           until the earlier ones have been consumed, so closing the generator early stops fetching.
+           @param keys: A list of ndb.Keys, typically from keys_for()
+           @param routing_term: The subject (for subject and predicate GraphShards) or object (for object GraphShards) 
+                                of the triples needed, or ANY. If given, only one child of each split GraphShard is read.
+           @param span: A Span from rdflib_appengine.tracing, on which the number of keys fetched is set as the attribute fetched
+        '''
+        pending = deque(keys)
+        in_flight = deque()
+        fetched = 0
+        while len(pending) > 0 or len(in_flight) > 0:
+            #Step 1: Refill the window in batches of at least half the window, so each batch is one round trip
+            free = self._shard_fetch_window - len(in_flight)
+            if len(pending) > 0 and (free * 2 >= self._shard_fetch_window or len(in_flight) == 0):
+                batch = [pending.popleft() for _ in xrange(min(free, len(pending)))]
+                in_flight.extend(ndb.get_multi_async(batch))
+                fetched += len(batch)
+                span.set(fetched = fetched)
+            #Step 2: Wait for the oldest get, which sends the queued batch if it was not sent already
+            m = in_flight.popleft().get_result()
+            if m is None:
+                continue
+            if not m.is_split:
+                yield m
+            elif routing_term == ANY:
+                pending.extend(m.child_keys())
+            else:
+                pending.append(m.child_key(routing_term))
 
     def _all_predicate_shard_models(self):
         '''Generator yielding every GraphShard for the identified graph.
         '''
         logging.warn('Inefficient usage: Traversing all triples')
         for m in GraphShard.query().filter(GraphShard.graph_ID == self._ID).iter():
-            if m is not None and m.spo() == 'p': #Avoid yield each triple twice (once for each GraphShard it is stored in)
+            if m is not None and m.spo() == 'p' and not m.is_split: #Avoid yield each triple twice (once for each GraphShard it is stored in)
                 yield m
                 
     def __len__(self, context=None):
-        return sum([len(m.rdflib_graph()) for m in self._all_predicate_shard_models()])
+        '''Sums the triple_count of every predicate GraphShard using a projection query, 
+           so only GraphShards with GraphShardDeltas or without a triple_count need to be loaded.
+           The result is cached in Memcache under a key including the generation(), which changes after every write.
+           The queries are eventually consistent, so a total counted right after a write may miss it. It is therefore
+           only cached for _LEN_CACHE_SECONDS.
+           If this NDBStore is context aware and context is None, the lengths of all contexts are summed.
+        '''
+        if self.context_aware:
+            if context is not None:
+                return len(self._context_store(context))
+            return sum([len(self._context_store(identifier)) for identifier in self._contexts()])
+        len_key = self._len_memcache_key() #Before counting, so a total that misses a concurrent write is cached for the old generation
+        total = memcache.get(len_key)
+        if total is not None:
+            return total
+        total = 0
+        counted = set()
+        uncounted = list()
+        for m in GraphShard.query(GraphShard.graph_ID == self._ID, projection = [GraphShard.delta_count, GraphShard.triple_count]):
+            if m.spo() == 'p':
+                counted.add(m.key)
+                if m.delta_count > 0 or m.triple_count is None:
+                    uncounted.append(m.key)
+                else:
+                    total += m.triple_count
+        #GraphShards written before triple_count was introduced are not found by the projection query
+        for key in GraphShard.query(GraphShard.graph_ID == self._ID).iter(keys_only = True):
+            if key.id().startswith('p-') and key not in counted:
+                uncounted.append(key)
+        if len(uncounted) > 0:
+            logging.debug('Loading {} GraphShards without an exact triple_count'.format(len(uncounted)))
+            total += sum([len(m.rdflib_graph()) for m in ndb.get_multi(uncounted) if m is not None and not m.is_split])
+        memcache.add(len_key, total, _LEN_CACHE_SECONDS)
+        return total
+    
+    def warm_up(self, patterns = (), queries = (), max_shards = 200):
+        '''Prepares this instance for serving queries, e.g. from a warm-up request: Loads GraphShards into the local cache,
+           imports the SPARQL query evaluator and prepares the given queries (see rdflib_appengine.evaluator.prepare()).
+           @param patterns: Triple patterns whose GraphShards are loaded, like for prefetch()
+           @param queries: The texts of common SPARQL queries. If none are given, a trivial query is prepared to initialize the SPARQL parser.
+           @param max_shards: The maximal number of the GraphShards stored by remember_hot_shards() to load
+           @return A dict with the number of 'shards' loaded, the number of 'queries' prepared and the 'seconds' taken
+        '''
+        begin = time()
+        #Step 1: Load the GraphShards that were hot on other instances, and those for the given patterns
+        ids = (memcache.get(self._hot_shards_memcache_key()) or [])[:max_shards]
+        models = [m for m in ndb.get_multi([ndb.Key(GraphShard, key_id) for key_id in ids]) if m is not None and not m.is_split]
+        GraphShard.rdflib_graphs(models)
+        self.prefetch(patterns)
+        #Step 2: Import the query evaluator and parse the queries
+        from rdflib_appengine.evaluator import prepare
+        queries = list(queries) or [_WARM_UP_QUERY]
+        for query in queries:
+            prepare(query)
+        no_of_shards = len([key for key in GraphShard.cached_keys() if self._owns(_graph_ID_of(key))])
+        logging.info('Warmed up {} with {} GraphShards and {} queries in {:.3f}s'.format(self._ID, no_of_shards, len(queries), time() - begin))
+        return {'shards' : no_of_shards, 'queries' : len(queries), 'seconds' : time() - begin}
+
+    def remember_hot_shards(self, max_shards = 200):
+        '''Records the GraphShards of this graph most recently used by this instance in Memcache, for warm_up() on new instances.
+           Call this now and then, e.g. after every hundred queries.
+           @param max_shards: The maximal number of GraphShards to record
+           @return The number of GraphShards recorded
+        '''
+        ids = [key.id() for key in GraphShard.cached_keys() if self._owns(_graph_ID_of(key))][:max_shards]
+        memcache.set(self._hot_shards_memcache_key(), ids)
+        return len(ids)
+
+    def _owns(self, graph_ID):
+        '''@return True if the given graph_ID is that of this graph, or of one of its contexts, see _context_store()
+        '''
+        return graph_ID == self._ID or graph_ID.startswith(self._ID + '@')
+
+    def _hot_shards_memcache_key(self):
+        '''@return The key used for storing the ids of the GraphShards recorded by remember_hot_shards() in Memcache
+        '''
+        return 'hot_shards({})'.format(self._ID)
+
+    def query(self, query, initNs, initBindings, queryGraph, **kwargs):
+        '''Called by Graph.query() before rdflib evaluates a query. Imports the custom SPARQL query evaluator, 
+           which registers itself in rdflib, then lets rdflib evaluate the query.
+           @raise NotImplementedError: Always, so rdflib evaluates the query
+        '''
+        import rdflib_appengine.evaluator #Registers the evaluator
+        raise NotImplementedError
+
+    def update(self, update, initNs, initBindings, queryGraph, **kwargs):
+        '''Called by Graph.update(). Evaluates updates that only insert and delete triples with batched writes, see 
+           rdflib_appengine.evaluator.evalUpdateWithBatchedWrites(). Imports the custom SPARQL query evaluator, like query().
+           @raise NotImplementedError: If the update uses other operations, or if this NDBStore is context aware, so rdflib evaluates it instead
+        '''
+        from rdflib_appengine.evaluator import evalUpdateWithBatchedWrites
+        if queryGraph == '__UNION__' or self.context_aware:
+            raise NotImplementedError
+        return evalUpdateWithBatchedWrites(Graph(store = self, identifier = queryGraph), update, initNs, initBindings)
+
+    def generation(self):
+        '''The generation of this graph changes after every write, so it can be part of keys for caching data derived from the graph,
+           e.g. query results, which are then invalidated by writes without any scanning. See rdflib_appengine.querycache.
+           The generation is kept in Memcache. If it is evicted, it restarts from the current time, which differs from earlier generations.
+           @return The generation, an int
+        '''
+        generation = memcache.get(self._generation_memcache_key())
+        if generation is None:
+            memcache.add(self._generation_memcache_key(), _initial_generation())
+            generation = memcache.get(self._generation_memcache_key())
+        return generation
+    
+    def _bump_generation(self):
+        '''Changes the generation of this graph. Call this after the datastore writes of every change have completed.
+        '''
+        memcache.incr(self._generation_memcache_key(), initial_value = _initial_generation())
+        
+    def _generation_memcache_key(self):
+        '''@return The key used for storing self.generation() in Memcache
+        '''
+        return 'generation({})'.format(self._ID)
+    
+    def _len_memcache_key(self):
+        '''@return The key used for caching len(self) in Memcache, for the current generation()
+        '''
+        return 'len({},{})'.format(self._ID, self.generation())
 
     def __contexts(self):
         '''Empty generator
         '''
         if False:
             yield
-# ------------------------------------------------------------------------
-# The following defines the custom SPARQL query evaluator for Graphs backed by an NDBStore
- 
-def _evalPartWithLoggingAndLazyJoins(ctx, part):
-    '''Supplement to rdflib.plugins.sparql.evaluate.evalPart().
-       Only active when ctx.graph is backed by an NDBStore
-       Dumps any SELECT query to the NDBStores internal log.
-       Executes every join as a lazy join.
+'''The maximal size of a value stored by _set_multi_chunked(), leaving room below Memcache's limit of 1MB per value'''
+_MEMCACHE_CHUNK_SIZE = 1000000 - 10000
+
+def _set_multi_chunked(mapping, time = 0):
+    '''Stores strs of any size in Memcache, compressed, using one batched round trip.
+       A value too large for Memcache after compression is split into chunks stored under separate keys.
+       The value stored under the key itself then holds the number of chunks and a random token, which is part of the
+       keys of the chunks. Hence chunks from different calls are never mixed, and deleting the key invalidates all the chunks.
+       @param mapping: A dict mapping keys to strs
+       @param time: The expiration time, see memcache.set_multi()
     '''
-    if not isinstance(ctx.graph.store, NDBStore):
-        raise NotImplementedError
-    if part.name == 'SelectQuery':
-        s = StringIO()
-        _dump(part, '', s)
-        ctx.graph.store.log(s.getvalue())
-        raise NotImplementedError
-    elif part.name == 'Join':
-        return evalLazyJoin(ctx, part)
-    else:
-        raise NotImplementedError
+    values = dict()
+    for (key, data) in mapping.iteritems():
+        data = zlib.compress(data, 1)
+        if len(data) <= _MEMCACHE_CHUNK_SIZE:
+            values[key] = data
+            continue
+        token = '{:08x}'.format(randrange(16 ** 8))
+        chunks = [data[i:i + _MEMCACHE_CHUNK_SIZE] for i in xrange(0, len(data), _MEMCACHE_CHUNK_SIZE)]
+        for (index, chunk) in enumerate(chunks):
+            values[_chunk_key(key, token, index)] = chunk
+        values[key] = (len(chunks), token)
+    if len(values) > 0:
+        memcache.set_multi(values, time)
+
+def _get_multi_chunked(keys):
+    '''Retrieves strs stored by _set_multi_chunked(), using one batched round trip, plus one for all chunks if any value was split.
+       @param keys: A list of keys
+       @return A dict mapping each of the keys that was found, with all its chunks, to its str
+    '''
+    found = memcache.get_multi(keys)
+    chunk_keys = [_chunk_key(key, value[1], index) for (key, value) in found.iteritems() if isinstance(value, tuple) for index in xrange(value[0])]
+    chunks = memcache.get_multi(chunk_keys) if len(chunk_keys) > 0 else {}
+    result = dict()
+    for (key, value) in found.iteritems():
+        if isinstance(value, tuple):
+            parts = [chunks.get(_chunk_key(key, value[1], index)) for index in xrange(value[0])]
+            if None in parts:
+                continue #A chunk has been evicted
+            value = ''.join(parts)
+        result[key] = zlib.decompress(value)
+    return result
+
+def _chunk_key(key, token, index):
+    return '{}#{}#{}'.format(key, token, index)
+
+'''The number of keys deleted by each batch in _delete_graph(), and the maximal number of batches in flight'''
+_DELETE_BATCH_SIZE = 500
+_DELETE_BATCHES_IN_FLIGHT = 8
+
+def _delete_graph(graph_ID):
+    '''Deletes every GraphShard, GraphShardDelta and PredicateStats of a graph, with several asynchronous batches in flight.
+       Also deletes the BulkLoads recording loads into the graph, so loading again with the same load_id writes the triples again.
+       Module level, so it can be deferred.
+       @param graph_ID: The graph_ID of the entities to delete
+    '''
+    from rdflib_appengine.bulkload import BulkLoad #bulkload imports this module
+    in_flight = deque()
+    deleted = 0
+    for model_class in [GraphShard, GraphShardDelta, PredicateStats, BulkLoad]:
+        keys = model_class.query(model_class.graph_ID == graph_ID).iter(keys_only = True, batch_size = _DELETE_BATCH_SIZE)
+        while True:
+            batch = list(islice(keys, _DELETE_BATCH_SIZE))
+            if len(batch) == 0:
+                break
+            if len(in_flight) == _DELETE_BATCHES_IN_FLIGHT:
+                for future in in_flight.popleft():
+                    future.check_success()
+            in_flight.append(ndb.delete_multi_async(batch))
+            deleted += len(batch)
+    for futures in in_flight:
+        for future in futures:
+            future.check_success()
+    logging.debug('Deleted {} entities of {}'.format(deleted, graph_ID))
+
+def _versioned_graph_ID(identifier, version):
+    '''@return The graph_ID of the given version of the versioned NDBStore with the given identifier
+    '''
+    return identifier if version == 0 else '{}~{}'.format(identifier, version)
+
+@ndb.transactional
+def _reserve_version(identifier):
+    '''@return A new version of the versioned NDBStore with the given identifier, never returned before
+    '''
+    pointer = GraphPointer.get_by_id(identifier) or GraphPointer(id = identifier, graph_ID = identifier)
+    pointer.latest = max(pointer.latest, pointer.version) + 1
+    pointer.put()
+    return pointer.latest
+
+@ndb.transactional
+def _switch_version(identifier, version, graph_ID):
+    '''Switches the GraphPointer of a versioned NDBStore to the given version, unless a later version is already in use.
+       @return The graph_ID of the version no longer used: The version replaced, or the given version
+    '''
+    pointer = GraphPointer.get_by_id(identifier)
+    if pointer.version > version:
+        return graph_ID
+    obsolete = pointer.graph_ID
+    pointer.graph_ID = graph_ID
+    pointer.version = version
+    pointer.put()
+    return obsolete
+
+def _graph_ID_of(key):
+    '''@param key: The key of a GraphShard
+       @return The graph_ID of the GraphShard, which follows the third '-' in the key's id
+    '''
+    return key.id().split('-', 3)[3]
+
+def _identifier_of(context):
+    '''@param context: A Graph, the identifier of a context, or None for the default graph of a Dataset
+       @return The identifier of the context
+    '''
+    if context is None:
+        return DATASET_DEFAULT_GRAPH_ID
+    return context.identifier if isinstance(context, Graph) else context
+
+def _placeholder(term):
+    '''@param term: A large URIRef or Literal, see NDBStore._stored_form()
+       @return A term of the same kind, language and datatype, whose lexical form is _PLACEHOLDER_PREFIX followed by the sha1() of the term
+    '''
+    if isinstance(term, Literal):
+        return Literal(_PLACEHOLDER_PREFIX + sha1(term), lang = term.language, datatype = term.datatype)
+    return URIRef(_PLACEHOLDER_PREFIX + sha1(term))
+
+def _is_placeholder(term):
+    return isinstance(term, (URIRef, Literal)) and term.startswith(_PLACEHOLDER_PREFIX)
+
+def _resolve(term, values):
+    '''@param term: An rdflib term read from a GraphShard
+       @param values: A dict from LargeTerm.get_values()
+       @return The term, or the term a placeholder stands for. A placeholder whose LargeTerm is missing is returned as is.
+    '''
+    if not _is_placeholder(term):
+        return term
+    value = values.get(term[len(_PLACEHOLDER_PREFIX):])
+    if value is None:
+        return term
+    if isinstance(term, Literal):
+        return Literal(value, lang = term.language, datatype = term.datatype)
+    return URIRef(value)
+
+def _matches(triple, pattern):
+    '''@return True if the given triple matches the given triple pattern, in which any of s, p and o may be ANY
+    '''
+    return all([x == ANY or x == y for (x, y) in zip(pattern, triple)])
+
+def _sub_shard_index(s, no_of_sub_shards):
+    '''@param s: A subject
+       @param no_of_sub_shards: A value in _VALID_NO_SHARDS
+       @return The index of the sub-shard for the subject, according to the last hex digits of its SHA1
+    '''
+    if no_of_sub_shards == 1:
+        return 0
+    return int(sha1(s)[-_NO_OF_SHARDS_TO_NO_OF_HEX_DIGITS[no_of_sub_shards]:], 16)
+
+def _initial_generation():
+    '''@return A generation for a graph whose generation is not in Memcache, larger than any generation before it was evicted
+               unless the graph was written more than a million times per second.
+    '''
+    return int(time() * 1000000)
+
+def _new_changes():
+    '''@return A pair of empty sets, for triples to add and triples to remove, respectively
+    '''
+    return (set(), set())
+
+def _plan(store, bgp, bound):
+    '''Orders triple patterns greedily: The next pattern is the one with the fewest estimated matches (see NDBStore.estimate()), 
+       given the variables bound by the previous patterns. Patterns sharing a variable with those already chosen go first,
+       to avoid cross products. Ties keep the original order. Property paths are estimated to match everything.
+       @param store: An NDBStore
+       @param bgp: A list of triple patterns
+       @param bound: A set of the variables bound before the patterns are evaluated
+       @return A list of pairs (triple pattern, estimated number of matches for each binding)
+    '''
+    bound = set(bound)
+    remaining = list(bgp)
+    plan = list()
+    while len(remaining) > 0:
+        candidates = [pattern for pattern in remaining if any([term in bound for term in pattern if _is_variable(term)])]
+        if len(candidates) == 0:
+            candidates = remaining
+        estimates = [(_estimate(store, pattern, bound), index) for (index, pattern) in enumerate(candidates)]
+        (estimate, index) = min(estimates)
+        pattern = candidates[index]
+        plan.append((pattern, estimate))
+        remaining.remove(pattern)
+        bound.update([term for term in pattern if _is_variable(term)])
+    return plan
+
+def _estimate(store, (s, p, o), bound):
+    if not isinstance(p, Node):
+        return float('inf') #A property path
+    free = [_is_variable(term) and term not in bound for term in (s, p, o)]
+    return store.estimate((ANY if free[0] else s, ANY if _is_variable(p) else p, ANY if free[2] else o))
 
-def _dump(part, indent, dest):
-    '''Pretty printer for a SPARQL query parsed by rdflib.
-       The query will be written on multiple lines.
-       @param part: Part of a parsed SPARQL query
-       @param indent: A string that is prepended to every lines printed for this part of the query
-       @param dest: A file-like object to which the output is written
+def _is_variable(term):
+    '''@return True if the given term from a triple pattern is a variable. Blank nodes in SPARQL queries act as variables.
     '''
-    if part is None:
-        return None
-    if part.name == 'BGP':
-        dest.write('{}{} {:04d} triples={}\n'.format(indent, part.name, id(part) % 10000, part.triples))
-        return
-    if part.name == 'Extend':
-        dest.write('{}{} {:04d} {}={}\n'.format(indent, part.name, id(part) % 10000, part.var, part.expr))
-    else:
-        dest.write('{}{} {:04d}\n'.format(indent, part.name, id(part) % 10000))
-    for attr in ['p', 'p1', 'p2']:
-        if hasattr(part, attr):
-            child  = getattr(part, attr)
-            if child is not None:
-                _dump(child, '{}  '.format(indent), dest)
-    return
-
-'''Register the above SPARQL query evaluator in rdflib'''
-CUSTOM_EVALS['ndbstore'] = _evalPartWithLoggingAndLazyJoins
-logging.info('Activated specialized query evaluation in rdflib')
+    return isinstance(term, (Variable, BNode))
@@ -0,0 +1,126 @@
+'''
+A cache for serialized SPARQL query results over Graphs backed by an NDBStore.
+
+Results are cached by the normalized text of the query and the generation of the graph, see NDBStore.generation().
+Every write to the graph changes its generation, so cached results are never served after a write,
+and nothing needs to be scanned or deleted: Stale results are simply never asked for again and eventually evicted.
+Results are cached both in the memory of this instance (least recently used first out) and in Memcache.
+'''
+
+from google.appengine.api import memcache
+from collections import OrderedDict
+import hashlib
+import re
+
+'''Matches string literals, IRIs and comments in SPARQL, and whitespace outside these'''
+_TOKEN = re.compile(r'''("""(?:[^\\]|\\.)*?"""|\'\'\'(?:[^\\]|\\.)*?\'\'\'|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|<[^<>"{}|^`\\\s]*>)|(?:#[^\n]*|\s)+''')
+
+def normalize(query):
+    '''Normalizes the text of a SPARQL query, so trivially different texts of the same query are cached as one.
+       Comments are removed and whitespace is collapsed, except within string literals and IRIs.
+       @param query: The text of a SPARQL query
+       @return The normalized text
+    '''
+    return _TOKEN.sub(lambda m: m.group(1) or ' ', query).strip()
+
+class QueryCache(object):
+    '''A cache of serialized query results, see the module documentation.
+    '''
+    def __init__(self, max_bytes = 10000000, memcache_seconds = 3600):
+        '''@param max_bytes: The maximal total length of the results cached in memory
+           @param memcache_seconds: The time results are kept in Memcache
+        '''
+        assert isinstance(max_bytes, int) and max_bytes >= 0, 'max_bytes must be a non-negative integer, not {}'.format(max_bytes)
+        self._max_bytes = max_bytes
+        self._memcache_seconds = memcache_seconds
+        self._entries = OrderedDict() #Maps a key to a result, least recently used first
+        self._bytes = 0
+        self.reset_stats()
+
+    def query(self, graph, query, format = 'json'):
+        '''Evaluates a SPARQL query and serializes the result, unless the serialized result is cached.
+           @param graph: An rdflib.Graph backed by an NDBStore
+           @param query: The text of a SPARQL query
+           @param format: The format to serialize the result in, see rdflib.query.Result.serialize()
+           @return A pair (result, is_hit), where result is the serialized result,
+                   and is_hit is True if the result was found in the cache
+        '''
+        key = self.key(graph.store, query, format)
+        result = self.get(key)
+        if result is not None:
+            return (result, True)
+        result = graph.query(query).serialize(format = format)
+        self.put(key, result)
+        return (result, False)
+
+    def key(self, store, query, format):
+        '''Finds the key for a query result. Find the key before evaluating the query, 
+           so a result evaluated while the graph is written is cached for the generation before the write.
+           @param store: An NDBStore
+           @param query: The text of a SPARQL query
+           @param format: The format of the serialized result
+           @return The key for the query's result in Memcache and in memory, e.g. 'query(default-graph,1420800000000000,json,0beec7b5...)'
+        '''
+        digest = hashlib.sha1(normalize(query).encode('utf-8')).hexdigest()
+        return 'query({},{},{},{})'.format(store._ID, store.generation(), format, digest)
+
+    def get(self, key):
+        '''@param key: A key from key()
+           @return The cached serialized result, or None if not cached
+        '''
+        result = self._entries.pop(key, None)
+        if result is not None:
+            self._entries[key] = result
+            self._stats['local_hits'] += 1
+            return result
+        result = memcache.get(key)
+        if result is not None:
+            self._stats['memcache_hits'] += 1
+            self._put_local(key, result)
+            return result
+        self._stats['misses'] += 1
+        return None
+
+    def put(self, key, result):
+        '''Caches a serialized result. Results too large for Memcache are only cached in memory.
+           @param key: A key from key(), found before the query was evaluated
+           @param result: The serialized result, a str
+        '''
+        self._put_local(key, result)
+        try:
+            memcache.set(key, result, self._memcache_seconds)
+        except ValueError:
+            pass #The result exceeds the size limit of Memcache
+
+    def clear(self):
+        '''Removes all results from the memory of this instance, but not from Memcache.
+        '''
+        self._entries.clear()
+        self._bytes = 0
+
+    def reset_stats(self):
+        '''Sets all counters to 0.
+        '''
+        self._stats = {'local_hits' : 0, 'memcache_hits' : 0, 'misses' : 0, 'evictions' : 0}
+
+    def stats(self):
+        '''@return A dict containing the counters 'local_hits', 'memcache_hits', 'misses' and 'evictions',
+                   and the current 'entries' and 'bytes' in memory.
+        '''
+        stats = dict(self._stats)
+        stats['entries'] = len(self._entries)
+        stats['bytes'] = self._bytes
+        return stats
+
+    def _put_local(self, key, result):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        if len(result) > self._max_bytes:
+            return
+        self._entries[key] = result
+        self._bytes += len(result)
+        while self._bytes > self._max_bytes:
+            (_, evicted) = self._entries.popitem(last = False)
+            self._bytes -= len(evicted)
+            self._stats['evictions'] += 1
@@ -0,0 +1,272 @@
+'''
+A compact binary format for the triples stored in a GraphShard.
+
+The format replaces N3 text, which must be run through rdflib's N3 parser on every cold read.
+A binary shard decodes directly into an rdflib.Graph without any parsing of RDF syntax.
+
+Layout of version 2 (all integers are unsigned LEB128 varints, all strings are UTF-8 prefixed by their length in bytes):
+  * The magic bytes 'NDBS' followed by one byte holding the format version
+  * The number of shared strings, followed by the shared strings. These are the namespaces of URIRefs
+    and the datatypes and language tags of Literals, which are typically shared by many terms.
+  * The number of terms, followed by the term table. Each term is one byte holding its kind, followed by
+      - 'U' (URIRef): the id of its namespace in the shared strings, and its local name
+      - 'B' (BNode): its label
+      - 'L' (Literal without datatype or language): its lexical form
+      - 'T' (Literal with a datatype): its lexical form, and the id of its datatype in the shared strings
+      - 'G' (Literal with a language): its lexical form, and the id of its language tag in the shared strings
+  * The number of subjects, followed by the triples grouped by subject and then by predicate: For each subject a term reference
+    and the number of predicates, and for each of those a term reference to the predicate, the number of objects and a term 
+    reference to each object. The terms are numbered in the order they are first referenced. A reference is 0 for the first 
+    reference to a term, and the term's number plus 1 for later references.
+Like N3, this writes each namespace once and each subject and predicate once per group of triples.
+
+Version 1 used unsigned 32 bit little-endian integers, stored full URIs, datatypes and language tags with every term,
+and 3 term ids per triple. It is still decoded, as GraphShards written in it are only rewritten when next compacted.
+'''
+
+from rdflib.term import URIRef, BNode, Literal
+from collections import defaultdict
+from array import array
+from struct import Struct, error as StructError
+import re
+import sys
+
+MAGIC = 'NDBS'
+
+VERSION = 2
+
+_HEADER = Struct('<4sB')
+_UINT32 = Struct('<I')
+
+_KIND_OF_TERM = ((URIRef, 'U'), (BNode, 'B'), (Literal, 'L')) #Order matters as all terms are unicode
+
+'''Splits a URI into its namespace, ending with its last '/' or '#', and its local name'''
+_NAMESPACE_AND_LOCAL_NAME = re.compile(r'^(.*[/#])?(.*)$', re.DOTALL)
+
+def is_binary(data):
+    '''@param data: A str, or None
+       @return True if the given data is a binary encoded GraphShard of any version
+    '''
+    return data is not None and data[:len(MAGIC)] == MAGIC
+
+def encode(triples):
+    '''Encodes triples in the binary format.
+       @param triples: An iterable of (s, p, o) triples of rdflib terms, e.g. an rdflib.Graph
+       @return A str containing the binary encoded triples
+    '''
+    groups = defaultdict(lambda: defaultdict(list)) #Maps a subject to a dict mapping a predicate to objects
+    for (s, p, o) in triples:
+        groups[s][p].append(o)
+    #Number the terms in the order they are first used by the grouped triples, see _append_term_id()
+    term_ids = dict()
+    terms = list()
+    triples_part = bytearray()
+    _append_varint(triples_part, len(groups))
+    for (s, predicates) in groups.iteritems():
+        _append_term_id(triples_part, term_ids, terms, s)
+        _append_varint(triples_part, len(predicates))
+        for (p, objects) in predicates.iteritems():
+            _append_term_id(triples_part, term_ids, terms, p)
+            _append_varint(triples_part, len(objects))
+            for o in objects:
+                _append_term_id(triples_part, term_ids, terms, o)
+    string_ids = dict()
+    strings = list()
+    def string_id(u):
+        sid = string_ids.get(u)
+        if sid is None:
+            sid = len(strings)
+            string_ids[u] = sid
+            strings.append(u)
+        return sid
+    body = bytearray()
+    _append_varint(body, len(terms))
+    for term in terms:
+        kind = _kind(term)
+        if kind == 'U':
+            (namespace, local_name) = _NAMESPACE_AND_LOCAL_NAME.match(term).groups()
+            body.append('U')
+            _append_varint(body, string_id(namespace or u''))
+            _append_string(body, local_name)
+        elif kind == 'B':
+            body.append('B')
+            _append_string(body, term)
+        elif term.datatype is not None:
+            body.append('T')
+            _append_string(body, term)
+            _append_varint(body, string_id(term.datatype))
+        elif term.language is not None:
+            body.append('G')
+            _append_string(body, term)
+            _append_varint(body, string_id(term.language))
+        else:
+            body.append('L')
+            _append_string(body, term)
+    body.extend(triples_part)
+    out = bytearray(_HEADER.pack(MAGIC, VERSION))
+    _append_varint(out, len(strings))
+    for u in strings:
+        _append_string(out, u)
+    out.extend(body)
+    return str(out)
+
+def decode(data, graph):
+    '''Adds triples in the binary format to a graph.
+       @param data: A str as returned by encode(), in any supported version of the binary format
+       @param graph: The rdflib.Graph to add the triples to
+       @return The given graph
+       @raise ValueError: If data is not in a supported version of the binary format, or is truncated
+    '''
+    if len(data) < _HEADER.size:
+        raise ValueError('Truncated binary encoded GraphShard')
+    (magic, version) = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a binary encoded GraphShard')
+    if version == 1:
+        return _decode_v1(data, graph)
+    if version != VERSION:
+        raise ValueError('Unsupported version {} of binary encoded GraphShard'.format(version))
+    try:
+        return _decode_v2(bytearray(data), graph)
+    except IndexError:
+        raise ValueError('Truncated binary encoded GraphShard')
+
+def _decode_v2(data, graph):
+    offset = _HEADER.size
+    (no_of_strings, offset) = _read_varint(data, offset)
+    strings = list()
+    for _ in xrange(no_of_strings):
+        (u, offset) = _read_string(data, offset)
+        strings.append(u)
+    (no_of_terms, offset) = _read_varint(data, offset)
+    terms = list()
+    for _ in xrange(no_of_terms):
+        kind = chr(data[offset])
+        if kind == 'U':
+            (namespace, offset) = _read_varint(data, offset + 1)
+            (local_name, offset) = _read_string(data, offset)
+            terms.append(URIRef(strings[namespace] + local_name))
+            continue
+        (lexical, offset) = _read_string(data, offset + 1)
+        if kind == 'B':
+            terms.append(BNode(lexical))
+        elif kind == 'L':
+            terms.append(Literal(lexical))
+        elif kind == 'T':
+            (datatype, offset) = _read_varint(data, offset)
+            terms.append(Literal(lexical, datatype = URIRef(strings[datatype])))
+        elif kind == 'G':
+            (language, offset) = _read_varint(data, offset)
+            terms.append(Literal(lexical, lang = strings[language]))
+        else:
+            raise ValueError('Unknown term kind {!r} in binary encoded GraphShard'.format(kind))
+    (no_of_subjects, offset) = _read_varint(data, offset)
+    quads = list()
+    used = [0] #The number of terms used so far, see _append_term_id()
+    def term(offset):
+        (term_id, offset) = _read_varint(data, offset)
+        if term_id == 0:
+            term_id = used[0]
+            used[0] += 1
+        else:
+            term_id -= 1
+        return (terms[term_id], offset)
+    for _ in xrange(no_of_subjects):
+        (s, offset) = term(offset)
+        (no_of_predicates, offset) = _read_varint(data, offset)
+        for _ in xrange(no_of_predicates):
+            (p, offset) = term(offset)
+            (no_of_objects, offset) = _read_varint(data, offset)
+            for _ in xrange(no_of_objects):
+                (o, offset) = term(offset)
+                quads.append((s, p, o, graph))
+    graph.addN(quads)
+    return graph
+
+def _decode_v1(data, graph):
+    try:
+        offset = _HEADER.size
+        (no_of_terms, ) = _UINT32.unpack_from(data, offset)
+        offset += _UINT32.size
+        terms = list()
+        for _ in xrange(no_of_terms):
+            kind = data[offset]
+            (lexical, offset) = _read_string_v1(data, offset + 1)
+            if kind == 'U':
+                terms.append(URIRef(lexical))
+            elif kind == 'B':
+                terms.append(BNode(lexical))
+            elif kind == 'L':
+                (language, offset) = _read_string_v1(data, offset)
+                (datatype, offset) = _read_string_v1(data, offset)
+                terms.append(Literal(lexical, lang = language or None, datatype = URIRef(datatype) if datatype else None))
+            else:
+                raise ValueError('Unknown term kind {!r} in binary encoded GraphShard'.format(kind))
+        (no_of_triples, ) = _UINT32.unpack_from(data, offset)
+    except (IndexError, StructError):
+        raise ValueError('Truncated binary encoded GraphShard')
+    offset += _UINT32.size
+    ids = array('I')
+    ids.fromstring(data[offset:offset + 3 * no_of_triples * ids.itemsize])
+    if sys.byteorder != 'little':
+        ids.byteswap()
+    if len(ids) != 3 * no_of_triples:
+        raise ValueError('Truncated binary encoded GraphShard')
+    graph.addN((terms[ids[i]], terms[ids[i + 1]], terms[ids[i + 2]], graph) for i in xrange(0, len(ids), 3))
+    return graph
+
+def _kind(term):
+    for (cls, kind) in _KIND_OF_TERM:
+        if isinstance(term, cls):
+            return kind
+    raise ValueError('Cannot encode {!r} in a GraphShard'.format(term))
+
+def _append_term_id(out, term_ids, terms, term):
+    '''Appends a reference to a term to the triples part: 0 for the first use of a term, which is then given the next term id,
+       and the term id plus 1 for later uses. Terms used once, like most objects, thus cost a single, very compressible byte.
+    '''
+    term_id = term_ids.get(term)
+    if term_id is None:
+        term_ids[term] = len(terms)
+        terms.append(term)
+        out.append(0)
+    else:
+        _append_varint(out, term_id + 1)
+
+def _append_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(data, offset):
+    byte = data[offset]
+    if byte < 0x80:
+        return (byte, offset + 1)
+    value = byte & 0x7f
+    shift = 7
+    while True:
+        offset += 1
+        byte = data[offset]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, offset + 1)
+        shift += 7
+
+def _append_string(out, u):
+    encoded = u.encode('utf-8')
+    _append_varint(out, len(encoded))
+    out.extend(encoded)
+
+def _read_string(data, offset):
+    (length, offset) = _read_varint(data, offset)
+    if offset + length > len(data):
+        raise IndexError('String beyond the end of the data')
+    return (data[offset:offset + length].decode('utf-8'), offset + length)
+
+def _read_string_v1(data, offset):
+    (length, ) = _UINT32.unpack_from(data, offset)
+    offset += _UINT32.size
+    if offset + length > len(data):
+        raise IndexError('String beyond the end of the data')
+    return (data[offset:offset + length].decode('utf-8'), offset + length)
@@ -0,0 +1,71 @@
+'''
+Streams SPARQL query results in the application/sparql-results+json format.
+
+rdflib's JSON serializer builds the whole result set in memory before writing any of it.
+iter_json() instead pulls the solutions one at a time from the query evaluator and yields the JSON in chunks,
+so memory use does not grow with the number of solutions, and the first chunks can be sent before the last solution is found
+by WSGI servers that stream responses. Note that App Engine's Python 2.7 runtime buffers the whole response before sending it,
+so there the time to the first byte is not reduced. Only the memory for building the result as rdflib objects and a JSON document 
+is saved.
+Since the query evaluator for NDBStore evaluates lazily, stopping the iteration (or closing the generator, as WSGI servers do)
+stops reading GraphShards too.
+'''
+
+from rdflib_appengine.evaluator import prepare
+from rdflib.plugins.sparql.evaluate import evalQuery
+from rdflib.plugins.sparql.results.jsonresults import termToJSON
+from itertools import islice
+import json
+import logging
+
+def iter_json(graph, query, max_rows = None, rows_per_chunk = 100):
+    '''Evaluates a SELECT or ASK query, returning a generator yielding the result in the application/sparql-results+json format.
+       The query is parsed and its evaluation started before this function returns, so an invalid query raises here, 
+       before a web server has sent a status, rather than while the result is being sent.
+       @param graph: An rdflib.Graph, e.g. backed by an NDBStore
+       @param query: The text of a SPARQL query
+       @param max_rows: None, or the maximal number of solutions to return. If there are more, the result object has
+                        "truncated": true next to the bindings. Only one solution beyond max_rows is evaluated, to find out.
+       @param rows_per_chunk: The number of solutions in each yielded chunk
+       @return A generator yielding strs
+       @raise ValueError: If the query is not a SELECT or ASK query
+       @raise pyparsing.ParseException: If the query is not valid SPARQL
+    '''
+    res = evalQuery(graph, prepare(query), {})
+    if res['type_'] == 'ASK':
+        return iter([json.dumps({'head' : {}, 'boolean' : res['askAnswer']})])
+    if res['type_'] != 'SELECT':
+        raise ValueError('Only SELECT and ASK results can be written as application/sparql-results+json, not {}'.format(res['type_']))
+    return _iter_select(res, query, max_rows, rows_per_chunk)
+
+def _iter_select(res, query, max_rows, rows_per_chunk):
+    '''Generator yielding the JSON for the result of a SELECT query, see iter_json().
+    '''
+    bindings = iter(res['bindings'])
+    try:
+        yield '{{"head": {}, "results": {{"bindings": ['.format(json.dumps({'vars' : res['vars_']}))
+        separator = ''
+        count = 0
+        truncated = False
+        while True:
+            if max_rows is not None and count == max_rows:
+                truncated = next(bindings, None) is not None
+                break
+            chunk = [_row(b) for b in islice(bindings, rows_per_chunk if max_rows is None else min(rows_per_chunk, max_rows - count))]
+            if len(chunk) == 0:
+                break
+            yield separator + ', '.join(chunk)
+            separator = ', '
+            count += len(chunk)
+        yield ('], "truncated": true}}' if truncated else ']}}')
+        if truncated:
+            logging.warn('Results of {} truncated at {} rows'.format(query, max_rows))
+    finally:
+        if hasattr(bindings, 'close'):
+            bindings.close() #Stops the evaluation of the query, if it was not complete
+
+def _row(b):
+    '''@param b: A solution, mapping Variables to rdflib terms
+       @return The solution in JSON
+    '''
+    return json.dumps(dict((var, termToJSON(None, term)) for (var, term) in b.iteritems() if term is not None))
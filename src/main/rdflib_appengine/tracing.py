@@ -0,0 +1,122 @@
+'''
+Structured tracing of the work done by an NDBStore.
+
+A Span records a timed operation, e.g. a SPARQL query or a call to NDBStore.triples(), with attributes and child Spans.
+When an NDBStore is configured with a tracer, it builds a tree of Spans for every query it evaluates
+(and for every call to triples() outside a query), and passes the root Span of each tree to the tracer when it is finished:
+
+  def tracer(span):
+      for shard in span.walk('shard'):
+          if shard.attributes['layer'] == 'datastore':
+              logging.info('{key} took {duration_ms:.1f}ms'.format(duration_ms = shard.duration_ms(), **shard.attributes))
+  g = Graph(store = NDBStore(identifier = 'current', configuration = {'tracer': tracer}))
+
+The Spans are:
+  * 'SelectQuery', 'AskQuery' or 'ConstructQuery': One SPARQL query. Attributes: solutions (SELECT only).
+  * 'plan': The order chosen for a basic graph pattern. Attributes: patterns, a list of (pattern, estimate).
+  * 'prefetch': A call to NDBStore.prefetch(). Attributes: patterns (the number of patterns), keys.
+  * 'triples': A call to NDBStore.triples(). Attributes: pattern, route ('s', 'p', 'o' or 'all'), keys, 
+                fetched (the number of GraphShard keys fetched, including children of split GraphShards), triples (the number yielded).
+  * 'shard': A GraphShard needed by one of the above. Attributes: key, layer (the layer of cache that served the GraphShard:
+             'local', 'memcache' or 'datastore'), triples, and for the datastore layer: bytes (decompressed) and deltas.
+             The duration of a 'shard' Span loaded from the datastore is its parse time.
+
+When no tracer is configured, NULL_SPAN is used instead of Spans. Its methods do nothing, so tracing costs next to nothing when disabled.
+'''
+
+from time import time
+
+class Span(object):
+    '''A timed operation with attributes and child Spans. The Span starts when it is created and ends when finish() is called.
+    '''
+    def __init__(self, name, parent = None, **attributes):
+        '''@param name: The kind of operation, e.g. 'triples'
+           @param parent: The Span this Span is part of, or None for the root of a tree of Spans
+           @param attributes: Initial attributes
+        '''
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.children = list()
+        self.start = time()
+        self.end = None
+
+    def child(self, name, **attributes):
+        '''Starts a new Span as part of this Span.
+           @return The new Span
+        '''
+        span = Span(name, self, **attributes)
+        self.children.append(span)
+        return span
+
+    def set(self, **attributes):
+        '''Sets attributes of this Span.
+        '''
+        self.attributes.update(attributes)
+
+    def finish(self):
+        '''Ends this Span.
+           @return This Span
+        '''
+        self.end = time()
+        return self
+
+    def duration_ms(self):
+        '''@return The duration of this Span in milliseconds, until now if the Span has not ended
+        '''
+        return ((self.end or time()) - self.start) * 1000
+
+    def walk(self, name = None):
+        '''Generator yielding this Span and its descendants, depth first.
+           @param name: None, or the name of the Spans to yield
+        '''
+        if name is None or self.name == name:
+            yield self
+        for child in self.children:
+            for span in child.walk(name):
+                yield span
+
+    def total(self, attribute, name = None):
+        '''@param attribute: The name of a numeric attribute, e.g. 'bytes'
+           @param name: None, or the name of the Spans to include
+           @return The sum of the attribute over this Span and its descendants
+        '''
+        return sum([span.attributes.get(attribute, 0) for span in self.walk(name)])
+
+    def to_dict(self):
+        '''@return This Span and its descendants as a dict, e.g. for serializing to JSON
+        '''
+        return {'name' : self.name,
+                'start' : self.start,
+                'duration_ms' : self.duration_ms(),
+                'attributes' : dict((k, v if isinstance(v, (int, long, float, bool)) else unicode(v)) for (k, v) in self.attributes.iteritems()),
+                'children' : [child.to_dict() for child in self.children],
+                }
+
+    def format(self, indent = ''):
+        '''@return This Span and its descendants on multiple lines, children indented below their parent
+        '''
+        attributes = ' '.join(['{}={}'.format(k, v) for (k, v) in sorted(self.attributes.iteritems())])
+        lines = ['{}{} {:.1f}ms {}'.format(indent, self.name, self.duration_ms(), attributes)]
+        lines.extend([child.format(indent + '  ') for child in self.children])
+        return '\n'.join(lines)
+
+class _NullSpan(object):
+    '''A Span that records nothing, see NULL_SPAN.
+    '''
+    parent = None
+
+    def child(self, name, **attributes):
+        return self
+
+    def set(self, **attributes):
+        pass
+
+    def finish(self):
+        return self
+
+    def __nonzero__(self):
+        return False
+
+'''Used instead of a Span when tracing is disabled. It is false in boolean context, so code can skip work needed only for tracing.'''
+NULL_SPAN = _NullSpan()
@@ -7,7 +7,7 @@ def readme():
         return f.read()
 
 setup(name='rdflib-appengine',
-      version = '1.2.0',
+      version = '1.3.0',
       description='Python distributible for using rdflib with NDB',
       long_description=readme(),
       url='https://github.com/mr-niels-christensen/rdflib-appengine',
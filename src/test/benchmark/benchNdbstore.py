@@ -0,0 +1,276 @@
+#!/usr/bin/python
+'''Measures the performance of NDBStore on the datastore and memcache stubs of the App Engine testbed:
+  * load: Throughput of addN() and of the bulk loader, in triples per second
+  * patterns: Latency of triples() for each kind of triple pattern, with cold caches and with a warm local cache
+  * queries: Latency of SPARQL queries, cold and warm
+  * startup: Cold start of a new process: The time to import rdflib_appengine.ndbstore, and the latency of the first query,
+             without and after NDBStore.warm_up(). Each is measured in a fresh Python process.
+The data is synthetic and generated from a seed, so runs with the same options measure the same work.
+The results are written as JSON. Give the JSON of an earlier run with --compare to see the relative changes.
+The stubs do not model the latency of the real services, so compare runs on the same machine only.
+'''
+import json
+import optparse
+import os
+import platform
+import random
+import subprocess
+import sys
+from StringIO import StringIO
+from time import time
+
+USAGE = """%prog [options] SDK_PATH
+Benchmark NDBStore using the App Engine testbed.
+
+SDK_PATH    Path to the SDK installation"""
+
+_NS = 'http://example.org/'
+
+def generate(seed, no_of_subjects, no_of_predicates, fanout, literal_length, literal_ratio):
+    '''Generates a synthetic graph.
+       Every subject has fanout objects for each predicate. Objects are either literals of the given length
+       (like _long_random_literal() in testIssues.py), or links to other subjects, making joins possible.
+       @param seed: The seed for the random choices, so the same parameters always generate the same triples
+       @param literal_ratio: The fraction of the objects that are literals
+       @return A list of (s, p, o) triples
+    '''
+    from rdflib.term import URIRef, Literal
+    rng = random.Random(seed)
+    subjects = [URIRef('{}s{}'.format(_NS, i)) for i in xrange(no_of_subjects)]
+    predicates = [URIRef('{}p{}'.format(_NS, i)) for i in xrange(no_of_predicates)]
+    triples = set()
+    for s in subjects:
+        for p in predicates:
+            for _ in xrange(fanout):
+                if rng.random() < literal_ratio:
+                    o = Literal(''.join([rng.choice('abcdefghijklmnopqrstuvwxyz ,') for _ in xrange(literal_length)]))
+                else:
+                    o = rng.choice(subjects)
+                triples.add((s, p, o))
+    return sorted(triples)
+
+class Benchmark(object):
+    '''Runs the workloads against a fresh testbed.
+    '''
+    def __init__(self, sdk_path, options):
+        self.sdk_path = sdk_path
+        self.options = options
+        self.configuration = json.loads(options.configuration)
+        self.triples = generate(options.seed, options.subjects, options.predicates, options.fanout, options.literal_length, options.literal_ratio)
+
+    def run(self, workloads):
+        from google.appengine.ext import testbed
+        results = dict()
+        for workload in workloads:
+            self.testbed = testbed.Testbed()
+            self.testbed.activate()
+            self.testbed.init_datastore_v3_stub()
+            self.testbed.init_memcache_stub()
+            self.rng = random.Random(self.options.seed) #Each workload makes the same choices, whichever workloads are run
+            try:
+                self._clear_caches()
+                results[workload] = getattr(self, workload)()
+            finally:
+                self.testbed.deactivate()
+        return results
+
+    def load(self):
+        from rdflib_appengine.bulkload import load
+        st = self._store('load-addn')
+        batch_size = self.options.batch_size
+        begin = time()
+        for i in xrange(0, len(self.triples), batch_size):
+            st.addN([(s, p, o, None) for (s, p, o) in self.triples[i:i + batch_size]])
+        addn_seconds = time() - begin
+        nt = ''.join([u'{} {} {} .\n'.format(s.n3(), p.n3(), o.n3()) for (s, p, o) in self.triples]).encode('utf-8')
+        begin = time()
+        load(self._store('load-bulk'), StringIO(nt), chunk_size = batch_size)
+        bulk_seconds = time() - begin
+        return {'triples' : len(self.triples),
+                'addN_triples_per_second' : len(self.triples) / addn_seconds,
+                'bulk_load_triples_per_second' : len(self.triples) / bulk_seconds,
+                }
+
+    def patterns(self):
+        from rdflib.term import URIRef
+        st = self._loaded_store()
+        samples = [self.rng.choice(self.triples) for _ in xrange(self.options.samples)]
+        kinds = {'(s,?,?)' : lambda (s, p, o): (s, None, None),
+                 '(?,p,?)' : lambda (s, p, o): (None, p, None),
+                 '(s,p,?)' : lambda (s, p, o): (s, p, None),
+                 '(?,p,o)' : lambda (s, p, o): (None, p, o),
+                 '(s,p,o)' : lambda (s, p, o): (s, p, o),
+                 '(?,?,o)' : lambda (s, p, o): (None, None, o if isinstance(o, URIRef) else URIRef(_NS + 's0')),
+                 }
+        results = dict()
+        for (kind, pattern_of) in sorted(kinds.iteritems()):
+            patterns = [pattern_of(t) for t in samples]
+            if kind == '(?,?,o)' and not self.configuration.get('no_of_object_shards'):
+                patterns = patterns[:1] #Traverses the whole graph
+            results[kind] = self._timed(patterns, lambda pattern: sum([1 for _ in st.triples(pattern)]))
+        return results
+
+    def queries(self):
+        st = self._loaded_store()
+        from rdflib import Graph
+        g = Graph(store = st)
+        s = self.rng.choice(self.triples)[0]
+        queries = {'star' : 'SELECT * WHERE {{ <{0}> <{1}p0> ?a ; <{1}p1> ?b }}'.format(s, _NS),
+                   'chain' : 'SELECT ?c WHERE {{ <{0}> <{1}p0> ?a . ?a <{1}p1> ?b . ?b <{1}p0> ?c }}'.format(s, _NS),
+                   'scan_limit' : 'SELECT ?s ?o WHERE {{ ?s <{0}p0> ?o }} LIMIT 10'.format(_NS),
+                   'join_filter' : 'SELECT ?s ?b WHERE {{ ?s <{0}p0> ?a . ?a <{0}p1> ?b FILTER (isLiteral(?b)) }}'.format(_NS),
+                   }
+        list(g.query('ASK {{ ?s <{}nothing> ?o }}'.format(_NS))) #Initializes the SPARQL parser, which is only done once per process
+        return dict((name, self._timed([q], lambda q: len(list(g.query(q))))) for (name, q) in sorted(queries.iteritems()))
+
+    def startup(self):
+        results = dict()
+        options = ['--{}={}'.format(name, getattr(self.options, name.replace('-', '_'))) 
+                   for name in ['subjects', 'predicates', 'fanout', 'literal-length', 'literal-ratio', 'seed', 'batch-size', 'configuration']]
+        for mode in ['cold', 'warm_up']:
+            args = [sys.executable, os.path.abspath(__file__), '--startup-child={}'.format(mode)] + options + [self.sdk_path]
+            results.update(json.loads(subprocess.check_output(args)))
+        return results
+
+    def startup_child(self, mode):
+        '''Measures the cold start of this process, see the module documentation. Must run before rdflib_appengine is imported.
+           @param mode: 'cold' to run the first query right away, or 'warm_up' to call NDBStore.warm_up() first
+           @return A dict with the measurements in milliseconds
+        '''
+        from google.appengine.ext import testbed
+        begin = time()
+        from rdflib_appengine.ndbstore import NDBStore
+        import_ms = 1000 * (time() - begin)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.rng = random.Random(self.options.seed)
+        st = self._loaded_store()
+        self._clear_caches()
+        from rdflib import Graph
+        g = Graph(store = st)
+        s = self.rng.choice(self.triples)[0]
+        query = 'SELECT * WHERE {{ <{0}> <{1}p0> ?a . ?a <{1}p1> ?b }}'.format(s, _NS)
+        results = {'import_ms' : import_ms}
+        if mode == 'warm_up':
+            begin = time()
+            st.warm_up(patterns = [(None, p, None) for p in set([p for (_, p, _) in self.triples])], queries = [query])
+            results['warm_up_ms'] = 1000 * (time() - begin)
+        results['{}_first_query_ms'.format(mode)] = self._time(lambda q: len(list(g.query(q))), query)
+        results['{}_second_query_ms'.format(mode)] = self._time(lambda q: len(list(g.query(q))), query)
+        return results
+
+    def _timed(self, inputs, f):
+        '''Runs f on each input with cold caches, then with a warm local cache, taking the best of the configured number of runs for each.
+           @return A dict with the median cold and warm latencies in milliseconds, and the mean number of results
+        '''
+        cold = list()
+        warm = list()
+        results = 0
+        for x in inputs:
+            cold.append(min([self._time(f, x, clear = True) for _ in xrange(self.options.repeat)]))
+            warm.append(min([self._time(f, x) for _ in xrange(self.options.repeat)]))
+            results += f(x)
+        return {'cold_ms' : _median(cold), 'warm_ms' : _median(warm), 'results' : float(results) / len(inputs)}
+
+    def _time(self, f, x, clear = False):
+        '''@return The milliseconds it takes to run f on x, after clearing all caches if clear is set
+        '''
+        if clear:
+            self._clear_caches()
+        begin = time()
+        f(x)
+        return 1000 * (time() - begin)
+
+    def _store(self, identifier):
+        from rdflib_appengine.ndbstore import NDBStore
+        return NDBStore(identifier = identifier, configuration = self.configuration)
+
+    def _loaded_store(self):
+        st = self._store('bench')
+        batch_size = self.options.batch_size
+        for i in xrange(0, len(self.triples), batch_size):
+            st.addN([(s, p, o, None) for (s, p, o) in self.triples[i:i + batch_size]])
+        st.compact()
+        return st
+
+    def _clear_caches(self):
+        from google.appengine.api import memcache
+        from google.appengine.ext import ndb
+        from rdflib_appengine.ndbstore import GraphShard
+        GraphShard._graph_cache.clear()
+        memcache.flush_all()
+        ndb.get_context().clear_cache()
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def _flatten(results, prefix = ''):
+    '''@return A dict mapping a path like 'patterns/(s,?,?)/cold_ms' to each number in the results
+    '''
+    flat = dict()
+    for (k, v) in results.iteritems():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, '{}{}/'.format(prefix, k)))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+def compare(old, new):
+    '''Prints each number in new results next to the corresponding number in old results.
+    '''
+    old = _flatten(old['results'])
+    print '{:<40} {:>14} {:>14} {:>8}'.format('measure', 'old', 'new', 'change')
+    for (k, v) in sorted(_flatten(new['results']).iteritems()):
+        if k in old and old[k]:
+            print '{:<40} {:>14.2f} {:>14.2f} {:>+7.0f}%'.format(k, old[k], v, 100.0 * (v - old[k]) / old[k])
+
+def main(sdk_path, options):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main'))
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    import logging
+    logging.getLogger().setLevel(logging.ERROR)
+    if options.startup_child:
+        print json.dumps(Benchmark(sdk_path, options).startup_child(options.startup_child))
+        return
+    import rdflib
+    benchmark = Benchmark(sdk_path, options)
+    report = {'options' : vars(options),
+              'environment' : {'python' : platform.python_version(), 'rdflib' : rdflib.__version__, 'machine' : platform.node()},
+              'results' : benchmark.run(options.workloads.split(',')),
+              }
+    output = json.dumps(report, indent = 2, sort_keys = True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--subjects', type = 'int', default = 500, help = 'Number of subjects in the generated graph')
+    parser.add_option('--predicates', type = 'int', default = 5, help = 'Number of predicates in the generated graph')
+    parser.add_option('--fanout', type = 'int', default = 2, help = 'Number of objects per subject and predicate')
+    parser.add_option('--literal-length', type = 'int', default = 100, help = 'Length of the generated literals')
+    parser.add_option('--literal-ratio', type = 'float', default = 0.5, help = 'Fraction of the objects that are literals')
+    parser.add_option('--seed', type = 'int', default = 42, help = 'Seed for generating data and choosing patterns')
+    parser.add_option('--batch-size', type = 'int', default = 1000, help = 'Number of triples per addN() call and bulk load chunk')
+    parser.add_option('--samples', type = 'int', default = 20, help = 'Number of patterns measured per kind of pattern')
+    parser.add_option('--repeat', type = 'int', default = 3, help = 'Report the best of this many warm runs')
+    parser.add_option('--configuration', default = '{}', help = 'NDBStore configuration as JSON, e.g. {"no_of_object_shards": 16}')
+    parser.add_option('--workloads', default = 'load,patterns,queries,startup', help = 'Comma separated workloads to run')
+    parser.add_option('-o', '--output', help = 'Write the results as JSON to this file instead of standard output')
+    parser.add_option('--startup-child', help = optparse.SUPPRESS_HELP) #Used by the startup workload to run a fresh process
+    parser.add_option('-c', '--compare', help = 'Compare the results with those in this JSON file from an earlier run')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    main(args[0], options)
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+'''Compares the time it takes to decode a GraphShard stored in the binary format
+from rdflib_appengine.shardformat against the legacy N3 format.
+'''
+import optparse
+import os
+import sys
+import zlib
+from time import time
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main'))
+
+from rdflib import Graph
+from rdflib.term import URIRef, Literal
+from rdflib.plugins.memory import IOMemory
+from rdflib_appengine import shardformat
+
+USAGE = """%prog [options]
+Benchmark decoding of GraphShards in the binary and N3 formats."""
+
+def _shard(no_of_triples, literal_length):
+    g = Graph(store = IOMemory())
+    for i in xrange(no_of_triples):
+        g.add((URIRef('http://example.org/s{}'.format(i % 1000)),
+               URIRef('http://example.org/p{}'.format(i % 10)),
+               Literal((uuid4().hex * (literal_length // 32 + 1))[:literal_length]) if i % 2 else URIRef('http://example.org/o{}'.format(i))))
+    return g
+
+def _best_of(repeat, f):
+    best = None
+    for _ in range(repeat):
+        begin = time()
+        f()
+        elapsed = time() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(no_of_triples, literal_length, repeat):
+    g = _shard(no_of_triples, literal_length)
+    n3 = g.serialize(format = 'n3')
+    binary = shardformat.encode(g)
+    print 'Shard with {} triples, literals of length {}'.format(len(g), literal_length)
+    print '{:>8} {:>12} {:>12} {:>12} {:>12}'.format('format', 'bytes', 'compressed', 'encode ms', 'decode ms')
+    print '{:>8} {:>12} {:>12} {:>12.1f} {:>12.1f}'.format('n3', len(n3), len(zlib.compress(n3.encode('utf-8'))),
+                                                   1000 * _best_of(repeat, lambda: g.serialize(format = 'n3')),
+                                                   1000 * _best_of(repeat, lambda: Graph(store = IOMemory()).parse(data = n3, format = 'n3')))
+    print '{:>8} {:>12} {:>12} {:>12.1f} {:>12.1f}'.format('binary', len(binary), len(zlib.compress(binary)),
+                                                   1000 * _best_of(repeat, lambda: shardformat.encode(g)),
+                                                   1000 * _best_of(repeat, lambda: shardformat.decode(binary, Graph(store = IOMemory()))))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('-n', '--triples', type = 'int', default = 10000, help = 'Number of triples in the shard')
+    parser.add_option('-l', '--literal-length', type = 'int', default = 100, help = 'Length of the literals in the shard')
+    parser.add_option('-r', '--repeat', type = 'int', default = 3, help = 'Report the best of this many runs')
+    options, args = parser.parse_args()
+    main(options.triples, options.literal_length, options.repeat)
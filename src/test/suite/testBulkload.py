@@ -0,0 +1,115 @@
+import unittest
+from rdflib_appengine.ndbstore import NDBStore, GraphShard
+from rdflib_appengine.bulkload import load, BulkLoad
+from google.appengine.ext import testbed, deferred
+from rdflib.term import URIRef, Literal, BNode
+from rdflib import Graph, ConjunctiveGraph
+from rdflib.graph import DATASET_DEFAULT_GRAPH_ID
+from StringIO import StringIO
+
+_TRIPLES = ([(URIRef('http://s{}'.format(i)), URIRef('http://p{}'.format(i % 3)), Literal(i)) for i in range(100)]
+            + [(URIRef('http://s{}'.format(i)), URIRef('http://p'), BNode('b{}'.format(i % 7))) for i in range(20)])
+
+_NT = ''.join([u'{} {} {} .\n'.format(s.n3(), p.n3(), o.n3()) for (s, p, o) in _TRIPLES]) #Serializers may change the order
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+        # Then activate the testbed, which prepares the service stubs for use.
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        GraphShard._graph_cache.clear()
+        self.st = NDBStore(identifier = 'banana')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testLoad(self):
+        progress = load(self.st, StringIO(_NT), chunk_size = 15)
+        self.assertTrue(progress.is_done)
+        self.assertEquals(len(_TRIPLES), progress.triples)
+        self._assertLoaded()
+        self.assertEquals([], BulkLoad.query().fetch()) #Nothing recorded without a load_id
+
+    def testLoadTurtle(self):
+        g = Graph()
+        g.parse(data = _NT, format = 'nt')
+        load(self.st, StringIO(g.serialize(format = 'turtle')), format = 'turtle', chunk_size = 15)
+        self._assertLoaded()
+
+    def testLoadContextAware(self):
+        self.st = NDBStore(identifier = 'banana', configuration = {'context_aware': True})
+        self.assertEquals(0, len(self.st))
+        load(self.st, StringIO(_NT), chunk_size = 15)
+        self._assertLoaded()
+        load(self.st, StringIO(_NT[:_NT.index('\n') + 1]), context = URIRef('http://c'))
+        g = ConjunctiveGraph(store = NDBStore(identifier = 'banana', configuration = {'context_aware': True}))
+        self.assertEquals(set([DATASET_DEFAULT_GRAPH_ID, URIRef('http://c')]), set([c.identifier for c in g.contexts()]))
+        self.assertEquals(set([_TRIPLES[0]]), set(g.get_context(URIRef('http://c'))))
+
+    def testResume(self):
+        update_shards_async = self.st._update_shards_async
+        calls = []
+        def failing_update_shards_async(changes):
+            calls.append(changes)
+            if len(calls) == 3:
+                raise IOError('Simulated failure')
+            return update_shards_async(changes)
+        self.st._update_shards_async = failing_update_shards_async
+        self.assertRaises(IOError, load, self.st, StringIO(_NT), chunk_size = 15, load_id = 'dump')
+        self.assertEquals(30, BulkLoad.query().get().triples)
+        progress = load(self.st, StringIO(_NT), chunk_size = 15, load_id = 'dump')
+        self.assertEquals(len(_TRIPLES), progress.triples)
+        self.assertEquals(len(_TRIPLES), BulkLoad.query().get().triples)
+        self.assertEquals(2 + 7, len(calls)) #The first two chunks are not written again
+        self._assertLoaded()
+        load(self.st, StringIO(_NT), chunk_size = 15, load_id = 'dump')
+        self.assertEquals(9, len(calls))
+
+    def testLoadAfterDestroy(self):
+        load(self.st, StringIO(_NT), chunk_size = 15, load_id = 'dump')
+        self.st.destroy(None)
+        self.assertEquals(0, len(self.st))
+        self.assertEquals([], BulkLoad.query().fetch())
+        progress = load(self.st, StringIO(_NT), chunk_size = 15, load_id = 'dump')
+        self.assertEquals(len(_TRIPLES), progress.triples)
+        self._assertLoaded()
+
+    def testReplace(self):
+        self.testbed.init_taskqueue_stub()
+        taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        st = NDBStore(identifier = 'banana', configuration = {'versioned': True})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES[:10]])
+        self.assertEquals(10, len(st)) #A graph without a GraphPointer is version 0
+        reader = NDBStore(identifier = 'banana', configuration = {'versioned': True})
+        load_into_new_version = st._update_shards_async
+        def checking_update_shards_async(store, changes):
+            self.assertEquals(10, len(NDBStore(identifier = 'banana', configuration = {'versioned': True}))) #Readers see the old version during the load
+            return load_into_new_version.__func__(store, changes)
+        NDBStore._update_shards_async = checking_update_shards_async
+        try:
+            st.replace(StringIO(_NT), chunk_size = 50)
+        finally:
+            NDBStore._update_shards_async = load_into_new_version.__func__
+        self.assertEquals(len(_TRIPLES), len(st))
+        self.st = NDBStore(identifier = 'banana', configuration = {'versioned': True})
+        self._assertLoaded()
+        self.assertEquals(10, len(reader)) #Until the old version is deleted
+        tasks = taskqueue.get_filtered_tasks()
+        self.assertEquals(1, len(tasks))
+        deferred.run(tasks[0].payload)
+        self.assertEquals(0, len([m for m in GraphShard.query().fetch() if m.graph_ID == 'banana']))
+        st.replace(StringIO(_NT[:_NT.index('\n') + 1]))
+        self.assertEquals(1, len(NDBStore(identifier = 'banana', configuration = {'versioned': True})))
+
+    def _assertLoaded(self):
+        self.assertEquals(len(_TRIPLES), len(self.st))
+        loaded = [t for (t, _) in self.st.triples((None, None, None))]
+        self.assertEquals(sorted([t for t in _TRIPLES if not isinstance(t[2], BNode)]), 
+                          sorted([t for t in loaded if not isinstance(t[2], BNode)]))
+        self.assertEquals(7, len(set([t[2] for t in loaded if isinstance(t[2], BNode)])))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,15 @@
 import unittest
-from rdflib_appengine.ndbstore import NDBStore
+from rdflib_appengine.ndbstore import NDBStore, GraphShard, GraphShardDelta, PredicateStats, ShardCache, LargeTerm, _set_multi_chunked, _get_multi_chunked
+from rdflib_appengine import shardformat
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.api import datastore
 from google.appengine.ext import testbed
-from rdflib.term import URIRef, Literal
+from rdflib.term import URIRef, Literal, Variable
+from rdflib import Graph, ConjunctiveGraph, Dataset
+from uuid import uuid4
 import itertools
+import os
 
 _BIG_URIREF = URIRef('http://%s' % ('x' * 500))
 _BIG_LITERAL = Literal('x' * 1500)
@@ -15,6 +22,12 @@ _TRIPLES = [(s, p, o) for [s, p, o] in itertools.product([URIRef('http://s%d' %
                                                          + [_BIG_LITERAL],
                                                          )]
 
+def _graph(triples):
+    g = Graph()
+    for t in triples:
+        g.add(t)
+    return g
+
 class TestCase(unittest.TestCase):
     def setUp(self):
         # First, create an instance of the Testbed class.
@@ -23,6 +36,7 @@ class TestCase(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        GraphShard._graph_cache.clear()
 
     def tearDown(self):
         self.testbed.deactivate()
@@ -59,14 +73,520 @@ class TestCase(unittest.TestCase):
         for pattern in patterns:
             self._assertSameMatches(st, pattern)
         
+    def testTriplesWithObjectShards(self):
+        st = NDBStore(identifier = 'banana', configuration = {'no_of_object_shards': 16})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        patterns = itertools.product(*zip(_TRIPLES[0], _TRIPLES[-1], [None, None, None]))
+        for pattern in patterns:
+            self._assertSameMatches(st, pattern)
+
+    def testObjectShardsAvoidTraversal(self):
+        st = NDBStore(identifier = 'banana', configuration = {'no_of_object_shards': 256})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        def fail():
+            self.fail('Traversed all GraphShards for an object-bound pattern')
+        st._all_predicate_shard_models = fail
+        self._assertSameMatches(st, (None, None, _BIG_LITERAL))
+        self._assertSameMatches(st, (None, _TRIPLES[0][1], _BIG_LITERAL))
+
+    def testRemoveWithObjectShards(self):
+        st = NDBStore(identifier = 'banana', configuration = {'no_of_object_shards': 1})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        st.remove(_TRIPLES[-1], None)
+        expected = [t for t in _TRIPLES[:-1] if t[2] == _TRIPLES[-1][2]]
+        self._assertSameSet(expected, st.triples((None, None, _TRIPLES[-1][2]), None))
+        self.assertEquals(len(_TRIPLES) - 1, len(st))
+
+    def testRebuildObjectShards(self):
+        NDBStore(identifier = 'banana', configuration = {'no_of_object_shards': 1}).addN([(s, p, o, None) for (s, p, o) in _TRIPLES[:10]])
+        NDBStore(identifier = 'banana').addN([(s, p, o, None) for (s, p, o) in _TRIPLES[10:]])
+        st = NDBStore(identifier = 'banana', configuration = {'no_of_object_shards': 16})
+        self._assertSameSet([], st.triples((None, None, _TRIPLES[-1][2]), None))
+        self.assertEquals(len(_TRIPLES), st.rebuild_object_shards())
+        self.assertEquals([], [key for key in GraphShard.query().iter(keys_only = True) if key.id().startswith('o--')])
+        patterns = itertools.product(*zip(_TRIPLES[0], _TRIPLES[-1], [None, None, None]))
+        for pattern in patterns:
+            self._assertSameMatches(st, pattern)
+
+    def testSplitting(self):
+        st = NDBStore(identifier = 'banana', configuration = {'max_triples_per_shard': 5, 'no_of_object_shards': 16})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        split = [m for m in GraphShard.query().fetch() if m.is_split]
+        self.assertTrue(len(split) > 0)
+        for m in split:
+            self.assertEquals(0, len(m.rdflib_graph()))
+        self.assertEquals(len(_TRIPLES), len(st))
+        patterns = itertools.product(*zip(_TRIPLES[0], _TRIPLES[-1], [None, None, None]))
+        for pattern in patterns:
+            self._assertSameMatches(st, pattern)
+        st.remove(_TRIPLES[0], None)
+        self.assertEquals(len(_TRIPLES) - 1, len(st))
+        self._assertSameSet(_TRIPLES[1:], st.triples((None, None, None), None))
+        st.destroy(None)
+        self.assertEquals([], GraphShard.query().fetch())
+
+    def testSplittingByBytes(self):
+        st = NDBStore(identifier = 'banana', configuration = {'max_bytes_per_shard': 2000})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        self.assertTrue(any(m.is_split for m in GraphShard.query().fetch()))
+        self._assertSameSet(_TRIPLES, st.triples((None, None, None), None))
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        self.assertEquals(len(_TRIPLES), len(st))
+
+    def testDeltas(self):
+        st = NDBStore(identifier = 'banana', configuration = {'max_deltas_per_shard': 3})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES[1:]])
+        self.assertEquals(0, GraphShardDelta.query().count())
+        base = dict((m.key, m.graph_bin) for m in GraphShard.query().fetch())
+        st.add(_TRIPLES[0], None)
+        self.assertEquals(2, GraphShardDelta.query().count())
+        self.assertEquals(base, dict((m.key, m.graph_bin) for m in GraphShard.query().fetch() if m.key in base))
+        self.assertEquals(len(_TRIPLES), len(st))
+        st.remove(_TRIPLES[1], None)
+        self._assertSameSet([_TRIPLES[0]] + _TRIPLES[2:], st.triples((None, None, None), None))
+        self.assertEquals(len(_TRIPLES) - 1, len(st))
+        self.assertEquals(4, GraphShardDelta.query().count())
+        self.assertEquals(2, st.compact())
+        self.assertEquals(0, GraphShardDelta.query().count())
+        self.assertEquals(0, st.compact())
+        self._assertSameSet([_TRIPLES[0]] + _TRIPLES[2:], st.triples((None, None, None), None))
+
+    def testLargeWritesAreNotAppendedAsDeltas(self):
+        p = URIRef('http://p')
+        st = NDBStore(identifier = 'banana')
+        st.addN([(URIRef('http://s%d' % i), p, Literal(i), None) for i in range(3000)])
+        large = [(URIRef('http://t%d' % i), p, Literal(''.join(uuid4().hex for _ in range(20)))) for i in range(3000)]
+        st.addN([(s, p, o, None) for (s, p, o) in large])
+        self.assertEquals(6000, len(st))
+        self.assertTrue(any(m.is_split for m in GraphShard.query().fetch()))
+        self.assertTrue(all(len(d.added_bin) + len(d.removed_bin) <= 500000 for d in GraphShardDelta.query().fetch()))
+        self._assertSameSet(large[7:8], st.triples((URIRef('http://t7'), None, None), None))
+
+    def testDeltasAreCompactedAutomatically(self):
+        st = NDBStore(identifier = 'banana', configuration = {'max_deltas_per_shard': 2})
+        for t in _TRIPLES[:5]:
+            st.add(t, None)
+        self.assertTrue(all(m.delta_count <= 2 for m in GraphShard.query().fetch()))
+        self.assertEquals(GraphShardDelta.query().count(), sum(m.delta_count for m in GraphShard.query().fetch()))
+        self._assertSameSet(_TRIPLES[:5], st.triples((None, None, None), None))
+
+    def testNoDeltas(self):
+        st = NDBStore(identifier = 'banana', configuration = {'max_deltas_per_shard': 0})
+        for t in _TRIPLES[:5]:
+            st.add(t, None)
+        st.remove(_TRIPLES[0], None)
+        self.assertEquals(0, GraphShardDelta.query().count())
+        self._assertSameSet(_TRIPLES[1:5], st.triples((None, None, None), None))
+
+    def testDestroyDeletesDeltas(self):
+        st = NDBStore(identifier = 'banana')
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        st.remove(_TRIPLES[0], None)
+        st.destroy(None)
+        self.assertEquals(0, GraphShardDelta.query().count())
+        self.assertEquals(0, GraphShard.query().count())
+
+    def testShardCacheEvictsLeastRecentlyUsed(self):
+        cache = ShardCache(max_triples = 4)
+        cache.put('a', _graph(_TRIPLES[0:2]), 10)
+        cache.put('b', _graph(_TRIPLES[2:4]), 10)
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', _graph(_TRIPLES[4:6]), 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        cache.put('d', _graph(_TRIPLES[0:5]), 10)
+        self.assertIsNone(cache.get('d'))
+        self.assertEquals({'entries': 2, 'triples': 4, 'bytes': 20, 'evictions': 1}, 
+                          dict((k, v) for (k, v) in cache.stats().items() if k in ['entries', 'triples', 'bytes', 'evictions']))
+
+    def testShardCacheByteLimit(self):
+        cache = ShardCache(max_bytes = 25)
+        cache.put('a', _graph(_TRIPLES[0:1]), 10)
+        cache.put('b', _graph(_TRIPLES[1:2]), 10)
+        cache.put('c', _graph(_TRIPLES[2:3]), 10)
+        self.assertIsNone(cache.get('a'))
+        cache.configure(max_bytes = 10)
+        self.assertEquals(['c'], [key for key in 'abc' if cache.get(key) is not None])
+        cache.discard('c')
+        self.assertEquals(0, cache.stats()['bytes'])
+
+    def testShardCacheStats(self):
+        st = NDBStore(identifier = 'banana')
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        GraphShard._graph_cache.reset_stats()
+        self._assertSameMatches(st, (_TRIPLES[0][0], None, None))
+        self.assertEquals(1, GraphShard.cache_stats()['datastore_loads'])
+        self._assertSameMatches(st, (_TRIPLES[0][0], None, None))
+        self.assertEquals(1, GraphShard.cache_stats()['local_hits'])
+        GraphShard._graph_cache.clear()
+        self._assertSameMatches(st, (_TRIPLES[0][0], None, None))
+        self.assertEquals(1, GraphShard.cache_stats()['memcache_hits'])
+        st.remove(_TRIPLES[0], None)
+        self._assertSameMatches(st, (_TRIPLES[0][0], None, None), without = [_TRIPLES[0]])
+        self.assertEquals(2, GraphShard.cache_stats()['datastore_loads'])
+
+    def testShardCacheNoticesWritesByOtherInstances(self):
+        st = NDBStore(identifier = 'banana')
+        st.add(_TRIPLES[0], None)
+        self._assertSameMatches(st, (_TRIPLES[0][0], None, None), without = _TRIPLES[1:])
+        #Write from another instance, which has a cache of its own
+        this_instance = GraphShard._graph_cache
+        GraphShard._graph_cache = ShardCache()
+        try:
+            NDBStore(identifier = 'banana').add(_TRIPLES[1], None)
+        finally:
+            GraphShard._graph_cache = this_instance
+        this_instance.reset_stats()
+        self._assertSameMatches(st, (_TRIPLES[0][0], None, None), without = _TRIPLES[2:])
+        self.assertEquals(0, GraphShard.cache_stats()['local_hits'])
+        self.assertEquals(1, GraphShard.cache_stats()['outdated'])
+
+    def testMemcacheHoldsBinaryFormat(self):
+        st = NDBStore(identifier = 'banana')
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        st.add((_TRIPLES[0][0], _TRIPLES[0][1], Literal('delta')), None)
+        m = st.keys_for('banana', _TRIPLES[0][0], 0)[0].get()
+        self.assertEquals(1, m.delta_count)
+        expected = set(m.rdflib_graph())
+        self.assertEquals(expected, set(shardformat.decode(_get_multi_chunked([m._parsed_memcache_key()])[m._parsed_memcache_key()], Graph())))
+        GraphShard._graph_cache.clear()
+        self.assertEquals(expected, set(m.rdflib_graph()))
+        self.assertEquals(1, GraphShard.cache_stats()['memcache_hits'])
+
+    def testChunkedMemcache(self):
+        large = os.urandom(2500000) #Does not compress
+        _set_multi_chunked({'small' : 'x' * 100, 'large' : large})
+        self.assertEquals({'small' : 'x' * 100, 'large' : large}, _get_multi_chunked(['small', 'large', 'missing']))
+        (no_of_chunks, token) = memcache.get('large')
+        self.assertEquals(3, no_of_chunks)
+        memcache.delete('large#{}#1'.format(token))
+        self.assertEquals({'small' : 'x' * 100}, _get_multi_chunked(['small', 'large']))
+
+    def testWarmUp(self):
+        st = NDBStore(identifier = 'banana')
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        other = NDBStore(identifier = 'apple')
+        other.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        self._assertSameMatches(st, (_TRIPLES[0][0], None, None))
+        self._assertSameMatches(other, (_TRIPLES[0][0], None, None))
+        self.assertEquals(1, st.remember_hot_shards())
+        GraphShard._graph_cache.clear()
+        self.assertEquals({'shards' : 1, 'queries' : 1}, dict((k, v) for (k, v) in st.warm_up().iteritems() if k != 'seconds'))
+        self.assertEquals(3, st.warm_up(patterns = [(None, _TRIPLES[0][1], None), (None, _TRIPLES[-1][1], None)])['shards'])
+        GraphShard._graph_cache.reset_stats()
+        self._assertSameMatches(st, (_TRIPLES[0][0], None, None))
+        self.assertEquals(1, GraphShard.cache_stats()['local_hits'])
+
+    def testBufferedWrites(self):
+        NDBStore(identifier = 'banana').addN([(s, p, o, None) for (s, p, o) in _TRIPLES[:10]])
+        st = NDBStore(identifier = 'banana', configuration = {'write_buffer_size': 1000})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES[10:20]])
+        for t in _TRIPLES[20:]:
+            st.add(t, None)
+        st.remove(_TRIPLES[0], None)
+        st.remove((_TRIPLES[-1][0], None, None), None)
+        expected = [t for t in _TRIPLES[1:] if t[0] != _TRIPLES[-1][0]]
+        self.assertEquals(len(_TRIPLES[:10]), len(NDBStore(identifier = 'banana'))) #Nothing written yet
+        for pattern in itertools.product(*zip(_TRIPLES[0], _TRIPLES[-1], [None, None, None])):
+            self._assertSameMatches(st, pattern, without = [t for t in _TRIPLES if t not in expected])
+        st.commit()
+        st = NDBStore(identifier = 'banana')
+        self.assertEquals(len(expected), len(st))
+        self._assertSameSet(expected, st.triples((None, None, None)))
+
+    def testBufferedWritesAreCommittedWhenFull(self):
+        st = NDBStore(identifier = 'banana', configuration = {'write_buffer_size': 5})
+        for t in _TRIPLES[:7]:
+            st.add(t, None)
+        self._assertSameSet(_TRIPLES[:5], NDBStore(identifier = 'banana').triples((None, None, None)))
+        st.rollback()
+        self._assertSameSet(_TRIPLES[:5], st.triples((None, None, None)))
+
+    def testBufferedWritesInWithBlock(self):
+        st = NDBStore(identifier = 'banana', configuration = {'write_buffer_size': 1000})
+        with st:
+            for t in _TRIPLES[:3]:
+                st.add(t, None)
+        try:
+            with st:
+                st.add(_TRIPLES[3], None)
+                raise ValueError()
+        except ValueError:
+            pass
+        self._assertSameSet(_TRIPLES[:3], NDBStore(identifier = 'banana').triples((None, None, None)))
+        self._assertSameSet(_TRIPLES[:3], st.triples((None, None, None)))
+
+    def testLenUsesTripleCounts(self):
+        st = NDBStore(identifier = 'banana', configuration = {'max_deltas_per_shard': 2})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES[1:]])
+        def fail():
+            self.fail('Traversed all GraphShards to compute len()')
+        st._all_predicate_shard_models = fail
+        self.assertEquals(len(_TRIPLES) - 1, len(st))
+        self.assertEquals(sum(len(m.rdflib_graph()) for m in GraphShard.query().fetch() if m.spo() == 'p'), 
+                          sum(m.triple_count for m in GraphShard.query().fetch() if m.spo() == 'p'))
+        st.add(_TRIPLES[0], None)
+        self.assertEquals(len(_TRIPLES), len(st))
+        st.add(_TRIPLES[0], None)
+        self.assertEquals(len(_TRIPLES), len(st))
+        st.remove(_TRIPLES[1], None)
+        self.assertEquals(len(_TRIPLES) - 1, len(st))
+        st.compact()
+        self.assertEquals(len(_TRIPLES) - 1, len(st))
+        st.destroy(None)
+        self.assertEquals(0, len(st))
+
+    def testLenCachedBeforeWriteCompletesIsNotUsed(self):
+        st = NDBStore(identifier = 'banana')
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES[1:]])
+        #As if a concurrent len() counted and cached the total while the next write was in flight
+        memcache.set(st._len_memcache_key(), len(_TRIPLES) - 1)
+        st.add(_TRIPLES[0], None)
+        self.assertEquals(len(_TRIPLES), len(st))
+        g = ConjunctiveGraph(store = NDBStore(identifier = 'banana', configuration = {'context_aware': True}))
+        c = g.get_context(URIRef('http://c'))
+        c.add(_TRIPLES[0])
+        self.assertEquals(1, len(c))
+        c.addN([(s, p, o, c) for (s, p, o) in _TRIPLES[1:3]])
+        self.assertEquals(3, len(c))
+
+    def testRemoveN(self):
+        st = NDBStore(identifier = 'banana')
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        (s, p, _) = _TRIPLES[0]
+        removed = [t for t in _TRIPLES if t[0] == s and t[1] == p]
+        st.removeN(removed)
+        self.assertEquals(2, GraphShardDelta.query().count()) #One for the subject GraphShard, one for the predicate GraphShard
+        self._assertSameSet([t for t in _TRIPLES if t not in removed], st.triples((None, None, None), None))
+        self.assertEquals(len(_TRIPLES) - len(removed), len(st))
+
+    def testRemovePatterns(self):
+        st = NDBStore(identifier = 'banana', configuration = {'no_of_object_shards': 16})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        (s, p, o) = _TRIPLES[-1]
+        st.removeN([(s, None, None), (None, p, o)])
+        remaining = [t for t in _TRIPLES if t[0] != s and (t[1], t[2]) != (p, o)]
+        self._assertSameSet(remaining, st.triples((None, None, None), None))
+        for pattern in itertools.product(*zip(_TRIPLES[0], _TRIPLES[-1], [None, None, None])):
+            self._assertSameMatches(st, pattern, without = [t for t in _TRIPLES if t not in remaining])
+        g = Graph(store = st)
+        g.remove((None, None, _TRIPLES[0][2]))
+        self._assertSameSet([t for t in remaining if t[2] != _TRIPLES[0][2]], st.triples((None, None, None), None))
+        g.remove((None, None, None))
+        self.assertEquals(0, len(st))
+
+    def testPredicateSubShardsBySubject(self):
+        configuration = {'no_of_shards_per_predicate_default': 16, 'predicate_sub_shards_by_subject': True}
+        st = NDBStore(identifier = 'banana', configuration = configuration)
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        (keys, _, _) = st._route(_TRIPLES[0][0:2] + (None, ))
+        self.assertEquals(1, len(keys))
+        patterns = itertools.product(*zip(_TRIPLES[0], _TRIPLES[-1], [None, None, None]))
+        for pattern in patterns:
+            self._assertSameMatches(st, pattern)
+        st.removeN(_TRIPLES[0:2])
+        self.assertEquals(len(_TRIPLES) - 2, len(st))
+        self._assertSameSet(_TRIPLES[2:], st.triples((None, None, None), None))
+
+    def testTriplesFetchesShardsLazily(self):
+        p = URIRef('http://p')
+        triples = [(URIRef('http://s%d' % i), p, Literal(i)) for i in range(200)]
+        spans = []
+        st = NDBStore(identifier = 'banana', configuration = {'no_of_shards_per_predicate_default': 256, 'shard_fetch_window': 8, 'tracer': spans.append})
+        st.addN([(s, p, o, None) for (s, p, o) in triples])
+        self._assertSameSet(triples, st.triples((None, p, None)))
+        self.assertEquals(256, spans[-1].attributes['fetched'])
+        GraphShard._graph_cache.reset_stats()
+        matches = st.triples((None, p, None))
+        next(matches)
+        matches.close()
+        self.assertTrue(spans[-1].attributes['fetched'] <= 8)
+        self.assertEquals(1, len(list(spans[-1].walk('shard'))))
+        stats = GraphShard.cache_stats()
+        self.assertEquals(1, stats['local_hits'] + stats['memcache_hits'] + stats['datastore_loads'])
+
+    def testRehashPredicateShards(self):
+        configuration = {'no_of_shards_per_predicate_default': 16}
+        st = NDBStore(identifier = 'banana', configuration = configuration)
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        configuration['predicate_sub_shards_by_subject'] = True
+        st = NDBStore(identifier = 'banana', configuration = configuration)
+        self.assertTrue(st.rehash_predicate_shards() > 0)
+        self.assertEquals(0, st.rehash_predicate_shards())
+        for (s, p, o) in _TRIPLES:
+            self._assertSameMatches(st, (s, p, None))
+        self.assertEquals(len(_TRIPLES), len(st))
+
+    def testLegacyN3Shards(self):
+        st = NDBStore(identifier = 'banana')
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        legacy = [m for m in GraphShard.query().fetch()]
+        for m in legacy:
+            m.graph_n3 = m.rdflib_graph().serialize(format = 'n3')
+            m.graph_bin = None
+        GraphShard.invalidate(legacy)
+        ndb.put_multi(legacy)
+        #Remove properties introduced after the N3 format
+        entities = datastore.Get([m.key.to_old_key() for m in legacy])
+        for e in entities:
+            for name in ['graph_bin', 'is_split', 'delta_count', 'triple_count', 'subject_count', 'object_count']:
+                del e[name]
+        datastore.Put(entities)
+        self.assertEquals(len(_TRIPLES), len(st))
+        self._assertSameSet(_TRIPLES, st.triples((None, None, None), None))
+        st.remove(_TRIPLES[0], None)
+        self.assertEquals(len(legacy), st.upgrade_shards())
+        self.assertEquals([], [m for m in GraphShard.query().fetch() if m.is_legacy()])
+        self._assertSameSet(_TRIPLES[1:], st.triples((None, None, None), None))
+
+    def testStatistics(self):
+        st = NDBStore(identifier = 'banana', configuration = {'max_triples_per_shard': 5})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        p = URIRef('http://p0')
+        stats = st.predicate_statistics([p])[p].as_dict()
+        self.assertEquals(p, stats['predicate'])
+        self.assertEquals(len(_TRIPLES) / 3, stats['triples'])
+        self.assertEquals(3, stats['subjects'])
+        self.assertTrue(6 <= stats['objects'] <= stats['triples'], stats) #The split GraphShards share objects
+        self.assertTrue(stats['shards'] > 1) #The GraphShard has been split
+        self.assertEquals(3, len(st.statistics()))
+        self.assertEquals(len(_TRIPLES), sum([d['triples'] for d in st.statistics()]))
+        self.assertEquals(1.0, st.estimate((_TRIPLES[0][0], p, _TRIPLES[0][2])))
+        self.assertEquals(6.0, st.estimate((_TRIPLES[0][0], p, None)))
+        self.assertEquals(len(_TRIPLES), st.estimate((None, None, None)))
+
+    def testStatisticsFollowWrites(self):
+        st = NDBStore(identifier = 'banana')
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        st.removeN([(None, URIRef('http://p1'), None)])
+        st.add((URIRef('http://s9'), URIRef('http://p9'), URIRef('http://o')), None)
+        st.removeN([(URIRef('http://s9'), URIRef('http://p1'), URIRef('http://o'))]) #Not in the graph
+        stats = dict((d['predicate'], d) for d in st.statistics())
+        self.assertEquals(len(_TRIPLES) / 3, stats[URIRef('http://p1')]['triples']) #The removals are in GraphShardDeltas
+        self.assertEquals(1, stats[URIRef('http://p9')]['triples'])
+        st.compact()
+        compacted = st.statistics()
+        stats = dict((d['predicate'], d) for d in compacted)
+        self.assertEquals(0, stats[URIRef('http://p1')]['triples'])
+        self.assertEquals(len(_TRIPLES) / 3, stats[URIRef('http://p0')]['triples'])
+        st.rebuild_statistics()
+        self.assertEquals(sorted([d for d in compacted if d['triples'] > 0]), sorted(st.statistics()))
+
+    def testEstimateReadsStatisticsOnce(self):
+        st = NDBStore(identifier = 'banana')
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        queries = []
+        def counting_query(*args, **kwargs):
+            queries.append(args)
+            return ndb.Model.query.im_func(PredicateStats, *args, **kwargs)
+        PredicateStats.query = staticmethod(counting_query)
+        try:
+            st.explain([(Variable('s'), Variable('p%d' % i), _TRIPLES[i][2]) for i in range(5)])
+            self.assertEquals(1, len(queries))
+            st.add((URIRef('http://s9'), URIRef('http://p9'), URIRef('http://o')), None)
+            st.explain([(Variable('s'), Variable('p'), Variable('o'))])
+            self.assertEquals(2, len(queries))
+        finally:
+            del PredicateStats.query
+
+    def testNoStatistics(self):
+        st = NDBStore(identifier = 'banana', configuration = {'statistics': False})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        self.assertEquals([], st.statistics())
+        self.assertEquals(3, st.rebuild_statistics())
+        self.assertEquals(len(_TRIPLES), sum([d['triples'] for d in st.statistics()]))
+
     def testDestroy(self):
         st = NDBStore(identifier = 'banana')
         st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
         st.destroy(None)
         self._assertSameSet(set(), st.triples((None, None, None), None))
 
-    def _assertSameMatches(self, st, (s, p, o)):
-        mine = _TRIPLES
+    def testContexts(self):
+        st = NDBStore(identifier = 'banana', configuration = {'context_aware': True})
+        g = ConjunctiveGraph(store = st)
+        (c1, c2) = (g.get_context(URIRef('http://c1')), g.get_context(URIRef('http://c2')))
+        g.addN([(s, p, o, c1) for (s, p, o) in _TRIPLES] + [(s, p, o, c2) for (s, p, o) in _TRIPLES[:10]])
+        self.assertEquals([URIRef('http://c1'), URIRef('http://c2')], [c.identifier for c in g.contexts()])
+        self.assertEquals(set(_TRIPLES), set(g))
+        self.assertEquals(set(_TRIPLES[:10]), set(c2))
+        self.assertEquals(len(_TRIPLES) + 10, len(g))
+        self.assertEquals(10, len(c2))
+        self.assertEquals(set([(s, p, o, URIRef('http://c2')) for (s, p, o) in _TRIPLES[:10]]),
+                          set([(s, p, o, c.identifier) for (s, p, o, c) in g.quads((None, None, None)) if c.identifier == URIRef('http://c2')]))
+        self.assertEquals([URIRef('http://c1')], [c.identifier for c in g.contexts(_TRIPLES[-1])])
+        c1.remove(_TRIPLES[0])
+        self.assertEquals(set(_TRIPLES[:10]), set(c2))
+        self.assertEquals([URIRef('http://c2')], [c.identifier for c in g.contexts(_TRIPLES[0])])
+        #A new NDBStore reads the contexts from the GraphContexts
+        g = ConjunctiveGraph(store = NDBStore(identifier = 'banana', configuration = {'context_aware': True}))
+        self.assertEquals([URIRef('http://c1'), URIRef('http://c2')], [c.identifier for c in g.contexts()])
+        g.remove_context(g.get_context(URIRef('http://c1')))
+        self.assertEquals(set(_TRIPLES[:10]), set(g))
+        g.destroy(None)
+        self.assertEquals([], list(g.contexts()))
+        self.assertEquals(0, len(g))
+
+    def testContextReadsOnlyItsShards(self):
+        st = NDBStore(identifier = 'banana', configuration = {'context_aware': True})
+        g = ConjunctiveGraph(store = st)
+        g.addN([(s, p, o, g.get_context(URIRef('http://c{}'.format(i % 2)))) for (i, (s, p, o)) in enumerate(_TRIPLES)])
+        GraphShard._graph_cache.clear()
+        context = g.get_context(URIRef('http://c0'))
+        self.assertEquals(set(_TRIPLES[::2]), set(context))
+        graph_IDs = set([key[len('GraphShard('):-1].split('-', 3)[3] for key in GraphShard._graph_cache.keys()])
+        self.assertEquals(set([st._context_store(URIRef('http://c0'))._ID]), graph_IDs)
+
+    def testQuadsReadEachContextOnce(self):
+        st = NDBStore(identifier = 'banana', configuration = {'context_aware': True})
+        g = ConjunctiveGraph(store = st)
+        (c1, c2) = (g.get_context(URIRef('http://c1')), g.get_context(URIRef('http://c2')))
+        g.addN([(s, p, o, c1) for (s, p, o) in _TRIPLES] + [(s, p, o, c2) for (s, p, o) in _TRIPLES[:10]])
+        def failing_contexts(triple = None):
+            self.fail('contexts() called for {}'.format(triple))
+        st.contexts = failing_contexts
+        context_store = st._context_store
+        calls = []
+        def counting_context_store(context):
+            calls.append(context)
+            return context_store(context)
+        st._context_store = counting_context_store
+        quads = set([(s, p, o, c.identifier) for (s, p, o, c) in g.quads((None, None, None))])
+        self.assertEquals(set([(s, p, o, URIRef('http://c1')) for (s, p, o) in _TRIPLES] 
+                              + [(s, p, o, URIRef('http://c2')) for (s, p, o) in _TRIPLES[:10]]), quads)
+        self.assertEquals([URIRef('http://c1'), URIRef('http://c2')], calls)
+
+    def testDataset(self):
+        ds = Dataset(store = NDBStore(identifier = 'banana', configuration = {'context_aware': True}))
+        ds.add(_TRIPLES[0])
+        g = ds.graph(URIRef('http://c1'))
+        g.add(_TRIPLES[1])
+        self.assertEquals(set([_TRIPLES[0]]), set(ds))
+        self.assertEquals(set([_TRIPLES[1]]), set(g))
+        self.assertTrue(URIRef('http://c1') in [c.identifier for c in ds.contexts()])
+        ds.remove_graph(g)
+        self.assertFalse(URIRef('http://c1') in [c.identifier for c in ds.contexts()])
+        self.assertEquals(0, len(ds.graph(URIRef('http://c1'))))
+
+    def testLargeTerms(self):
+        st = NDBStore(identifier = 'banana', configuration = {'large_term_size': 400, 'no_of_object_shards': 16})
+        st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        self.assertEquals(2, LargeTerm.query().count())
+        for m in GraphShard.query():
+            self.assertEquals([], [t for t in m.load_into(Graph()) if len(t[0]) > 400 or len(t[2]) > 400])
+        GraphShard._graph_cache.clear()
+        LargeTerm._cache.clear()
+        self._assertSameMatches(st, (None, None, None))
+        for pattern in [(_BIG_URIREF, None, None), (None, _BIG_URIREF, _BIG_LITERAL), (None, None, _BIG_URIREF), (URIRef('http://s1'), None, _BIG_LITERAL)]:
+            self._assertSameMatches(st, pattern)
+        st.removeN([(_BIG_URIREF, None, None), (URIRef('http://s0'), URIRef('http://p0'), _BIG_LITERAL)])
+        removed = [t for t in _TRIPLES if t[0] == _BIG_URIREF] + [(URIRef('http://s0'), URIRef('http://p0'), _BIG_LITERAL)]
+        self._assertSameMatches(st, (None, None, None), without = removed)
+        self._assertSameMatches(st, (None, None, _BIG_LITERAL), without = removed)
+
+    def _assertSameMatches(self, st, (s, p, o), without = []):
+        mine = [t for t in _TRIPLES if t not in without]
         if s is not None:
             mine = [t for t in mine if t[0] == s]
         if p is not None:
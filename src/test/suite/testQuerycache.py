@@ -0,0 +1,68 @@
+import unittest
+from rdflib_appengine.ndbstore import NDBStore, GraphShard
+from rdflib_appengine.querycache import QueryCache, normalize
+from google.appengine.ext import testbed
+from google.appengine.api import memcache
+from rdflib.term import URIRef, Literal
+from rdflib import Graph
+
+_QUERY = 'SELECT ?o WHERE { <http://s> <http://p> ?o }'
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+        # Then activate the testbed, which prepares the service stubs for use.
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        GraphShard._graph_cache.clear()
+        self.st = NDBStore(identifier = 'banana')
+        self.st.addN([(URIRef('http://s'), URIRef('http://p'), Literal(i), None) for i in range(3)])
+        self.g = Graph(store = self.st)
+        self.cache = QueryCache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testNormalize(self):
+        self.assertEquals(normalize(_QUERY), normalize('  SELECT ?o #comment\n WHERE {\t<http://s> <http://p>  ?o\n}'))
+        self.assertNotEquals(normalize('SELECT * WHERE { ?s ?p "a  b" }'), normalize('SELECT * WHERE { ?s ?p "a b" }'))
+        self.assertEquals('ASK { ?s ?p "#not a comment" }', normalize('ASK  { ?s ?p "#not a comment" }'))
+
+    def testHitsAndMisses(self):
+        (result, is_hit) = self.cache.query(self.g, _QUERY)
+        self.assertFalse(is_hit)
+        self.assertEquals(self.g.query(_QUERY).serialize(format = 'json'), result)
+        self.assertEquals((result, True), self.cache.query(self.g, _QUERY + ' '))
+        self.cache.clear()
+        self.assertEquals((result, True), self.cache.query(self.g, _QUERY)) #From Memcache
+        self.assertEquals(1, self.cache.stats()['local_hits'])
+        self.assertEquals(1, self.cache.stats()['memcache_hits'])
+        self.assertEquals(1, self.cache.stats()['misses'])
+
+    def testWritesInvalidate(self):
+        self.cache.query(self.g, _QUERY)
+        for write in [lambda: self.st.add((URIRef('http://s'), URIRef('http://p'), Literal(42)), None),
+                      lambda: self.st.remove((URIRef('http://s'), URIRef('http://p'), Literal(0))),
+                      lambda: self.st.destroy(None)]:
+            generation = self.st.generation()
+            write()
+            self.assertNotEquals(generation, self.st.generation())
+            (result, is_hit) = self.cache.query(self.g, _QUERY)
+            self.assertFalse(is_hit)
+            self.assertEquals(self.g.query(_QUERY).serialize(format = 'json'), result)
+
+    def testGenerationSurvivesEviction(self):
+        generation = self.st.generation()
+        memcache.flush_all()
+        self.assertTrue(self.st.generation() > generation)
+
+    def testEviction(self):
+        cache = QueryCache(max_bytes = 1)
+        cache.query(self.g, _QUERY)
+        self.assertEquals(0, cache.stats()['entries'])
+        self.assertEquals((self.g.query(_QUERY).serialize(format = 'json'), True), cache.query(self.g, _QUERY)) #From Memcache
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import unittest
+from rdflib_appengine import shardformat
+from rdflib.term import URIRef, Literal, BNode
+from rdflib.namespace import XSD
+from rdflib import Graph
+import zlib
+
+_TRIPLES = [(URIRef('http://s'), URIRef('http://p'), URIRef('http://o')),
+            (URIRef('http://s'), URIRef('http://p'), Literal(42)),
+            (URIRef('http://s'), URIRef('http://p'), Literal(3.14)),
+            (URIRef('http://s'), URIRef('http://p'), Literal('2014-09-12', datatype = XSD.date)),
+            (URIRef('http://s'), URIRef('http://p'), Literal(u'blåbærgrød', lang = 'da')),
+            (URIRef('http://s'), URIRef('http://p'), Literal(u'')),
+            (BNode('b0'), URIRef(u'http://p/æøå'), Literal('x' * 1500)),
+            (BNode('b0'), URIRef('http://p'), BNode('b1')),
+            ]
+
+#Encoded by version 1 of the binary format
+_VERSION_1 = ('NDBS\x01\x05\x00\x00\x00U\x08\x00\x00\x00http://sU\x08\x00\x00\x00http://pL\x01\x00\x00\x00v\x02\x00\x00\x00en\x00\x00\x00\x00'
+              'B\x01\x00\x00\x00bL\x01\x00\x00\x002\x00\x00\x00\x00(\x00\x00\x00http://www.w3.org/2001/XMLSchema#integer\x02\x00\x00\x00'
+              '\x00\x00\x00\x00\x01\x00\x00\x00\x02\x00\x00\x00\x03\x00\x00\x00\x01\x00\x00\x00\x04\x00\x00\x00')
+
+class TestCase(unittest.TestCase):
+    def testRoundTrip(self):
+        data = shardformat.encode(_TRIPLES)
+        self.assertTrue(shardformat.is_binary(data))
+        self.assertEquals(set(_TRIPLES), set(shardformat.decode(data, Graph())))
+
+    def testRoundTripGraph(self):
+        g = Graph()
+        for t in _TRIPLES:
+            g.add(t)
+        self.assertEquals(set(_TRIPLES), set(shardformat.decode(shardformat.encode(g), Graph())))
+
+    def testEmpty(self):
+        self.assertEquals(0, len(shardformat.decode(shardformat.encode([]), Graph())))
+
+    def testTermsAreStoredOnce(self):
+        one = len(shardformat.encode(_TRIPLES[-2:-1]))
+        many = len(shardformat.encode([(s, p, Literal(i)) for (i, (s, p, _)) in enumerate(_TRIPLES[-2:-1] * 100)]))
+        self.assertTrue(many < 100 * one)
+
+    def testNotBinary(self):
+        self.assertFalse(shardformat.is_binary(None))
+        self.assertFalse(shardformat.is_binary('@prefix ns1: <http://p/> .'))
+        self.assertRaises(ValueError, shardformat.decode, 'NDBX\x01', Graph())
+
+    def testUnsupportedVersion(self):
+        data = shardformat.encode(_TRIPLES)
+        self.assertRaises(ValueError, shardformat.decode, data[:4] + '\xff' + data[5:], Graph())
+
+    def testTruncated(self):
+        data = shardformat.encode(_TRIPLES)
+        self.assertRaises(ValueError, shardformat.decode, data[:-1], Graph())
+        self.assertRaises(ValueError, shardformat.decode, data[:20], Graph())
+        self.assertRaises(ValueError, shardformat.decode, data[:3], Graph())
+        self.assertRaises(ValueError, shardformat.decode, _VERSION_1[:20], Graph())
+
+    def testVersion1(self):
+        self.assertEquals(set([(URIRef('http://s'), URIRef('http://p'), Literal(u'v', lang = 'en')), (BNode('b'), URIRef('http://p'), Literal(2))]),
+                          set(shardformat.decode(_VERSION_1, Graph())))
+
+    def testSmallerThanN3(self):
+        g = Graph()
+        for i in range(1000):
+            g.add((URIRef('http://example.org/s{}'.format(i % 100)), URIRef('http://example.org/p{}'.format(i % 10)),
+                   Literal('{:x}'.format(i * 7919)) if i % 2 else URIRef('http://example.org/o{}'.format(i))))
+        n3 = g.serialize(format = 'n3')
+        data = shardformat.encode(g)
+        self.assertTrue(len(data) < len(n3))
+        self.assertTrue(len(zlib.compress(data)) < len(zlib.compress(n3)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import unittest
+from rdflib_appengine.ndbstore import NDBStore, GraphShard
+from google.appengine.ext import testbed
+from rdflib.term import URIRef, Literal, Variable
+from rdflib import Graph, ConjunctiveGraph
+
+_NS = 'http://example.org/'
+
+def _u(name):
+    return URIRef(_NS + name)
+
+_TRIPLES = ([(_u('person{}'.format(i)), _u('knows'), _u('person{}'.format((i * 7) % 50))) for i in range(50)]
+            + [(_u('person{}'.format(i)), _u('name'), Literal('Person {}'.format(i))) for i in range(50)]
+            + [(_u('person{}'.format(i)), _u('age'), Literal(20 + i % 30)) for i in range(0, 50, 2)]
+            + [(_u('person{}'.format(i)), _u('worksAt'), _u('company{}'.format(i % 5))) for i in range(50)]
+            + [(_u('company{}'.format(i)), _u('name'), Literal('Company {}'.format(i))) for i in range(5)])
+
+_QUERIES = ['SELECT ?s ?o WHERE { ?s <http://example.org/knows> ?o }',
+            'SELECT ?n WHERE { ?s <http://example.org/knows> ?o . ?o <http://example.org/name> ?n }',
+            'SELECT ?s ?n ?a WHERE { ?s <http://example.org/name> ?n ; <http://example.org/age> ?a }',
+            'SELECT ?n ?c WHERE { ?s <http://example.org/knows> ?o . ?o <http://example.org/worksAt> ?w . ?w <http://example.org/name> ?c . ?s <http://example.org/name> ?n }',
+            'SELECT ?n ?a WHERE { ?s <http://example.org/name> ?n OPTIONAL { ?s <http://example.org/age> ?a } }',
+            'SELECT ?s WHERE { ?s <http://example.org/age> ?a FILTER (?a > 40) }',
+            'SELECT ?s WHERE { ?s ?p ?s }',
+            'SELECT ?o WHERE { <http://example.org/person3> <http://example.org/knows>/<http://example.org/name> ?o }',
+            'SELECT ?s ?p WHERE { ?s ?p <http://example.org/company2> }',
+            ]
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+        # Then activate the testbed, which prepares the service stubs for use.
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        GraphShard._graph_cache.clear()
+        self.st = NDBStore(identifier = 'banana', configuration = {'max_triples_per_shard': 20})
+        self.st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        self.expected = Graph()
+        for t in _TRIPLES:
+            self.expected.add(t)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testQueries(self):
+        g = Graph(store = self.st)
+        for q in _QUERIES:
+            self.assertEquals(sorted(self.expected.query(q)), sorted(g.query(q)), q)
+
+    def testNamedGraphs(self):
+        g = ConjunctiveGraph(store = NDBStore(identifier = 'apple', configuration = {'context_aware': True}))
+        expected = ConjunctiveGraph()
+        for graph in [g, expected]:
+            graph.addN([(s, p, o, graph.get_context(_u('graph{}'.format(i % 3)))) for (i, (s, p, o)) in enumerate(_TRIPLES)])
+        for q in ['SELECT ?g (COUNT(*) AS ?n) WHERE { GRAPH ?g { ?s ?p ?o } } GROUP BY ?g',
+                  'SELECT ?n WHERE { GRAPH <http://example.org/graph1> { ?s <http://example.org/knows> ?o . ?o <http://example.org/name> ?n } }',
+                  _QUERIES[1]]:
+            self.assertEquals(sorted(expected.query(q)), sorted(g.query(q)), q)
+
+    def testUpdates(self):
+        g = Graph(store = self.st)
+        writes = []
+        update_shards = self.st._update_shards
+        def counting_update_shards(changes):
+            writes.append(changes)
+            update_shards(changes)
+        self.st._update_shards = counting_update_shards
+        updates = ['INSERT DATA { <http://example.org/person0> <http://example.org/age> 99 . <http://example.org/person1> <http://example.org/age> 98 }',
+                   'DELETE DATA { <http://example.org/person0> <http://example.org/age> 99 . <http://example.org/person2> <http://example.org/age> 21 }',
+                   'DELETE WHERE { ?s <http://example.org/worksAt> <http://example.org/company1> }',
+                   'DELETE { ?s <http://example.org/name> ?n } INSERT { ?s <http://example.org/label> ?n } WHERE { ?s <http://example.org/knows> ?o ; <http://example.org/name> ?n }',
+                   'PREFIX ex: <http://example.org/> INSERT { ?o ex:knownBy ?s } WHERE { ?s ex:knows ?o } ; DELETE WHERE { ?s ex:age 98 }',
+                   'PREFIX ex: <http://example.org/> DELETE { ?s ex:knownBy ?o } INSERT { ?s ex:knownBy ?o } WHERE { ?s ex:knownBy ?o }', #Kept
+                   ]
+        for update in updates:
+            g.update(update)
+            self.expected.update(update)
+            self.assertEquals(set(self.expected), set(g), update)
+        self.assertEquals(7, len(writes)) #One batch for each operation
+        g.update('CLEAR DEFAULT') #Not batched, evaluated by rdflib
+        self.assertEquals(0, len(g))
+
+    def testBufferedUpdate(self):
+        st = NDBStore(identifier = 'banana', configuration = {'max_triples_per_shard': 20, 'write_buffer_size': 1000})
+        g = Graph(store = st)
+        update = 'INSERT { ?s <http://example.org/knowsNameOf> ?n } WHERE { ?s <http://example.org/knows> ?o . ?o <http://example.org/name> ?n }'
+        g.update(update)
+        self.expected.update(update)
+        q = 'SELECT ?s ?n WHERE { ?s <http://example.org/knowsNameOf> ?n }'
+        self.assertEquals(50, len(self.expected.query(q)))
+        self.assertEquals(sorted(self.expected.query(q)), sorted(g.query(q)))
+        self.assertEquals(0, len(Graph(store = NDBStore(identifier = 'banana')).query(q)))
+        g.commit()
+        self.assertEquals(sorted(self.expected.query(q)), sorted(Graph(store = NDBStore(identifier = 'banana')).query(q)))
+
+    def testLimit(self):
+        rows = list(Graph(store = self.st).query('SELECT ?n WHERE { ?s <http://example.org/knows> ?o . ?o <http://example.org/name> ?n } LIMIT 3'))
+        self.assertEquals(3, len(rows))
+
+    def testLimitStopsEvaluation(self):
+        calls = []
+        prefetch = self.st.prefetch
+        def counting_prefetch(patterns, context = None):
+            patterns = list(patterns)
+            calls.append(len(patterns))
+            prefetch(patterns, context)
+        self.st.prefetch = counting_prefetch
+        q = 'SELECT ?n WHERE { ?s <http://example.org/knows> ?o . ?o <http://example.org/name> ?n }'
+        list(Graph(store = self.st).query(q + ' LIMIT 2 OFFSET 1'))
+        self.assertEquals(8, sum(calls[1:])) #Only the first batch of bindings from the first triple pattern
+        rows = list(Graph(store = self.st).query(q + ' ORDER BY ?n LIMIT 2 OFFSET 1'))
+        self.assertEquals(sorted([r[0] for r in self.expected.query(q)])[1:3], [r[0] for r in rows])
+
+    def testPrefetchBatchesBindings(self):
+        calls = []
+        prefetch = self.st.prefetch
+        def counting_prefetch(patterns, context = None):
+            patterns = list(patterns)
+            calls.append(len(patterns))
+            prefetch(patterns, context)
+        self.st.prefetch = counting_prefetch
+        q = _QUERIES[1]
+        self.assertEquals(sorted(self.expected.query(q)), sorted(Graph(store = self.st).query(q)))
+        self.assertEquals(1, calls[0])
+        self.assertTrue(sum(calls[1:]) >= 50, calls) #One binding per solution of the first triple pattern
+        self.assertTrue(len(calls) < 10, calls)
+
+    def testSelectivePatternsFirst(self):
+        (s, o, n) = (Variable('s'), Variable('o'), Variable('n'))
+        bgp = [(s, _u('knows'), o), (o, _u('name'), n), (s, _u('age'), Literal(42))]
+        plan = self.st.explain(bgp)
+        self.assertEquals([bgp[2], bgp[0], bgp[1]], [pattern for (pattern, _) in plan])
+        self.assertTrue(plan[0][1] < 2, plan)
+        self.assertEquals([bgp[0], bgp[1]], [pattern for (pattern, _) in self.st.explain(bgp[:2])])
+        self.assertEquals([bgp[1], bgp[0]], [pattern for (pattern, _) in self.st.explain(bgp[:2], bound = [n])])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+from rdflib_appengine.ndbstore import NDBStore, GraphShard
+from rdflib_appengine.sparqljson import iter_json
+from google.appengine.ext import testbed
+from rdflib.term import URIRef, Literal, BNode
+from rdflib import Graph
+from pyparsing import ParseException
+import json
+
+_TRIPLES = ([(URIRef('http://s{}'.format(i)), URIRef('http://p'), Literal(i)) for i in range(250)]
+            + [(URIRef('http://s{}'.format(i)), URIRef('http://q'), Literal(u'\xe6 {}'.format(i), lang = 'da')) for i in range(5)]
+            + [(BNode('b'), URIRef('http://q'), URIRef('http://o'))])
+
+_SELECT = 'SELECT ?s ?o ?l WHERE { ?s <http://p> ?o OPTIONAL { ?s <http://q> ?l } }'
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+        # Then activate the testbed, which prepares the service stubs for use.
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        GraphShard._graph_cache.clear()
+        self.st = NDBStore(identifier = 'banana')
+        self.st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+        self.g = Graph(store = self.st)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testSelect(self):
+        chunks = list(iter_json(self.g, _SELECT))
+        self.assertTrue(len(chunks) > 3, chunks)
+        self._assertSameResults(self.g.query(_SELECT).serialize(format = 'json'), ''.join(chunks))
+        q = 'SELECT ?s ?o WHERE { ?s <http://q> ?o }'
+        self._assertSameResults(self.g.query(q).serialize(format = 'json'), ''.join(iter_json(self.g, q)))
+
+    def testEmpty(self):
+        q = 'SELECT ?s WHERE { ?s <http://nothing> ?o }'
+        self._assertSameResults(self.g.query(q).serialize(format = 'json'), ''.join(iter_json(self.g, q)))
+
+    def testAsk(self):
+        self.assertEquals({'head' : {}, 'boolean' : True}, json.loads(''.join(iter_json(self.g, 'ASK { ?s <http://p> ?o }'))))
+
+    def testMaxRows(self):
+        result = json.loads(''.join(iter_json(self.g, _SELECT, max_rows = 42)))
+        self.assertEquals(42, len(result['results']['bindings']))
+        self.assertTrue(result['results']['truncated'])
+        result = json.loads(''.join(iter_json(self.g, _SELECT, max_rows = 250)))
+        self.assertEquals(250, len(result['results']['bindings']))
+        self.assertFalse('truncated' in result['results'])
+
+    def testConstruct(self):
+        self.assertRaises(ValueError, iter_json, self.g, 'CONSTRUCT { ?s ?p ?o } WHERE { ?s ?p ?o }')
+
+    def testInvalidQueryRaisesBeforeStreaming(self):
+        self.assertRaises(ParseException, iter_json, self.g, 'SELECT ?s WHERE { ?s <http://p> }')
+
+    def testClosingStopsEvaluation(self):
+        calls = []
+        triples = self.st.triples
+        def counting_triples(pattern, context = None):
+            calls.append(pattern)
+            return triples(pattern, context)
+        self.st.triples = counting_triples
+        chunks = iter_json(self.g, 'SELECT ?s ?o ?x WHERE { ?s <http://p> ?o . ?s <http://q> ?x }', rows_per_chunk = 1)
+        chunks.next()
+        chunks.next()
+        chunks.close()
+        self.assertTrue(len(calls) < 50, len(calls))
+
+    def _assertSameResults(self, expected, actual):
+        expected = json.loads(expected)
+        actual = json.loads(actual)
+        self.assertEquals(set(expected['head']['vars']), set(actual['head']['vars']))
+        self.assertEquals(sorted(expected['results']['bindings']), sorted(actual['results']['bindings']))
+
+if __name__ == '__main__':
+    unittest.main()
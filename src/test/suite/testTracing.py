@@ -0,0 +1,79 @@
+import unittest
+from rdflib_appengine.ndbstore import NDBStore, GraphShard
+from rdflib_appengine.tracing import Span, NULL_SPAN
+from google.appengine.ext import testbed
+from rdflib.term import URIRef, Literal
+from rdflib import Graph
+import json
+
+_TRIPLES = ([(URIRef('http://s{}'.format(i)), URIRef('http://p'), Literal(i)) for i in range(20)]
+            + [(URIRef('http://s{}'.format(i)), URIRef('http://q'), URIRef('http://s{}'.format(i + 1))) for i in range(20)])
+
+_QUERY = 'SELECT ?o WHERE { ?s <http://q> ?x . ?x <http://p> ?o }'
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+        # Then activate the testbed, which prepares the service stubs for use.
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        GraphShard._graph_cache.clear()
+        self.spans = []
+        self.st = NDBStore(identifier = 'banana', configuration = {'tracer': self.spans.append})
+        self.st.addN([(s, p, o, None) for (s, p, o) in _TRIPLES])
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testQuery(self):
+        self.assertEquals(19, len(list(Graph(store = self.st).query(_QUERY))))
+        self.assertEquals(['SelectQuery'], [span.name for span in self.spans])
+        root = self.spans[0]
+        self.assertEquals(19, root.attributes['solutions'])
+        self.assertTrue(root.end is not None)
+        self.assertEquals(1, len(list(root.walk('plan'))))
+        self.assertEquals(1 + 20, len(list(root.walk('triples')))) #One for each binding of ?x
+        self.assertEquals(20 + 19, root.total('triples', 'triples'))
+        loaded = [span for span in root.walk('shard') if span.attributes['layer'] == 'datastore']
+        self.assertEquals(2, len(loaded))
+        self.assertTrue(all([span.attributes['bytes'] > 0 for span in loaded]))
+        self.assertEquals(len(_TRIPLES), sum([span.attributes['triples'] for span in loaded]))
+        json.dumps(root.to_dict())
+        list(Graph(store = self.st).query(_QUERY))
+        self.assertEquals(set(['local']), set([span.attributes['layer'] for span in self.spans[1].walk('shard')]))
+
+    def testTriplesOutsideQuery(self):
+        triples = self.st.triples((URIRef('http://s1'), None, None))
+        triples.next()
+        self.assertEquals([], self.spans)
+        triples.close()
+        self.assertEquals(['triples'], [span.name for span in self.spans])
+        self.assertEquals(1, self.spans[0].attributes['triples'])
+        self.assertEquals('s', self.spans[0].attributes['route'])
+
+    def testLog(self):
+        st = NDBStore(identifier = 'banana', configuration = {'log': True})
+        list(Graph(store = st).query(_QUERY))
+        log = st._log.getvalue()
+        self.assertTrue('SelectQuery' in log, log)
+        self.assertTrue('layer=datastore' in log, log)
+
+    def testDisabled(self):
+        st = NDBStore(identifier = 'banana')
+        self.assertFalse(st.is_tracing())
+        self.assertTrue(st._span('triples') is NULL_SPAN)
+        self.assertEquals(19, len(list(Graph(store = st).query(_QUERY))))
+
+    def testSpan(self):
+        root = Span('root')
+        root.child('a', n = 1).finish()
+        b = root.child('b', n = 2)
+        b.child('a', n = 3).finish()
+        self.assertEquals(4, root.total('n', 'a'))
+        self.assertEquals(['root', 'a', 'b', 'a'], [span.name for span in root.walk()])
+        self.assertEquals(4, len(root.format().split('\n')))
+
+if __name__ == '__main__':
+    unittest.main()